@@ -0,0 +1,182 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+Local stand-in for a nominatim server serving canned search, reverse and
+lookup replies. It can also be run on its own to point the plugin at it:
+
+    python3 -m bulknominatim.benchmark.mockServer --port 8080 --latency 0.05
+"""
+import sys
+import gzip
+import json
+import time
+import zlib
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl
+
+
+def address(seed):
+    '''Canned address details derived from seed.'''
+    return {
+        'house_number': str(seed % 9999 + 1),
+        'road': 'Road {}'.format(seed % 977),
+        'neighbourhood': 'Neighbourhood {}'.format(seed % 313),
+        'town': 'Town {}'.format(seed % 101),
+        'city': 'City {}'.format(seed % 53),
+        'county': 'County {}'.format(seed % 29),
+        'state': 'State {}'.format(seed % 13),
+        'postcode': '{:05d}'.format(seed % 99999),
+        'country': 'Country {}'.format(seed % 7),
+        'country_code': 'c{}'.format(seed % 7)}
+
+
+def place(seed, details):
+    '''A canned nominatim place derived from seed.'''
+    lat = (seed % 170000) / 1000.0 - 85
+    lon = (seed // 7 % 360000) / 1000.0 - 180
+    result = {
+        'place_id': seed,
+        'licence': 'Data (c) OpenStreetMap contributors, ODbL 1.0.',
+        'osm_type': ('node', 'way', 'relation')[seed % 3],
+        'osm_id': seed * 3 + 1,
+        'lat': '{:.7f}'.format(lat),
+        'lon': '{:.7f}'.format(lon),
+        'class': 'place',
+        'type': 'house',
+        'importance': 0.5,
+        'display_name': '{} Road {}, City {}, Country {}'.format(seed % 9999 + 1, seed % 977, seed % 53, seed % 7),
+        'boundingbox': ['{:.7f}'.format(lat - 0.001), '{:.7f}'.format(lat + 0.001),
+            '{:.7f}'.format(lon - 0.001), '{:.7f}'.format(lon + 0.001)]}
+    if details:
+        result['address'] = address(seed)
+    return result
+
+
+class MockNominatim(object):
+    '''Threaded HTTP server answering /search, /reverse and /lookup requests after
+    latency seconds, plus up to jitter more. A fraction errorRate of the
+    requests fail with HTTP 503. Searches return up to results places. If
+    workers is set only that many requests are served at once, like a
+    server with a fixed number of worker processes. The replies depend only
+    on the query so repeated runs are comparable.'''
+
+    def __init__(self, latency=0.0, jitter=0.0, errorRate=0.0, results=1, port=0, workers=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.errorRate = errorRate
+        self.results = results
+        self.numRequests = 0
+        self.numErrors = 0
+        self.lock = threading.Lock()
+        self.random = random.Random(1)
+        self.workers = threading.Semaphore(workers) if workers > 0 else None
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self.handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self.url()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reply(self, path, params):
+        '''Return the HTTP status and body of a request.'''
+        with self.lock:
+            self.numRequests += 1
+            fail = self.errorRate > 0 and self.random.random() < self.errorRate
+            delay = self.latency + (self.random.random() * self.jitter if self.jitter else 0)
+            if fail:
+                self.numErrors += 1
+        if delay > 0:
+            if self.workers is not None:
+                with self.workers:
+                    time.sleep(delay)
+            else:
+                time.sleep(delay)
+        if fail:
+            return 503, b'{"error": "Service temporarily unavailable"}'
+        details = params.get('addressdetails') == '1'
+        seed = zlib.crc32(json.dumps(sorted(params.items())).encode('utf-8'))
+        if path.startswith('/reverse'):
+            body = place(seed, details)
+        elif path.startswith('/search'):
+            limit = min(self.results, int(params.get('limit', 10)))
+            body = [place(seed + i, details) for i in range(limit)]
+        elif path.startswith('/lookup'):
+            body = []
+            types = {'N': 'node', 'W': 'way', 'R': 'relation'}
+            for key in params.get('osm_ids', '').split(','):
+                if key[:1] in types and key[1:].isdigit():
+                    result = place(int(key[1:]), details)
+                    result['osm_type'] = types[key[:1]]
+                    result['osm_id'] = int(key[1:])
+                    body.append(result)
+        else:
+            return 404, b'{"error": "Unknown endpoint"}'
+        return 200, json.dumps(body).encode('utf-8')
+
+    def handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are written separately, which stalls kept
+            # alive connections on delayed acks with Nagle's algorithm.
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                parts = urlsplit(self.path)
+                status, body = mock.reply(parts.path, dict(parse_qsl(parts.query)))
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                if len(body) > 1024 and 'gzip' in self.headers.get('Accept-Encoding', ''):
+                    body = gzip.compress(body)
+                    self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(body)))
+                if status == 503:
+                    self.send_header('Retry-After', '0')
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+        return Handler
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='mockServer', description='Local stand-in nominatim server.')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds before each reply')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Random extra seconds of latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests failing with 503')
+    parser.add_argument('--results', type=int, default=1, help='Results per search')
+    parser.add_argument('--workers', type=int, default=0, help='Requests served at once, 0 for no limit')
+    args = parser.parse_args(argv)
+    server = MockNominatim(args.latency, args.jitter, args.error_rate, args.results, args.port, args.workers)
+    sys.stderr.write('Serving on {}\n'.format(server.url()))
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
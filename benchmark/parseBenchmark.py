@@ -0,0 +1,122 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+Compare parsing nominatim search replies with address details the way the
+plugin used to, decoding the reply to text and validating one field at a
+time, against the table driven parser working on the raw reply bytes:
+
+    python3 -m bulknominatim.benchmark.parseBenchmark --replies 2000 --results 10
+"""
+import sys
+import json
+import time
+import argparse
+
+from .. import geocodeEngine
+from ..geocodeEngine import ADDRESS_FIELDS, parseForward, parseReverse
+from .mockServer import place
+
+
+def fieldValidate(data, name):
+    if name in data:
+        return str(data[name])
+    return ''
+
+
+def legacyForward(data, address):
+    '''The parsing of a search reply before the table driven parser.'''
+    jd = json.loads(data.decode('utf-8', errors='replace'))
+    points = []
+    for addr in jd:
+        lat = float(addr['lat'])
+        lon = float(addr['lon'])
+        attributes = [fieldValidate(addr, 'osm_type'), fieldValidate(addr, 'osm_id'),
+            fieldValidate(addr, 'class'), fieldValidate(addr, 'type'), address,
+            fieldValidate(addr, 'display_name')]
+        details = addr.get('address', {})
+        attributes.extend([fieldValidate(details, name) for name in ADDRESS_FIELDS])
+        points.append((lon, lat, attributes))
+    return points
+
+
+def legacyReverse(data):
+    jd = json.loads(data.decode('utf-8', errors='replace'))
+    attributes = [fieldValidate(jd, 'osm_type'), fieldValidate(jd, 'osm_id'), fieldValidate(jd, 'display_name')]
+    details = jd.get('address', {})
+    attributes.extend([fieldValidate(details, name) for name in ADDRESS_FIELDS])
+    return attributes
+
+
+def makeReplies(numReplies, numResults):
+    '''Raw search and reverse replies with address details.'''
+    search = [json.dumps([place(i * numResults + j, True) for j in range(numResults)]).encode('utf-8')
+        for i in range(numReplies)]
+    reverse = [json.dumps(place(i, True)).encode('utf-8') for i in range(numReplies)]
+    return search, reverse
+
+
+def timeit(func, replies, repeat):
+    '''Best time in seconds of func over all replies.'''
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        for data in replies:
+            func(data)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def backends():
+    '''The JSON decoders that are installed.'''
+    found = [('json', json.loads)]
+    for name in ('ujson', 'orjson'):
+        try:
+            found.append((name, __import__(name).loads))
+        except ImportError:
+            pass
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='parseBenchmark', description='Benchmark nominatim reply parsing.')
+    parser.add_argument('--replies', type=int, default=2000, help='Number of replies')
+    parser.add_argument('--results', type=int, default=10, help='Places per search reply')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs of which the best is reported')
+    args = parser.parse_args(argv)
+
+    search, reverse = makeReplies(args.replies, args.results)
+    size = sum(len(data) for data in search) / 1048576.0
+    print('{} search replies of {} places ({:.1f} MB), {} reverse replies'.format(
+        len(search), args.results, size, len(reverse)))
+    print('JSON decoder used by the plugin: {}'.format(geocodeEngine.JSON_BACKEND))
+    legacySearch = timeit(lambda data: legacyForward(data, 'address'), search, args.repeat)
+    legacyRev = timeit(legacyReverse, reverse, args.repeat)
+    print('{:>10} {:>14} {:>10} {:>14} {:>10}'.format('parser', 'search rep/s', 'speedup', 'reverse rep/s', 'speedup'))
+    print('{:>10} {:>14.0f} {:>10} {:>14.0f} {:>10}'.format('legacy', len(search) / legacySearch, '1.00x',
+        len(reverse) / legacyRev, '1.00x'))
+    saved = geocodeEngine.loadJson
+    try:
+        for name, loads in backends():
+            geocodeEngine.loadJson = loads
+            # Check the output matches the legacy parser
+            if parseForward(geocodeEngine.loadReply(search[0]), 'address', True) != legacyForward(search[0], 'address'):
+                print('{}: search output differs from the legacy parser'.format(name))
+            t1 = timeit(lambda data: parseForward(geocodeEngine.loadReply(data), 'address', True), search, args.repeat)
+            t2 = timeit(lambda data: parseReverse(geocodeEngine.loadReply(data), True), reverse, args.repeat)
+            print('{:>10} {:>14.0f} {:>9.2f}x {:>14.0f} {:>9.2f}x'.format(name, len(search) / t1, legacySearch / t1,
+                len(reverse) / t2, legacyRev / t2))
+    finally:
+        geocodeEngine.loadJson = saved
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,296 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+Measure the throughput of the geocoding request loop against the local
+mock nominatim server. Run it from the QGIS plugins directory:
+
+    python3 -m bulknominatim.benchmark.runBenchmark --sizes 100,1000,10000 --latency 0.02
+
+For each mode and table size it reports rows per second, request latency
+percentiles and the peak Python memory allocated during the run.
+
+By default the requests are made by the headless GeocodeEngine used by
+bulkGeocode. With --loop qgis, or both, they are also made by the
+RequestDispatcher used by the dialog, Processing and map tools, under a
+QgsApplication. Run it with the Python of a QGIS install for that mode,
+which is skipped if qgis.core cannot be imported.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+
+from ..endpointPool import EndpointPool, STRATEGIES
+from ..geocodeEngine import (GeocodeConfig, GeocodeEngine, QueryTemplate, forwardOptions, freeFormQuery,
+    reverseQuery, osmKey, lookupBatches, lookupResults, loadReply, parseForward, parseReverse)
+from ..geocodeCache import GeocodeCache
+from ..rateLimiter import limiter
+from .mockServer import MockNominatim
+
+MODES = ('table', 'freeform', 'reverse', 'lookup')
+# Request loops that can be measured
+LOOPS = ('engine', 'qgis', 'both')
+# Columns of the generated address tables
+TABLE_COLUMNS = {'full': -1, 'number': 0, 'street': 1, 'city': 2, 'county': -1, 'state': 3,
+    'country': 4, 'postal': -1}
+
+
+class TimedEngine(GeocodeEngine):
+    '''GeocodeEngine recording the latency of every request.'''
+
+    def __init__(self, config):
+        super(TimedEngine, self).__init__(config)
+        self.latencies = []
+
+    def request(self, url):
+        start = time.perf_counter()
+        result = super(TimedEngine, self).request(url)
+        self.latencies.append(time.perf_counter() - start)
+        return result
+
+
+class LatencyRecorder(object):
+    '''Stands in for the RunStats of a RequestDispatcher to record the
+    network time of every request.'''
+
+    def __init__(self):
+        self.latencies = []
+
+    def add(self, phase, seconds):
+        if phase == 'network':
+            self.latencies.append(seconds)
+
+
+def startQgis():
+    '''Start a QgsApplication without a GUI for the qgis loop, or return
+    None if QGIS is not installed.'''
+    try:
+        from qgis.core import QgsApplication
+    except ImportError:
+        return None
+    app = QgsApplication([], False)
+    app.initQgis()
+    return app
+
+
+def percentile(values, p):
+    '''Nearest rank percentile of a sorted list.'''
+    if not values:
+        return 0.0
+    rank = max(1, int(round(p / 100.0 * len(values))))
+    return values[min(rank, len(values)) - 1]
+
+
+def makeRows(mode, size, duplicates, seed=1):
+    '''Generate size input rows for mode. A fraction duplicates of them
+    repeat an earlier row.'''
+    rnd = random.Random(seed)
+    rows = []
+    for rowId in range(size):
+        if rows and rnd.random() < duplicates:
+            row = rows[rnd.randrange(len(rows))][1:]
+        elif mode == 'reverse':
+            row = (round(rnd.uniform(-180, 180), 6), round(rnd.uniform(-85, 85), 6))
+        elif mode == 'lookup':
+            row = (rnd.choice(('node', 'way', 'relation')), rnd.randint(1, 10**10))
+        elif mode == 'freeform':
+            row = ('{} Road {}, City {}, State {}'.format(rnd.randint(1, 9999), rnd.randint(1, 977),
+                rnd.randint(1, 53), rnd.randint(1, 13)),)
+        else:
+            row = ([str(rnd.randint(1, 9999)), 'Road {}'.format(rnd.randint(1, 977)),
+                'City {}'.format(rnd.randint(1, 53)), 'State {}'.format(rnd.randint(1, 13)), 'Country 1'],)
+        rows.append((rowId,) + row)
+    return rows
+
+
+def runOne(urls, mode, size, args, cache):
+    config = GeocodeConfig(urls[0], args.results, args.details, maxConcurrent=args.concurrent,
+        maxRetries=args.retries, cache=cache, endpoints=[(url, 1.0) for url in urls], balance=args.balance)
+    engine = TimedEngine(config)
+    rows = makeRows(mode, size, args.duplicates)
+    if mode == 'table':
+        results = engine.table(rows, TABLE_COLUMNS)
+    elif mode == 'freeform':
+        results = engine.forward(rows)
+    elif mode == 'lookup':
+        results = engine.lookup(rows)
+    else:
+        results = engine.reverse(rows)
+    if args.memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    numPoints = 0
+    for result in results:
+        numPoints += len(result.points)
+    elapsed = time.perf_counter() - start
+    engine.close()
+    peak = 0
+    if args.memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return report('engine', mode, size, numPoints, elapsed, peak, engine.latencies, engine.numErrors,
+        engine.numRetries, engine.cacheHits, engine.session.numConnections)
+
+
+def dispatcherJobs(config, mode, rows):
+    '''The (url, context) jobs the plugin tools hand to RequestDispatcher
+    for the rows of a mode.'''
+    if mode in ('table', 'freeform'):
+        # Grouped by query like ForwardGeocodeTask.groupQueries
+        options = forwardOptions(config.maxResults, config.showDetails)
+        template = QueryTemplate(config.searchURL(), TABLE_COLUMNS, False, options)
+        queries = {}
+        for row in rows:
+            if mode == 'table':
+                url, address = template(row[1])
+            else:
+                url, address = freeFormQuery(config.searchURL(), row[1]) + options, row[1]
+            queries.setdefault(url, []).append(address)
+        return queries.items()
+    if mode == 'lookup':
+        keys = ((rowId, osmKey(osmType, osmId)) for rowId, osmType, osmId in rows)
+        return lookupBatches(config.lookupURL(), keys, config.showDetails)
+    return ((reverseQuery(config.reverseURL(), lat, lon, config.showDetails, config.levelOfDetail), None)
+        for rowId, lon, lat in rows)
+
+
+def runDispatcher(urls, mode, size, args, cache):
+    '''Run a mode through the RequestDispatcher of the plugin tools. The
+    replies are parsed in the callback as the tools do.'''
+    from ..dispatcher import RequestDispatcher
+    config = GeocodeConfig(urls[0], args.results, args.details)
+    pool = EndpointPool(urls[0], [(url, 1.0) for url in urls], args.balance)
+    recorder = LatencyRecorder()
+    dispatcher = RequestDispatcher(args.concurrent, cache, maxRetries=args.retries, stats=recorder, pool=pool)
+    counts = {'points': 0, 'errors': 0}
+
+    def callback(context, data):
+        try:
+            if mode == 'lookup':
+                for rowId, key, points, error in lookupResults(context, data, config.showDetails):
+                    if error is None:
+                        counts['points'] += len(points)
+                    else:
+                        counts['errors'] += 1
+            elif mode == 'reverse':
+                parseReverse(loadReply(data), config.showDetails)
+                counts['points'] += 1
+            else:
+                counts['points'] += len(parseForward(loadReply(data), context[0], config.showDetails)) * len(context)
+        except Exception:
+            counts['errors'] += 1
+
+    jobs = dispatcherJobs(config, mode, makeRows(mode, size, args.duplicates))
+    if args.memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    dispatcher.fetchAll(jobs, callback)
+    elapsed = time.perf_counter() - start
+    peak = 0
+    if args.memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return report('qgis', mode, size, counts['points'], elapsed, peak, recorder.latencies, counts['errors'],
+        dispatcher.numRetries, dispatcher.cacheHits, 'n/a')
+
+
+def report(loop, mode, size, numPoints, elapsed, peak, latencies, errors, retries, cacheHits, connections):
+    latencies = sorted(latencies)
+    return {
+        'loop': loop,
+        'mode': mode,
+        'rows': size,
+        'points': numPoints,
+        'seconds': round(elapsed, 3),
+        'rows_per_sec': round(size / elapsed, 1) if elapsed else 0.0,
+        'requests': len(latencies),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'peak_mb': round(peak / 1048576.0, 2),
+        'errors': errors,
+        'retries': retries,
+        'cache_hits': cacheHits,
+        'connections': connections}
+
+
+def parseArguments(argv):
+    parser = argparse.ArgumentParser(prog='runBenchmark',
+        description='Benchmark bulk geocoding against a local mock nominatim server.')
+    parser.add_argument('--sizes', default='100,1000', help='Comma separated table sizes')
+    parser.add_argument('--modes', default=','.join(MODES), help='Comma separated modes: table, freeform, reverse, lookup')
+    parser.add_argument('--loop', choices=LOOPS, default=LOOPS[0],
+        help='Request loop to measure: the headless engine, the RequestDispatcher of the plugin under QGIS, or both')
+    parser.add_argument('--latency', type=float, default=0.01, help='Server latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Random extra server latency in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests failing with 503')
+    parser.add_argument('--results', type=int, default=1, help='Results per search')
+    parser.add_argument('--workers', type=int, default=0, help='Requests each mock server serves at once, 0 for no limit')
+    parser.add_argument('--details', action='store_true', help='Request address details')
+    parser.add_argument('--concurrent', type=int, default=4, help='Concurrent requests')
+    parser.add_argument('--replicas', type=int, default=1, help='Number of mock servers to spread requests across')
+    parser.add_argument('--balance', choices=STRATEGIES, default=STRATEGIES[0], help='Load balancing strategy')
+    parser.add_argument('--rate', type=float, default=0, help='Requests per second, 0 for no limit')
+    parser.add_argument('--retries', type=int, default=5, help='Retries per failed request')
+    parser.add_argument('--duplicates', type=float, default=0.0, help='Fraction of rows repeating an earlier row')
+    parser.add_argument('--cache', action='store_true', help='Use a fresh reply cache for each run')
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+        help='Do not trace memory, which slows the run down')
+    parser.add_argument('--json', help='Also write the results to this JSON file')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArguments(argv)
+    limiter.setRate(args.rate)
+    runners = []
+    if args.loop in ('engine', 'both'):
+        runners.append(runOne)
+    if args.loop in ('qgis', 'both'):
+        app = startQgis()
+        if app is None:
+            sys.stderr.write('qgis.core can not be imported, skipping the qgis loop\n')
+        else:
+            runners.append(runDispatcher)
+    servers = [MockNominatim(args.latency, args.jitter, args.error_rate, args.results, workers=args.workers)
+        for i in range(max(1, args.replicas))]
+    urls = [server.start() for server in servers]
+    reports = []
+    columns = ['loop', 'mode', 'rows', 'rows_per_sec', 'p50_ms', 'p95_ms', 'p99_ms', 'peak_mb', 'requests', 'errors',
+        'retries', 'cache_hits', 'connections']
+    print(' '.join(['{:>12}'.format(c) for c in columns]))
+    try:
+        for mode in args.modes.split(','):
+            for size in [int(s) for s in args.sizes.split(',')]:
+                for runner in runners:
+                    cache = None
+                    if args.cache:
+                        cache = GeocodeCache(os.path.join(tempfile.mkdtemp(), 'cache.sqlite'))
+                    report = runner(urls, mode.strip(), size, args, cache)
+                    if cache is not None:
+                        cache.close()
+                    reports.append(report)
+                    print(' '.join(['{:>12}'.format(report[c]) for c in columns]))
+                    sys.stdout.flush()
+    finally:
+        for server in servers:
+            server.stop()
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(reports, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -10,20 +10,19 @@
 """
 import os
 import re
-import json
-from urllib.parse import quote_plus
 
-from qgis.core import (Qgis, QgsVectorLayer, QgsField, QgsNetworkContentFetcher,
-    QgsPalLayerSettings, QgsCoordinateReferenceSystem, QgsCoordinateTransform, QgsNetworkAccessManager,
-    QgsFeature, QgsGeometry, QgsPointXY, QgsFeatureRequest, QgsProject, QgsMapLayerProxyModel,
-    QgsVectorLayerSimpleLabeling)
-
-from qgis.PyQt.QtCore import QVariant, QUrl, QEventLoop, QTextCodec
-from qgis.PyQt.QtNetwork import QNetworkRequest, QNetworkReply
+from qgis.core import (Qgis, QgsApplication, QgsCoordinateReferenceSystem, QgsCoordinateTransform,
+    QgsProject, QgsMapLayerProxyModel, QgsVectorLayerFeatureSource, QgsWkbTypes)
+from qgis.gui import QgsFileWidget
 
 from qgis.PyQt.QtWidgets import QDialog
 from qgis.PyQt import uic
 
+from .geocodeTask import AddressTableTask, FreeFormTask, ReverseGeocodeTask, LookupTask
+from .jobJournal import JobJournal
+from .resultWriter import (MemoryResultWriter, OgrResultWriter, SourceLayerWriter, SIMPLE_FIELDS,
+    FORWARD_FIELDS, REVERSE_FIELDS, FILE_FILTER)
+
 FORM_CLASS, _ = uic.loadUiType(os.path.join(
     os.path.dirname(__file__), 'bulkNominatim.ui'))
 
@@ -37,10 +36,23 @@ class BulkNominatimDialog(QDialog, FORM_CLASS):
         self.settings = settings
         self.addressMapLayerComboBox.setFilters(QgsMapLayerProxyModel.VectorLayer)
         self.addressMapLayerComboBox.layerChanged.connect(self.findFields)
+        self.addressMapLayerComboBox.layerChanged.connect(self.updateWriteBack)
+        self.writeBackCheckBox.toggled.connect(self.updateWriteBack)
         self.mMapLayerComboBox.setFilters(QgsMapLayerProxyModel.PointLayer)
+        self.lookupLayerComboBox.setFilters(QgsMapLayerProxyModel.VectorLayer)
+        self.lookupLayerComboBox.layerChanged.connect(self.findLookupFields)
+        self.osmTypeComboBox.setAllowEmptyFieldName(True)
+        self.findLookupFields(self.lookupLayerComboBox.currentLayer())
+        self.outputFileWidget.setStorageMode(QgsFileWidget.SaveFile)
+        self.outputFileWidget.setFilter(FILE_FILTER)
+        self.statsFileWidget.setStorageMode(QgsFileWidget.SaveFile)
+        self.statsFileWidget.setFilter('JSON (*.json);;CSV (*.csv)')
+        self.task = None
 
     def accept(self):
         '''process and geocode the addresses'''
+        if self.isRunning():
+            return
         selected_tab = self.tabWidget.currentIndex()
         # Clear the Results Dialog box
         self.resultsTextEdit.clear()
@@ -48,102 +60,107 @@ class BulkNominatimDialog(QDialog, FORM_CLASS):
             self.processAddressTable()
         elif selected_tab == 1:
             self.processFreeFormData()
-        else:
+        elif selected_tab == 2:
             self.reverseGeocode()
+        else:
+            self.lookupOsmIds()
         
     def showEvent(self, event):
         '''The dialog is being shown. We need to initialize it.'''
         super(BulkNominatimDialog, self).showEvent(event)
         self.findFields()
         
-    def request(self, url):
-        fetcher = QgsNetworkContentFetcher()
-        fetcher.fetchContent(QUrl(url))
-        evloop = QEventLoop()
-        fetcher.finished.connect(evloop.quit)
-        evloop.exec_(QEventLoop.ExcludeUserInputEvents)
-        fetcher.finished.disconnect(evloop.quit)
-        return fetcher.contentAsString()
-    
     def reverseGeocode(self):
         layer = self.mMapLayerComboBox.currentLayer()
         if not layer:
             self.iface.messageBar().pushMessage("", "No valid point vector layer to reverse geocode" , level=Qgis.Warning, duration=6)
             return
-        
+
         showDetails = int( self.detailedAddressCheckBox.isChecked())
-        self.numAddress = layer.featureCount()
-        self.numErrors = 0
-        if self.numAddress > self.settings.maxAddress:
+        numAddress = layer.featureCount()
+        if numAddress > self.settings.maxAddress and not self.settings.streamingMode:
             self.iface.messageBar().pushMessage("", "Maximum geocodes to process were exceeded. Please reduce the number and try again." , level=Qgis.Warning, duration=6)
             return
-            
-        layername = self.layerLineEdit.text()
-        self.createPointLayerReverse()
-        
+
+        writer = self.createWriter(REVERSE_FIELDS)
+        if writer is None:
+            return
+
         layerCRS = layer.crs()
         epsg4326 = QgsCoordinateReferenceSystem("EPSG:4326")
         transform = QgsCoordinateTransform(layerCRS, epsg4326, QgsProject.instance())
 
-        iter = layer.getFeatures()
-        
-        for feature in iter:
-            # already know that this is a point vector layer
-            pt = feature.geometry().asPoint()
-            # make sure the coordinates are in EPSG:4326
-            pt = transform.transform(pt.x(), pt.y())
-            newfeature = QgsFeature()
-            newfeature.setGeometry(QgsGeometry.fromPointXY(pt))
-            lat = str(pt.y())
-            lon = str(pt.x())
-            url = '{}?format=json&lat={}&lon={}&zoom=18&addressdetails={}'.format(self.settings.reverseURL(),lat,lon,showDetails)
-            jsondata = self.request(url)
-            # print(jsondata)
-            address = ''
-            try:
-                jd = json.loads(jsondata)
-                if len(jd) == 0:
-                    raise ValueError('')
-                display_name = self.fieldValidate(jd, 'display_name')
-                if showDetails:
-                    osm_type = self.fieldValidate(jd, 'osm_type')
-                    osm_id = self.fieldValidate(jd, 'osm_id')
-                    house_number = ''
-                    road = ''
-                    neighbourhood = ''
-                    locality = ''
-                    town = ''
-                    city = ''
-                    county = ''
-                    state = ''
-                    postcode = ''
-                    country = ''
-                    country_code = ''
-                    if 'address' in jd:
-                        house_number = self.fieldValidate(jd['address'], 'house_number')
-                        road = self.fieldValidate(jd['address'], 'road')
-                        neighbourhood = self.fieldValidate(jd['address'], 'neighbourhood')
-                        locality = self.fieldValidate(jd['address'], 'locality')
-                        town = self.fieldValidate(jd['address'], 'town')
-                        city = self.fieldValidate(jd['address'], 'city')
-                        county = self.fieldValidate(jd['address'], 'county')
-                        state = self.fieldValidate(jd['address'], 'state')
-                        postcode = self.fieldValidate(jd['address'], 'postcode')
-                        country = self.fieldValidate(jd['address'], 'country')
-                        country_code = self.fieldValidate(jd['address'], 'country_code')
-                    feature.setAttributes([osm_type, osm_id, display_name, house_number, road, neighbourhood, locality, town, city, county, state, postcode, country, country_code])
-                    self.provider.addFeatures([feature])
-                else:
-                    feature.setAttributes([display_name])
-                    self.provider.addFeatures([feature])
-            except Exception:
-                self.numErrors += 1
-        
-        self.pointLayer.updateExtents()
-        QgsProject.instance().addMapLayer(self.pointLayer)
-        if self.numAddress > 0:
-            self.resultsTextEdit.appendPlainText('Total Points Processed: '+str(self.numAddress))
-            self.resultsTextEdit.appendPlainText('Processing Complete!')
+        journal = self.createJournal('reverse', layer.source(), layer.subsetString(),
+            self.settings.reverseURL(), showDetails, self.settings.snapTolerance)
+        task = ReverseGeocodeTask(self.settings, writer, showDetails, self.resultsTextEdit,
+            QgsVectorLayerFeatureSource(layer), numAddress, transform, journal)
+        self.startTask(task)
+
+    def findLookupFields(self, layer):
+        self.osmTypeComboBox.setLayer(layer)
+        self.osmIdComboBox.setLayer(layer)
+        if layer:
+            fields = layer.fields()
+            if fields.lookupField('osm_type') >= 0:
+                self.osmTypeComboBox.setField('osm_type')
+            if fields.lookupField('osm_id') >= 0:
+                self.osmIdComboBox.setField('osm_id')
+
+    def lookupOsmIds(self):
+        layer = self.lookupLayerComboBox.currentLayer()
+        if not layer:
+            self.iface.messageBar().pushMessage("", "No valid table or vector layer to look up" , level=Qgis.Warning, duration=6)
+            return
+        fields = layer.fields()
+        idIdx = fields.lookupField(self.osmIdComboBox.currentField())
+        if idIdx < 0:
+            self.iface.messageBar().pushMessage("", "Select the field holding the OSM ID" , level=Qgis.Warning, duration=6)
+            return
+        typeIdx = fields.lookupField(self.osmTypeComboBox.currentField()) if self.osmTypeComboBox.currentField() else -1
+        numAddress = layer.featureCount()
+        if numAddress > self.settings.maxAddress and not self.settings.streamingMode:
+            self.iface.messageBar().pushMessage("", "Maximum geocodes to process were exceeded. Please reduce the number and try again." , level=Qgis.Warning, duration=6)
+            return
+
+        showDetails = int( self.detailedAddressCheckBox.isChecked())
+        writer = self.createWriter(FORWARD_FIELDS)
+        if writer is None:
+            return
+        journal = self.createJournal('lookup', layer.source(), layer.subsetString(), self.settings.lookupURL(),
+            showDetails, typeIdx, idIdx)
+        task = LookupTask(self.settings, writer, showDetails, self.resultsTextEdit,
+            QgsVectorLayerFeatureSource(layer), numAddress, typeIdx, idIdx, journal)
+        self.startTask(task)
+
+    def createJournal(self, *keys):
+        '''Create the checkpoint journal of a job identified by keys. Unless
+        resuming is enabled any earlier checkpoint of the job is discarded.'''
+        journal = JobJournal(os.path.join(QgsApplication.qgisSettingsDirPath(), 'bulknominatim', 'journals'), *keys)
+        if not self.resumeCheckBox.isChecked():
+            journal.remove()
+        elif journal.exists():
+            self.resultsTextEdit.appendPlainText('Resuming from the last checkpoint of this job.')
+        return journal
+
+    def startTask(self, task):
+        '''Hand the geocoding job to the QGIS task manager.'''
+        self.task = task
+        self.task.statsPath = self.statsFileWidget.filePath().strip()
+        self.task.statusChanged.connect(self.statusLabel.setText)
+        self.statusLabel.clear()
+        self.task.taskCompleted.connect(self.taskDone)
+        self.task.taskTerminated.connect(self.taskDone)
+        QgsApplication.taskManager().addTask(self.task)
+        self.resultsTextEdit.appendPlainText('Geocoding started. Progress is shown in the QGIS task manager.')
+
+    def taskDone(self):
+        self.task = None
+
+    def isRunning(self):
+        if self.task is not None:
+            self.iface.messageBar().pushMessage("", "A bulk geocoding job is already running. Cancel it from the task manager or wait for it to finish." , level=Qgis.Warning, duration=6)
+            return True
+        return False
 
     def findFields(self):
         if not self.isVisible():
@@ -166,190 +183,59 @@ class BulkNominatimDialog(QDialog, FORM_CLASS):
         if not layer:
             self.iface.messageBar().pushMessage("", "No valid table or vector layer to reverse geocode" , level=Qgis.Warning, duration=6)
             return
-        self.numAddress = layer.featureCount()
-        if not self.numAddress:
+        numAddress = layer.featureCount()
+        if not numAddress:
             self.iface.messageBar().pushMessage("", "No addresses to geocode" , level=Qgis.Warning, duration=6)
             return
-            
-        self.numErrors = 0
-        if self.numAddress > self.settings.maxAddress:
-            self.iface.messageBar().pushMessage("", "Maximum geocodes to process were exceeded. Please reduce the number and try again or change the maximum geocodes in Settings." , level=Qgis.Warning, duration=6)
+
+        if numAddress > self.settings.maxAddress and not self.settings.streamingMode:
+            self.iface.messageBar().pushMessage("", "Maximum geocodes to process were exceeded. Please reduce the number and try again or change the maximum geocodes or enable streaming mode in Settings." , level=Qgis.Warning, duration=6)
             return
 
         maxResults = self.maxResultsSpinBox.value()
         showDetails = int( self.detailedAddressCheckBox.isChecked())
         useFreeFormQuery = int(self.freeformCheckBox.isChecked())
-        self.pointLayer = None
-        self.createPointLayer()
-
-        iter = layer.getFeatures(QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry))
-        full_address_idx = self.fullAddressComboBox.currentIndex() - 1
-        street_num_idx = self.numberComboBox.currentIndex() - 1
-        street_name_idx = self.streetNameComboBox.currentIndex() - 1
-        city_idx = self.cityComboBox.currentIndex() - 1
-        county_idx = self.countyComboBox.currentIndex() - 1
-        state_idx = self.stateComboBox.currentIndex() - 1
-        country_idx = self.countryComboBox.currentIndex() - 1
-        postal_idx = self.postalCodeComboBox.currentIndex() - 1
-        
-        for feature in iter:
-            self.isfirst = True
-            if full_address_idx >= 0:
-                address = feature[full_address_idx].strip()
-                address2 = re.sub('\s+', ' ', address)
-                address2 = quote_plus(address2)
-                url = self.settings.searchURL() + '?q=' + address2
-            elif useFreeFormQuery:
-                strs = []
-                if street_name_idx >= 0:
-                    num = ''
-                    name = ''
-                    if street_num_idx  >= 0 and feature[street_num_idx]:
-                        num = ('{}'.format(feature[street_num_idx])).strip()
-                    if feature[street_name_idx]:
-                        name = ('{}'.format(feature[street_name_idx])).strip()
-                    if num:
-                        street = num+' '+name
-                    else:
-                        street = name
-                    if street:
-                        strs.append(street)
-                if city_idx >= 0:
-                    s = ('{}'.format(feature[city_idx])).strip()
-                    if s:
-                        strs.append(s)
-                if county_idx >= 0:
-                    s = ('{}'.format(feature[county_idx])).strip()
-                    if s:
-                        strs.append(s)
-                if state_idx >= 0:
-                    s = ('{}'.format(feature[state_idx])).strip()
-                    if s:
-                        strs.append(s)
-                if country_idx >= 0:
-                    s = ('{}'.format(feature[country_idx])).strip()
-                    if s:
-                        strs.append(s)
-                if postal_idx >= 0:
-                    s = ('{}'.format(feature[postal_idx])).strip()
-                    if s:
-                        strs.append(s)
-                url = self.settings.searchURL() + '?q=' + quote_plus(', '.join(strs))
-            else:
-                address = ','.join([str(x) if x else '' for x in feature.attributes()])
-                url = self.settings.searchURL() + '?'
-                if street_name_idx >= 0:
-                    num = ''
-                    name = ''
-                    if street_num_idx  >= 0 and feature[street_num_idx]:
-                        num = ('{}'.format(feature[street_num_idx])).strip()
-                    if feature[street_name_idx]:
-                        name = ('{}'.format(feature[street_name_idx])).strip()
-                    street = num+' '+name
-                    street = street.strip()
-                    if street:
-                        url += self.formatParam('street', street)
-                if city_idx >= 0:
-                    url += self.formatParam('city', feature[city_idx])
-                if county_idx >= 0:
-                    url += self.formatParam('county', feature[county_idx])
-                if state_idx >= 0:
-                    url += self.formatParam('state', feature[state_idx])
-                if country_idx >= 0:
-                    url += self.formatParam('country', feature[country_idx])
-                if postal_idx >= 0:
-                    url += self.formatParam('postalcode', feature[postal_idx])
-                    
-            url += '&format=json&limit={}&polygon=0&addressdetails={}'.format(maxResults, showDetails)
-            jsondata = self.request(url)
-
-            try:
-                jd = json.loads(jsondata)
-                if len(jd) == 0:
-                    raise ValueError(address)
-                for addr in jd:
-                    try:
-                        lat = addr['lat']
-                        lon = addr['lon']
-                    except:
-                        raise ValueError(address)
-                    
-                    newfeature = QgsFeature()
-                    newfeature.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(float(lon), float(lat))))
-                    display_name = self.fieldValidate(addr, 'display_name')
-
-                    if self.detailedAddressCheckBox.checkState():
-                        osm_type = self.fieldValidate(addr, 'osm_type')
-                        osm_id = self.fieldValidate(addr, 'osm_id')
-                        osm_class = self.fieldValidate(addr, 'class')
-                        type = self.fieldValidate(addr, 'type')
-                        house_number = ''
-                        road = ''
-                        neighbourhood = ''
-                        locality = ''
-                        town = ''
-                        city = ''
-                        county = ''
-                        state = ''
-                        postcode = ''
-                        country = ''
-                        country_code = ''
-                        if 'address' in addr:
-                            house_number = self.fieldValidate(addr['address'], 'house_number')
-                            road = self.fieldValidate(addr['address'], 'road')
-                            neighbourhood = self.fieldValidate(addr['address'], 'neighbourhood')
-                            locality = self.fieldValidate(addr['address'], 'locality')
-                            town = self.fieldValidate(addr['address'], 'town')
-                            city = self.fieldValidate(addr['address'], 'city')
-                            county = self.fieldValidate(addr['address'], 'county')
-                            state = self.fieldValidate(addr['address'], 'state')
-                            postcode = self.fieldValidate(addr['address'], 'postcode')
-                            country = self.fieldValidate(addr['address'], 'country')
-                            country_code = self.fieldValidate(addr['address'], 'country_code')
-                        newfeature.setAttributes([osm_type, osm_id, osm_class, type, address, display_name, house_number, road, neighbourhood, locality, town, city, county, state, postcode, country, country_code])
-                        self.provider.addFeatures([newfeature])
-                    else:
-                        # Display only the resulting output address
-                        newfeature.setAttributes([display_name])
-                        self.provider.addFeatures([newfeature])
-            except Exception as e:
-                if self.numErrors == 0:
-                    self.resultsTextEdit.appendPlainText('Address Errors')
-                self.numErrors += 1
-                self.resultsTextEdit.appendPlainText(str(e))
-
-        if self.numAddress > 0:
-            self.pointLayer.updateExtents()
-            QgsProject.instance().addMapLayer(self.pointLayer)
-            self.resultsTextEdit.appendPlainText('Number of Addresses Processed: '+str(self.numAddress))
-            self.resultsTextEdit.appendPlainText('Number of Successes: '+ str(self.numAddress-self.numErrors))
-            self.resultsTextEdit.appendPlainText('Number of Errors: '+str(self.numErrors))
-            self.resultsTextEdit.appendPlainText('Processing Complete!')
-        
-    def formatParam(self, tag, value):
-        if value:
-            value = ('{}'.format(value)).strip()
-            value = re.sub('\s+', ' ', value)
-            value = quote_plus(value)
-        else:
-            value = ''
-        if self.isfirst:
-            url = '{}={}'.format(tag,value)
-            self.isfirst = False
+        incremental = self.incrementalCheckBox.isChecked()
+        writeBack = self.writeBackCheckBox.isChecked()
+        if incremental and writeBack:
+            self.iface.messageBar().pushMessage("", "Incremental updates are written to an output file, not to the input layer" , level=Qgis.Warning, duration=6)
+            return
+        if incremental and not self.outputFileWidget.filePath().strip():
+            self.iface.messageBar().pushMessage("", "Choose an output file to update incrementally" , level=Qgis.Warning, duration=6)
+            return
+        if writeBack:
+            writer = self.createSourceWriter(layer, FORWARD_FIELDS)
         else:
-            url = '&{}={}'.format(tag,value)
-        return url
-    
+            writer = self.createWriter(FORWARD_FIELDS, incremental)
+        if writer is None:
+            return
+
+        columns = {
+            'full': self.fullAddressComboBox.currentIndex() - 1,
+            'number': self.numberComboBox.currentIndex() - 1,
+            'street': self.streetNameComboBox.currentIndex() - 1,
+            'city': self.cityComboBox.currentIndex() - 1,
+            'county': self.countyComboBox.currentIndex() - 1,
+            'state': self.stateComboBox.currentIndex() - 1,
+            'country': self.countryComboBox.currentIndex() - 1,
+            'postal': self.postalCodeComboBox.currentIndex() - 1}
+
+        # The incremental output file is its own checkpoint
+        journal = None
+        if not incremental:
+            journal = self.createJournal('table', layer.source(), layer.subsetString(), self.settings.searchURL(),
+                maxResults, showDetails, useFreeFormQuery, sorted(columns.items()))
+        task = AddressTableTask(self.settings, writer, showDetails, self.resultsTextEdit, maxResults,
+            QgsVectorLayerFeatureSource(layer), numAddress, columns, useFreeFormQuery, journal, incremental)
+        self.startTask(task)
+
     def processFreeFormData(self):
         addresses = []
-        
+
         # Get the text for the Address Query Box an dgo through line by line to geocode it
         inputtext = str(self.addressTextEdit.toPlainText())
         lines = inputtext.splitlines()
-        self.pointLayer = None
-        self.numAddress = 0
-        self.numErrors = 0
-        
+
         # Create a list of all the Addresses. We want to get an accurate count
         for address in lines:
             # Get rid of beginning and end space
@@ -357,161 +243,65 @@ class BulkNominatimDialog(QDialog, FORM_CLASS):
             # Skip any blank lines
             if not address:
                 continue
-            self.numAddress += 1
             addresses.append(address)
-            
-        if self.numAddress > self.settings.maxAddress:
+
+        if len(addresses) > self.settings.maxAddress and not self.settings.streamingMode:
             self.iface.messageBar().pushMessage("", "Maximum addresses to process were exceeded. Please reduce the number and try again." , level=Qgis.Warning, duration=6)
             return
 
-        if self.numAddress:
-            self.createPointLayer()
+        if not addresses:
+            return
+        writer = self.createWriter(FORWARD_FIELDS)
+        if writer is None:
+            return
         maxResults = self.maxResultsSpinBox.value()
         showDetails = int( self.detailedAddressCheckBox.isChecked())
-        
-        for address in addresses:
-            # Replace internal spaces with + signs
-            address2 = re.sub('\s+', ' ', address)
-            address2 = quote_plus(address2)
-            url = '{}?q={}&format=json&limit={}&polygon=0&addressdetails={}'.format(
-                self.settings.searchURL(), address2, maxResults, showDetails)
-            jsondata = self.request(url)
-            # print(jsondata)
-            try:
-                jd = json.loads(jsondata)
-                if len(jd) == 0:
-                    raise ValueError(address)
-                for addr in jd:
-                    try:
-                        lat = addr['lat']
-                        lon = addr['lon']
-                    except:
-                        raise ValueError(address)
-                    
-                    feature = QgsFeature()
-                    feature.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(float(lon), float(lat))))
-                    display_name = self.fieldValidate(addr, 'display_name')
-
-                    if self.detailedAddressCheckBox.checkState():
-                        osm_type = self.fieldValidate(addr, 'osm_type')
-                        osm_id = self.fieldValidate(addr, 'osm_id')
-                        osm_class = self.fieldValidate(addr, 'class')
-                        type = self.fieldValidate(addr, 'type')
-                        house_number = ''
-                        road = ''
-                        neighbourhood = ''
-                        locality = ''
-                        town = ''
-                        city = ''
-                        county = ''
-                        state = ''
-                        postcode = ''
-                        country = ''
-                        country_code = ''
-                        if 'address' in addr:
-                            house_number = self.fieldValidate(addr['address'], 'house_number')
-                            road = self.fieldValidate(addr['address'], 'road')
-                            neighbourhood = self.fieldValidate(addr['address'], 'neighbourhood')
-                            locality = self.fieldValidate(addr['address'], 'locality')
-                            town = self.fieldValidate(addr['address'], 'town')
-                            city = self.fieldValidate(addr['address'], 'city')
-                            county = self.fieldValidate(addr['address'], 'county')
-                            state = self.fieldValidate(addr['address'], 'state')
-                            postcode = self.fieldValidate(addr['address'], 'postcode')
-                            country = self.fieldValidate(addr['address'], 'country')
-                            country_code = self.fieldValidate(addr['address'], 'country_code')
-                        feature.setAttributes([osm_type, osm_id, osm_class, type, address, display_name, house_number, road, neighbourhood, locality, town, city, county, state, postcode, country, country_code])
-                        self.provider.addFeatures([feature])
-                    else:
-                        # Display only the resulting output address
-                        feature.setAttributes([display_name])
-                        self.provider.addFeatures([feature])
-            except Exception as e:
-                if self.numErrors == 0:
-                    self.resultsTextEdit.appendPlainText('Address Errors')
-                self.numErrors += 1
-                self.resultsTextEdit.appendPlainText(str(e))
-
-        if self.numAddress > 0:
-            self.pointLayer.updateExtents()
-            QgsProject.instance().addMapLayer(self.pointLayer)
-            self.resultsTextEdit.appendPlainText('Number of Addresses Processed: '+str(self.numAddress))
-            self.resultsTextEdit.appendPlainText('Number of Successes: '+ str(self.numAddress-self.numErrors))
-            self.resultsTextEdit.appendPlainText('Number of Errors: '+str(self.numErrors))
-            self.resultsTextEdit.appendPlainText('Processing Complete!')
-
-    def fieldValidate(self, data, name):
-        if name in data:
-            return str(data[name])
-        return ''
-        
-    def createPointLayerReverse(self):
-        layername = self.layerLineEdit.text()
-        self.pointLayer = QgsVectorLayer("point?crs=epsg:4326", layername, "memory")
-        self.provider = self.pointLayer.dataProvider()
-        if self.detailedAddressCheckBox.checkState():
-            self.provider.addAttributes([
-                QgsField("osm_type", QVariant.String),
-                QgsField("osm_id", QVariant.String),
-                QgsField("display_name", QVariant.String),
-                QgsField("house_number", QVariant.String),
-                QgsField("road", QVariant.String),
-                QgsField("neighbourhood", QVariant.String),
-                QgsField("locality", QVariant.String),
-                QgsField("town", QVariant.String),
-                QgsField("city", QVariant.String),
-                QgsField("county", QVariant.String),
-                QgsField("state", QVariant.String),
-                QgsField("postcode", QVariant.String),
-                QgsField("country", QVariant.String),
-                QgsField("country_code", QVariant.String)])
-        else:
-            self.provider.addAttributes([QgsField("display_name", QVariant.String)])
-        self.pointLayer.updateFields()
-        if self.showLabelCheckBox.checkState():
-            # Display labels
-            label = QgsPalLayerSettings()
-            label.fieldName = 'display_name'
-            label.placement= QgsPalLayerSettings.AroundPoint
-            labeling = QgsVectorLayerSimpleLabeling(label)
-            self.pointLayer.setLabeling(labeling)
-            self.pointLayer.setLabelsEnabled(True)
-        
-    def createPointLayer(self):
+
+        journal = self.createJournal('freeform', '\n'.join(addresses), self.settings.searchURL(),
+            maxResults, showDetails)
+        task = FreeFormTask(self.settings, writer, showDetails, self.resultsTextEdit, maxResults, addresses, journal)
+        self.startTask(task)
+
+    def updateWriteBack(self, *args):
+        '''Only point layers can have their geometry set.'''
+        layer = self.addressMapLayerComboBox.currentLayer()
+        isPoint = layer is not None and layer.geometryType() == QgsWkbTypes.PointGeometry
+        self.setGeometryCheckBox.setEnabled(self.writeBackCheckBox.isChecked() and isPoint)
+        if not isPoint:
+            self.setGeometryCheckBox.setChecked(False)
+
+    def createSourceWriter(self, layer, detailedFields):
+        '''Create the writer adding the results to the input layer. Returns
+        None if the layer can not be written to.'''
+        if layer.isEditable():
+            self.iface.messageBar().pushMessage("", "Save or discard the edits of the input layer first", level=Qgis.Warning, duration=6)
+            return None
+        fields = detailedFields if self.detailedAddressCheckBox.checkState() else SIMPLE_FIELDS
+        setGeometry = self.setGeometryCheckBox.isEnabled() and self.setGeometryCheckBox.isChecked()
+        try:
+            return SourceLayerWriter(layer, fields, setGeometry, self.settings.writeBatchSize)
+        except Exception as e:
+            self.iface.messageBar().pushMessage("", "Unable to write to the input layer: {}".format(e), level=Qgis.Warning, duration=6)
+            return None
+
+    def createWriter(self, detailedFields, incremental=False):
+        '''Create the result writer for the output layer or file. Returns None
+        if the output file could not be created.'''
         layername = self.layerLineEdit.text()
-        self.pointLayer = QgsVectorLayer("point?crs=epsg:4326", layername, "memory")
-        self.provider = self.pointLayer.dataProvider()
         if self.detailedAddressCheckBox.checkState():
-            self.provider.addAttributes([
-                QgsField("osm_type", QVariant.String),
-                QgsField("osm_id", QVariant.String),
-                QgsField("class", QVariant.String),
-                QgsField("type", QVariant.String),
-                QgsField("source_addr", QVariant.String),
-                QgsField("display_name", QVariant.String),
-                QgsField("house_number", QVariant.String),
-                QgsField("road", QVariant.String),
-                QgsField("neighbourhood", QVariant.String),
-                QgsField("locality", QVariant.String),
-                QgsField("town", QVariant.String),
-                QgsField("city", QVariant.String),
-                QgsField("county", QVariant.String),
-                QgsField("state", QVariant.String),
-                QgsField("postcode", QVariant.String),
-                QgsField("country", QVariant.String),
-                QgsField("country_code", QVariant.String)])
+            fields = detailedFields
         else:
-            self.provider.addAttributes([QgsField("display_name", QVariant.String)])
-        self.pointLayer.updateFields()
-        if self.showLabelCheckBox.checkState():
-            # Display labels
-            label = QgsPalLayerSettings()
-            label.fieldName = 'display_name'
-            label.placement= QgsPalLayerSettings.AroundPoint
-            labeling = QgsVectorLayerSimpleLabeling(label)
-            self.pointLayer.setLabeling(labeling)
-            self.pointLayer.setLabelsEnabled(True)
-        
+            fields = SIMPLE_FIELDS
+        showLabels = bool(self.showLabelCheckBox.checkState())
+        path = self.outputFileWidget.filePath().strip()
+        if not path:
+            return MemoryResultWriter(layername, fields, showLabels, self.settings.writeBatchSize)
+        try:
+            return OgrResultWriter(path, layername, fields, showLabels, self.settings.writeBatchSize, incremental)
+        except Exception as e:
+            self.iface.messageBar().pushMessage("", "Unable to create the output file: {}".format(e), level=Qgis.Warning, duration=6)
+            return None
+
     def configureLayerFields(self, header):
         self.clearLayerFields()
         self.fullAddressComboBox.addItems(header)
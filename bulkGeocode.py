@@ -0,0 +1,319 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+Command line bulk geocoding of a CSV file or an OGR layer without QGIS.
+Run it from the QGIS plugins directory as a module, for example
+
+    python3 -m bulknominatim.bulkGeocode addresses.csv results.gpkg \\
+        --url https://nominatim.example.com --address-field address
+
+Use --help for all of the options.
+"""
+import os
+import sys
+import csv
+import time
+import argparse
+
+from .endpointPool import STRATEGIES, parseEndpoints
+from .geocodeEngine import (GeocodeConfig, GeocodeEngine, COLUMNS, SIMPLE_FIELDS,
+    FORWARD_FIELDS, REVERSE_FIELDS, DRIVERS, JSON_BACKEND)
+from .gazetteer import Gazetteer
+from .geocodeCache import GeocodeCache
+from .rateLimiter import limiter
+from .runStats import RunStats
+
+
+def readCsv(path):
+    '''Return the header and an iterator of (row number, values) of a CSV file.'''
+    f = open(path, 'r', encoding='utf-8-sig', newline='')
+    reader = csv.reader(f)
+    header = next(reader, [])
+
+    def rows():
+        with f:
+            for rowId, values in enumerate(reader):
+                yield rowId, values + [''] * (len(header) - len(values))
+    return header, rows()
+
+
+def readOgr(path, layerName, withPoints):
+    '''Return the field names and an iterator of (fid, values) of an OGR
+    layer, or (fid, lon, lat) in EPSG:4326 if withPoints.'''
+    from osgeo import ogr, osr
+    datasource = ogr.Open(path)
+    if datasource is None:
+        raise IOError('Unable to open {}'.format(path))
+    layer = datasource.GetLayerByName(layerName) if layerName else datasource.GetLayer(0)
+    if layer is None:
+        raise IOError('Layer {} not found in {}'.format(layerName, path))
+    defn = layer.GetLayerDefn()
+    header = [defn.GetFieldDefn(i).GetName() for i in range(defn.GetFieldCount())]
+    transform = None
+    if withPoints:
+        source = layer.GetSpatialRef()
+        if source is not None:
+            target = osr.SpatialReference()
+            target.ImportFromEPSG(4326)
+            # Keep x as longitude with GDAL 3
+            if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+                source.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+                target.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            transform = osr.CoordinateTransformation(source, target)
+
+    def rows(datasource=datasource):
+        # datasource is held so the layer stays valid while it is read
+        for feature in layer:
+            if not withPoints:
+                yield feature.GetFID(), [feature.GetField(i) for i in range(len(header))]
+                continue
+            geom = feature.GetGeometryRef()
+            if geom is None or geom.IsEmpty():
+                continue
+            geom = geom.Centroid() if geom.GetGeometryType() != ogr.wkbPoint else geom
+            x, y = geom.GetX(), geom.GetY()
+            if transform is not None:
+                x, y = transform.TransformPoint(x, y)[:2]
+            yield feature.GetFID(), x, y
+    return header, rows()
+
+
+def readPoint(values, lonIdx, latIdx):
+    '''Return the lon, lat of a CSV row, or None, None if they are not
+    valid coordinates.'''
+    try:
+        lon = float(values[lonIdx])
+        lat = float(values[latIdx])
+    except (ValueError, IndexError):
+        return None, None
+    if not (-180 <= lon <= 180 and -90 <= lat <= 90):
+        return None, None
+    return lon, lat
+
+
+def columnIndex(header, name):
+    if not name:
+        return -1
+    if name not in header:
+        raise ValueError('Column {} is not in the input'.format(name))
+    return header.index(name)
+
+
+class CsvOutput(object):
+    '''Write results as CSV with lon and lat columns.'''
+
+    def __init__(self, path, fieldNames):
+        self.file = open(path, 'w', encoding='utf-8', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(['lon', 'lat'] + fieldNames)
+
+    def write(self, points):
+        for lon, lat, attributes in points:
+            self.writer.writerow([lon, lat] + attributes)
+
+    def close(self):
+        self.file.close()
+
+
+class OgrOutput(object):
+    '''Write results to a point layer of an OGR file in batched transactions.'''
+
+    def __init__(self, path, fieldNames, batchSize=1000):
+        from osgeo import ogr, osr
+        self.ogr = ogr
+        driverName = DRIVERS.get(os.path.splitext(path)[1].lower(), 'GPKG')
+        driver = ogr.GetDriverByName(driverName)
+        if driver is None:
+            raise IOError('The {} driver is not available'.format(driverName))
+        if os.path.exists(path):
+            driver.DeleteDataSource(path)
+        self.datasource = driver.CreateDataSource(path)
+        if self.datasource is None:
+            raise IOError('Unable to create {}'.format(path))
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(4326)
+        name = os.path.splitext(os.path.basename(path))[0]
+        self.layer = self.datasource.CreateLayer(name, srs, ogr.wkbPoint)
+        for fieldName in fieldNames:
+            self.layer.CreateField(ogr.FieldDefn(fieldName, ogr.OFTString))
+        self.defn = self.layer.GetLayerDefn()
+        self.batchSize = batchSize
+        self.count = 0
+        self.layer.StartTransaction()
+
+    def write(self, points):
+        for lon, lat, attributes in points:
+            geom = self.ogr.Geometry(self.ogr.wkbPoint)
+            geom.AddPoint_2D(lon, lat)
+            out = self.ogr.Feature(self.defn)
+            out.SetGeometry(geom)
+            for i, value in enumerate(attributes):
+                if value:
+                    out.SetField(i, value)
+            self.layer.CreateFeature(out)
+            self.count += 1
+            if self.count % self.batchSize == 0:
+                self.layer.CommitTransaction()
+                self.layer.StartTransaction()
+
+    def close(self):
+        self.layer.CommitTransaction()
+        self.layer = None
+        self.defn = None
+        self.datasource = None
+
+
+def parseArguments(argv):
+    parser = argparse.ArgumentParser(prog='bulkGeocode',
+        description='Bulk geocode a CSV file or OGR layer with a nominatim server.')
+    parser.add_argument('input', help='CSV file or OGR data source to geocode')
+    parser.add_argument('output', help='Output .csv, .gpkg, .sqlite, .shp or .geojson file')
+    parser.add_argument('--url', required=True, help='Nominatim service URL')
+    parser.add_argument('--replica', action='append', nargs='+', metavar=('URL', 'WEIGHT'), default=[],
+        help='Replica of the nominatim server to spread requests across, with an optional weight. '
+        'May be repeated. The --url server is used with a weight of 1 unless it is also listed.')
+    parser.add_argument('--balance', choices=STRATEGIES, default=STRATEGIES[0],
+        help='Spread requests across the servers by weighted round robin or the fewest outstanding requests')
+    parser.add_argument('--reverse', action='store_true', help='Reverse geocode points instead of addresses')
+    parser.add_argument('--lookup', action='store_true',
+        help='Refresh places by OSM type and id with lookup requests of up to 50 ids')
+    parser.add_argument('--osm-type-field', help='OSM type column for --lookup, empty if the ids are like N123')
+    parser.add_argument('--osm-id-field', default='osm_id', help='OSM id column for --lookup')
+    parser.add_argument('--layer', help='Input layer name of a multi-layer data source')
+    parser.add_argument('--address-field', help='Column holding the full address')
+    parser.add_argument('--number-field', help='Street number column')
+    parser.add_argument('--street-field', help='Street name column')
+    parser.add_argument('--city-field', help='City column')
+    parser.add_argument('--county-field', help='County column')
+    parser.add_argument('--state-field', help='State column')
+    parser.add_argument('--country-field', help='Country column')
+    parser.add_argument('--postal-field', help='Postal code column')
+    parser.add_argument('--free-form-query', action='store_true',
+        help='Join the address columns into a single query rather than a structured one')
+    parser.add_argument('--lon-field', help='Longitude column of a CSV input to reverse geocode')
+    parser.add_argument('--lat-field', help='Latitude column of a CSV input to reverse geocode')
+    parser.add_argument('--max-results', type=int, default=1, help='Maximum results per address')
+    parser.add_argument('--details', action='store_true', help='Include detailed address fields')
+    parser.add_argument('--zoom', type=int, default=18, help='Reverse geocoding level of detail')
+    parser.add_argument('--concurrent', type=int, default=4, help='Concurrent requests')
+    parser.add_argument('--rate', type=float, default=0, help='Requests per second, 0 for no limit')
+    parser.add_argument('--retries', type=int, default=5, help='Retries per failed request')
+    parser.add_argument('--timeout', type=float, default=60, help='Request timeout in seconds')
+    parser.add_argument('--cache', help='SQLite file to cache replies in')
+    parser.add_argument('--cache-days', type=int, default=30, help='Days a cached reply is used')
+    parser.add_argument('--gazetteer', help='Local gazetteer to look addresses up in before the server, '
+        'built with python3 -m bulknominatim.gazetteer')
+    parser.add_argument('--offline', action='store_true',
+        help='Report addresses not in the gazetteer as not found instead of querying the server')
+    parser.add_argument('--batch-size', type=int, default=1000, help='Features per write transaction')
+    parser.add_argument('--dedup-size', type=int, default=1000,
+        help='Rows repeating one of this many recent distinct queries share its reply, 0 to send every row')
+    parser.add_argument('--stats', help='Write request timing statistics to this .json or .csv file')
+    parser.add_argument('--quiet', action='store_true', help='Do not report progress')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArguments(argv)
+    cache = None
+    if args.cache:
+        cache = GeocodeCache(args.cache, ttl=args.cache_days*86400)
+    gazetteer = None
+    if args.gazetteer:
+        gazetteer = Gazetteer(args.gazetteer, offlineOnly=args.offline)
+    elif args.offline:
+        raise SystemExit('--offline needs a --gazetteer')
+    limiter.setRate(args.rate)
+    endpoints = parseEndpoints('\n'.join(' '.join(replica) for replica in args.replica))
+    config = GeocodeConfig(args.url, args.max_results, args.details, args.zoom,
+        args.concurrent, args.retries, args.timeout, cache, endpoints=endpoints, balance=args.balance,
+        gazetteer=gazetteer, dedupSize=args.dedup_size)
+    stats = RunStats('reverse' if args.reverse else 'lookup' if args.lookup else 'forward')
+    stats.info = {'input': args.input, 'concurrent_requests': args.concurrent, 'requests_per_second': args.rate,
+        'max_retries': args.retries, 'cache_enabled': cache is not None, 'show_details': args.details,
+        'json_decoder': JSON_BACKEND}
+    engine = GeocodeEngine(config, stats=stats)
+
+    isCsv = os.path.splitext(args.input)[1].lower() in ('.csv', '.txt')
+    if args.reverse:
+        if isCsv:
+            header, rows = readCsv(args.input)
+            lonIdx = columnIndex(header, args.lon_field or 'lon')
+            latIdx = columnIndex(header, args.lat_field or 'lat')
+            points = ((rowId,) + readPoint(values, lonIdx, latIdx) for rowId, values in rows)
+        else:
+            header, points = readOgr(args.input, args.layer, True)
+        results = engine.reverse(points)
+        fieldNames = REVERSE_FIELDS if args.details else SIMPLE_FIELDS
+    elif args.lookup:
+        header, rows = readCsv(args.input) if isCsv else readOgr(args.input, args.layer, False)
+        typeIdx = columnIndex(header, args.osm_type_field)
+        idIdx = columnIndex(header, args.osm_id_field)
+        results = engine.lookup((rowId, values[typeIdx] if typeIdx >= 0 else None, values[idIdx])
+            for rowId, values in rows)
+        fieldNames = FORWARD_FIELDS if args.details else SIMPLE_FIELDS
+    else:
+        header, rows = readCsv(args.input) if isCsv else readOgr(args.input, args.layer, False)
+        columns = {key: columnIndex(header, getattr(args, key+'_field')) for key in COLUMNS[1:]}
+        columns['full'] = columnIndex(header, args.address_field)
+        if columns['full'] < 0 and columns['street'] < 0 and columns['city'] < 0:
+            raise SystemExit('Give --address-field or the address columns to geocode')
+        results = engine.table(rows, columns, args.free_form_query)
+        fieldNames = FORWARD_FIELDS if args.details else SIMPLE_FIELDS
+
+    if os.path.splitext(args.output)[1].lower() == '.csv':
+        output = CsvOutput(args.output, fieldNames)
+    else:
+        output = OgrOutput(args.output, fieldNames, args.batch_size)
+    numRows = 0
+    try:
+        for result in results:
+            numRows += 1
+            stats.rowsDone()
+            if result.error is None:
+                start = time.monotonic()
+                output.write(result.points)
+                stats.add('write', time.monotonic() - start)
+            elif not args.quiet:
+                sys.stderr.write('Failed row {}: {}\n'.format(result.rowId, result.error))
+            if not args.quiet and numRows % 1000 == 0:
+                sys.stderr.write('{} rows processed, {:.1f} rows/s\n'.format(numRows, stats.throughput()))
+    finally:
+        output.close()
+        engine.close()
+        if cache is not None:
+            cache.close()
+        if gazetteer is not None:
+            gazetteer.close()
+    stats.stop()
+    if args.stats:
+        stats.counters = {'errors': engine.numErrors, 'retries': engine.numRetries,
+            'failed_requests': engine.numFailed, 'cache_hits': engine.cacheHits, 'cache_misses': engine.cacheMisses,
+            'gazetteer_hits': engine.gazetteerHits, 'unique_queries': engine.numQueries}
+        stats.export(args.stats)
+    if not args.quiet:
+        sys.stderr.write('Rows processed: {}\n'.format(numRows))
+        sys.stderr.write('Errors: {}\n'.format(engine.numErrors))
+        sys.stderr.write('Retried requests: {}\n'.format(engine.numRetries))
+        sys.stderr.write('Failed requests: {}\n'.format(engine.numFailed))
+        for line in engine.dedupSummary():
+            sys.stderr.write(line + '\n')
+        if engine.cache is not None:
+            sys.stderr.write('Cache hits: {} misses: {}\n'.format(engine.cacheHits, engine.cacheMisses))
+        if engine.gazetteer is not None:
+            sys.stderr.write('Gazetteer hits: {}\n'.format(engine.gazetteerHits))
+        sys.stderr.write('JSON decoder: {}\n'.format(JSON_BACKEND))
+        for line in engine.pool.summary() + engine.session.summary() + stats.summary():
+            sys.stderr.write(line + '\n')
+    return 0 if numRows == 0 or engine.numErrors < numRows else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -9,6 +9,7 @@
  *                                                                         *
  ***************************************************************************/
 """
+from qgis.core import QgsApplication
 from qgis.PyQt.QtCore import QUrl
 from qgis.PyQt.QtGui import QIcon
 from qgis.PyQt.QtWidgets import QAction, QToolButton
@@ -16,6 +17,7 @@ from qgis.PyQt.QtWidgets import QAction, QToolButton
 import os.path
 import webbrowser
 from .bulkDialog import BulkNominatimDialog
+from .nominatimProvider import NominatimProvider
 from .reverseGeocode import ReverseGeocodeTool
 from .settings import SettingsWidget
 
@@ -23,9 +25,17 @@ class BulkNominatim(object):
     def __init__(self, iface):
         self.iface = iface
         self.canvas = iface.mapCanvas()
+        self.provider = None
+
+    def initProcessing(self):
+        '''Add the geocoding algorithms to the Processing toolbox.'''
+        self.provider = NominatimProvider()
+        QgsApplication.processingRegistry().addProvider(self.provider)
 
     def initGui(self):
         """Initialize BulkNominatim GUI."""
+        self.initProcessing()
+
         # Set up a toolbar
         self.toolbar = self.iface.addToolBar('Bulk Nominatim Toolbar')
         self.toolbar.setObjectName('BulkNominatimToolbar')
@@ -85,6 +95,7 @@ class BulkNominatim(object):
         # Remove Toolbar
         del self.toolbar
         self.reverseGeocodeTool.unload()
+        QgsApplication.processingRegistry().removeProvider(self.provider)
     
     def setReverseGeocodeTool(self):
         self.reverseGeocodeAction.setChecked(True)
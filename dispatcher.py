@@ -0,0 +1,295 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import time
+import heapq
+from collections import deque
+
+from qgis.core import QgsNetworkAccessManager
+from qgis.PyQt.QtCore import QObject, QUrl, QEventLoop, QTimer
+from qgis.PyQt.QtNetwork import QNetworkRequest, QNetworkReply
+
+from .endpointPool import pool
+from .rateLimiter import limiter, RETRY_STATUS, backoffDelay, parseRetryAfter
+
+# Network errors that are worth retrying
+RETRY_ERRORS = (QNetworkReply.ConnectionRefusedError, QNetworkReply.RemoteHostClosedError,
+    QNetworkReply.TimeoutError, QNetworkReply.OperationCanceledError,
+    QNetworkReply.TemporaryNetworkFailureError, QNetworkReply.NetworkSessionFailedError,
+    QNetworkReply.ProxyTimeoutError, QNetworkReply.UnknownNetworkError)
+
+# Named HTTP2... before Qt 5.15
+HTTP2_ALLOWED = getattr(QNetworkRequest, 'Http2AllowedAttribute', getattr(QNetworkRequest, 'HTTP2AllowedAttribute', None))
+HTTP2_USED = getattr(QNetworkRequest, 'Http2WasUsedAttribute', getattr(QNetworkRequest, 'HTTP2WasUsedAttribute', None))
+
+
+def nominatimRequest(url):
+    '''Network request for a nominatim url. The requests of a thread share
+    the connections of its QgsNetworkAccessManager, which keeps them alive
+    between requests and negotiates HTTP/2 where the server supports it.
+    Accept-Encoding is left to Qt so it still decompresses gzip replies.'''
+    request = QNetworkRequest(QUrl(url))
+    request.setRawHeader(b'Accept', b'application/json')
+    if HTTP2_ALLOWED is not None:
+        request.setAttribute(HTTP2_ALLOWED, True)
+    return request
+
+
+class RequestDispatcher(QObject):
+    '''Fetch a stream of Nominatim urls keeping up to maxInFlight requests
+    outstanding at once. Replies complete asynchronously but are handed to
+    the callback in the same order the jobs were queued. If a cache is
+    given, cached replies are used instead of going to the network, and
+    searches not in the cache are looked up in gazetteer, if given, before
+    they are sent.
+    isCanceled is an optional callable polled between replies; once it
+    returns True the outstanding requests are aborted and fetchAll returns
+    without delivering the remaining replies.
+
+    Requests are paced by the shared rate limiter. Requests that fail with
+    a transient error (HTTP 429/5xx, timeouts, dropped connections) are put
+    on a retry queue and sent again after an exponential backoff with
+    jitter, or after the delay the server asked for in Retry-After, up to
+    maxRetries times.
+
+    Each request is sent to the server chosen by the shared endpoint pool,
+    so a retry may go to a different replica than the one that failed.
+
+    If stats, a RunStats, is given the time each request waits in the
+    queue and the time it spends on the network are added to it.'''
+
+    # Longest time to sleep before checking for cancelation, in milliseconds
+    MAXWAIT = 1000
+
+    def __init__(self, maxInFlight=4, cache=None, isCanceled=None, maxRetries=5, limiter=limiter, stats=None,
+            pool=pool, gazetteer=None):
+        super(RequestDispatcher, self).__init__()
+        self.maxInFlight = max(1, int(maxInFlight))
+        self.cache = cache if cache is not None and cache.enabled else None
+        self.gazetteer = gazetteer if gazetteer is not None and gazetteer.enabled else None
+        self.isCanceled = isCanceled
+        self.maxRetries = maxRetries
+        self.limiter = limiter
+        self.pool = pool
+        self.stats = stats
+        self.cacheHits = 0
+        self.cacheMisses = 0
+        self.gazetteerHits = 0
+        self.numRetries = 0
+        self.numFailed = 0
+        # Requests sent, TLS handshakes made and replies received over HTTP/2
+        self.numRequests = 0
+        self.numHandshakes = 0
+        self.numHttp2 = 0
+        # Limit how far ahead of the oldest undelivered reply we may get
+        # so a single slow request cannot make the reorder buffer grow.
+        self.window = self.maxInFlight * 4
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.wake)
+
+    def fetchAll(self, jobs, callback):
+        '''jobs is an iterable of (url, context) tuples. For each job
+        callback(context, data) is called in input order where data is the
+        raw reply bytes, or empty if the request failed. A url of None is
+        not requested and is delivered with empty data.'''
+        self.jobs = iter(jobs)
+        self.callback = callback
+        self.exhausted = False
+        self.nextIssue = 0
+        self.nextDeliver = 0
+        self.contexts = {}
+        self.completed = {}
+        self.replies = {}
+        self.urls = {}
+        self.attempts = {}
+        # Endpoint each request in flight was sent to
+        self.endpoints = {}
+        # Time each request was queued or sent
+        self.timestamps = {}
+        # Requests waiting for a rate limiter token
+        self.ready = deque()
+        # Heap of (time, index) of requests waiting to be retried
+        self.retries = []
+        self.evloop = QEventLoop()
+        self.issue()
+        if not self.isDone():
+            self.evloop.exec_(QEventLoop.ExcludeUserInputEvents)
+        self.timer.stop()
+        if self.cache is not None:
+            self.cache.flush()
+
+    def isDone(self):
+        return self.exhausted and self.nextDeliver == self.nextIssue
+
+    def canceled(self):
+        return self.isCanceled is not None and self.isCanceled()
+
+    def abort(self):
+        '''Abort all outstanding requests and drop undelivered replies.'''
+        for reply in self.replies.values():
+            reply.finished.disconnect()
+            reply.abort()
+            reply.deleteLater()
+        for endpoint in self.endpoints.values():
+            self.pool.release(endpoint, True)
+        self.endpoints.clear()
+        self.replies.clear()
+        self.urls.clear()
+        self.timestamps.clear()
+        self.completed.clear()
+        self.contexts.clear()
+        self.ready.clear()
+        self.retries = []
+        self.exhausted = True
+        self.nextDeliver = self.nextIssue
+
+    def schedule(self, delay):
+        '''Call issue() again after delay seconds.'''
+        msec = min(self.MAXWAIT, max(1, int(delay * 1000)))
+        if not self.timer.isActive() or self.timer.remainingTime() > msec:
+            self.timer.start(msec)
+
+    def wake(self):
+        self.issue()
+        if self.isDone():
+            self.evloop.quit()
+
+    def issue(self):
+        while True:
+            cached = False
+            if self.canceled():
+                self.abort()
+                return
+            now = time.monotonic()
+            while self.retries and self.retries[0][0] <= now:
+                self.ready.appendleft(heapq.heappop(self.retries)[1])
+            while len(self.replies) < self.maxInFlight:
+                if not self.ready:
+                    if self.exhausted or self.nextIssue - self.nextDeliver >= self.window:
+                        break
+                    try:
+                        url, context = next(self.jobs)
+                    except StopIteration:
+                        self.exhausted = True
+                        break
+                    index = self.nextIssue
+                    self.nextIssue += 1
+                    self.contexts[index] = context
+                    if url is None:
+                        self.completed[index] = b''
+                        cached = True
+                        continue
+                    if self.cache is not None:
+                        data = self.cache.get(url)
+                        if data is not None:
+                            self.cacheHits += 1
+                            self.completed[index] = data
+                            cached = True
+                            continue
+                        self.cacheMisses += 1
+                    if self.gazetteer is not None:
+                        data = self.gazetteer.get(url)
+                        if data is not None:
+                            self.gazetteerHits += 1
+                            self.completed[index] = data
+                            cached = True
+                            continue
+                    self.urls[index] = url
+                    self.attempts[index] = 0
+                    self.timestamps[index] = time.monotonic()
+                    self.ready.append(index)
+                delay = self.limiter.reserve()
+                if delay > 0:
+                    self.schedule(delay)
+                    break
+                self.send(self.ready.popleft())
+            if not cached:
+                break
+            # Cache hits may have opened up room in the reorder window
+            self.deliver()
+        if self.retries:
+            self.schedule(self.retries[0][0] - time.monotonic())
+
+    def send(self, index):
+        now = time.monotonic()
+        if self.stats is not None:
+            self.stats.add('queue', now - self.timestamps[index])
+        self.timestamps[index] = now
+        # Cache keys stay on the primary server url
+        url, self.endpoints[index] = self.pool.route(self.urls[index])
+        reply = QgsNetworkAccessManager.instance().get(nominatimRequest(url))
+        self.numRequests += 1
+        self.replies[index] = reply
+        reply.finished.connect(lambda index=index: self.replyFinished(index))
+        # Only emitted when a new connection is made
+        reply.encrypted.connect(self.handshake)
+
+    def handshake(self):
+        self.numHandshakes += 1
+
+    def connectionSummary(self):
+        '''Lines describing the connection reuse of the requests.'''
+        if not self.numRequests:
+            return []
+        return ['Connections: {} TLS handshakes for {} requests, {} replies over HTTP/2'.format(
+            self.numHandshakes, self.numRequests, self.numHttp2)]
+
+    def replyFinished(self, index):
+        reply = self.replies.pop(index)
+        error = reply.error()
+        status = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+        now = time.monotonic()
+        if self.stats is not None:
+            self.stats.add('network', now - self.timestamps[index])
+        self.timestamps[index] = now
+        self.pool.release(self.endpoints.pop(index), status not in RETRY_STATUS and error not in RETRY_ERRORS)
+        if HTTP2_USED is not None and reply.attribute(HTTP2_USED):
+            self.numHttp2 += 1
+        if error == QNetworkReply.NoError:
+            self.limiter.succeeded()
+            data = bytes(reply.readAll())
+            url = self.urls.pop(index)
+            del self.attempts[index]
+            del self.timestamps[index]
+            if self.cache is not None:
+                self.cache.put(url, data)
+            self.completed[index] = data
+        elif (status in RETRY_STATUS or error in RETRY_ERRORS) and self.attempts[index] < self.maxRetries:
+            if status in (429, 503):
+                self.limiter.throttled()
+            delay = parseRetryAfter(bytes(reply.rawHeader(b'Retry-After')).decode('latin-1'))
+            if delay is None:
+                delay = backoffDelay(self.attempts[index])
+            self.attempts[index] += 1
+            self.numRetries += 1
+            heapq.heappush(self.retries, (now + delay, index))
+        else:
+            self.numFailed += 1
+            del self.urls[index]
+            del self.attempts[index]
+            del self.timestamps[index]
+            self.completed[index] = b''
+        reply.deleteLater()
+        if self.canceled():
+            self.abort()
+        else:
+            self.deliver()
+            self.issue()
+        if self.isDone():
+            self.evloop.quit()
+
+    def deliver(self):
+        '''Hand any replies that are now in order to the callback.'''
+        while self.nextDeliver in self.completed:
+            data = self.completed.pop(self.nextDeliver)
+            context = self.contexts.pop(self.nextDeliver)
+            self.nextDeliver += 1
+            self.callback(context, data)
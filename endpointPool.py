@@ -0,0 +1,192 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import time
+import threading
+from urllib.parse import urlsplit
+
+# Ways of choosing the server of each request
+ROUND_ROBIN = 'roundrobin'
+LEAST_OUTSTANDING = 'least'
+STRATEGIES = (ROUND_ROBIN, LEAST_OUTSTANDING)
+
+
+def parseEndpoints(text):
+    '''Parse a list of servers, one per line, each a URL optionally followed
+    by a weight. Returns a list of (url, weight). Lines starting with # are
+    ignored.'''
+    endpoints = []
+    for line in (text or '').splitlines():
+        parts = line.split()
+        if not parts or parts[0].startswith('#'):
+            continue
+        weight = 1.0
+        if len(parts) > 1:
+            try:
+                weight = float(parts[1])
+            except ValueError:
+                pass
+        if weight > 0:
+            endpoints.append((parts[0].rstrip('/'), weight))
+    return endpoints
+
+
+def serverOf(url):
+    '''Return the scheme, host, port and path without a trailing slash of
+    a url, with the scheme and host in lower case and the default port of
+    the scheme filled in.'''
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    if port is None:
+        port = {'http': 80, 'https': 443}.get(scheme)
+    return scheme, (parts.hostname or '').lower(), port, parts.path.rstrip('/')
+
+
+class Endpoint(object):
+    '''A nominatim server and its health.'''
+
+    def __init__(self, url, weight=1.0):
+        self.url = url
+        self.weight = weight
+        self.outstanding = 0
+        # Smooth weighted round robin counter
+        self.current = 0.0
+        # Consecutive failures and when an ejected server may be used again
+        self.failures = 0
+        self.ejectedUntil = 0.0
+        self.ejectSeconds = 0.0
+        self.numRequests = 0
+        self.numFailed = 0
+        self.numEjected = 0
+
+
+class EndpointPool(object):
+    '''Spread requests across replicas of a nominatim server. Urls are built
+    against the primary server, so cache and journal keys do not depend on
+    which replica answered, and route() rewrites each one to the replica
+    chosen for it by weighted round robin or by the fewest outstanding
+    requests per unit of weight. A replica failing EJECT_FAILURES requests
+    in a row is left out for EJECT_SECONDS, doubling on each ejection up to
+    MAX_EJECT_SECONDS, then tried again. If every replica is ejected the
+    one due back first is used. The pool may be used from several
+    threads.'''
+
+    EJECT_FAILURES = 3
+    EJECT_SECONDS = 30.0
+    MAX_EJECT_SECONDS = 300.0
+
+    def __init__(self, primary='', endpoints=(), strategy=ROUND_ROBIN):
+        self.lock = threading.Lock()
+        self.configure(primary, endpoints, strategy)
+
+    def configure(self, primary, endpoints=(), strategy=ROUND_ROBIN):
+        '''primary is the server urls are built with and endpoints a list of
+        (url, weight) of the replicas. The primary is also used with a
+        weight of 1 unless it is listed in endpoints.'''
+        primary = primary.strip().rstrip('/')
+        weights = {}
+        for url, weight in endpoints:
+            weights[url.rstrip('/')] = weight
+        if primary not in weights:
+            weights = dict([(primary, 1.0)] + list(weights.items()))
+        with self.lock:
+            self.primary = primary
+            self.server = serverOf(primary)
+            self.strategy = strategy if strategy in STRATEGIES else ROUND_ROBIN
+            self.endpoints = [Endpoint(url, weight) for url, weight in weights.items()]
+            self.totalWeight = sum(e.weight for e in self.endpoints)
+
+    def route(self, url):
+        '''Choose the server for a request. Returns the url to send and the
+        Endpoint to pass to release() afterwards, or None if the url is not
+        on the primary server and is sent unchanged. The scheme, host and
+        port of the url must be those of the primary and its path must be
+        within the path of the primary.'''
+        scheme, host, port, path = self.server
+        parts = urlsplit(url)
+        if not host or serverOf(url)[:3] != (scheme, host, port):
+            return url, None
+        if parts.path != path and not parts.path.startswith(path + '/'):
+            return url, None
+        rest = parts.path[len(path):]
+        if parts.query:
+            rest += '?' + parts.query
+        with self.lock:
+            endpoint = self.choose()
+            endpoint.outstanding += 1
+            endpoint.numRequests += 1
+        return endpoint.url + rest, endpoint
+
+    def choose(self):
+        if len(self.endpoints) == 1:
+            return self.endpoints[0]
+        now = time.monotonic()
+        healthy = [e for e in self.endpoints if e.ejectedUntil <= now]
+        if not healthy:
+            return min(self.endpoints, key=lambda e: e.ejectedUntil)
+        if self.strategy == LEAST_OUTSTANDING:
+            return min(healthy, key=lambda e: ((e.outstanding + 1) / e.weight, -e.weight))
+        # Smooth weighted round robin spreads the requests of a heavy
+        # server evenly instead of sending them in bursts.
+        total = 0.0
+        best = None
+        for e in healthy:
+            e.current += e.weight
+            total += e.weight
+            if best is None or e.current > best.current:
+                best = e
+        best.current -= total
+        return best
+
+    def release(self, endpoint, ok):
+        '''Record the outcome of a request. ok is False if the server failed
+        to answer or answered that it is overloaded or broken.'''
+        if endpoint is None:
+            return
+        with self.lock:
+            endpoint.outstanding = max(0, endpoint.outstanding - 1)
+            if ok:
+                endpoint.failures = 0
+                endpoint.ejectSeconds = 0.0
+                return
+            endpoint.numFailed += 1
+            endpoint.failures += 1
+            if endpoint.failures >= self.EJECT_FAILURES and len(self.endpoints) > 1:
+                endpoint.ejectSeconds = min(self.MAX_EJECT_SECONDS,
+                    endpoint.ejectSeconds * 2 if endpoint.ejectSeconds else self.EJECT_SECONDS)
+                endpoint.ejectedUntil = time.monotonic() + endpoint.ejectSeconds
+                endpoint.numEjected += 1
+                endpoint.failures = 0
+
+    def counts(self):
+        '''Snapshot of the request counters of each server.'''
+        with self.lock:
+            return {e.url: (e.numRequests, e.numFailed, e.numEjected) for e in self.endpoints}
+
+    def summary(self, since=None):
+        '''Lines describing the use of each server since a counts()
+        snapshot, or nothing if there is only one server.'''
+        if len(self.endpoints) < 2:
+            return []
+        since = since or {}
+        lines = []
+        for url, (requests, failed, ejected) in self.counts().items():
+            r, f, e = since.get(url, (0, 0, 0))
+            lines.append('Server {}: {} requests, {} failed, ejected {} times'.format(
+                url, requests - r, failed - f, ejected - e))
+        return lines
+
+
+# Servers shared by every request made by the plugin
+pool = EndpointPool()
@@ -0,0 +1,367 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+Local gazetteer answering nominatim search queries without the network.
+It can be built from the command line, for example
+
+    python3 -m bulknominatim.gazetteer gazetteer.sqlite --extract addresses.csv \\
+        --cache ~/.local/share/QGIS/QGIS3/profiles/default/bulknominatim/cache.sqlite
+
+Use --help for all of the options.
+"""
+import os
+import re
+import sys
+import csv
+import json
+import sqlite3
+import argparse
+import threading
+from urllib.parse import urlsplit, parse_qsl
+
+from .geocodeEngine import ADDRESS_FIELDS, loadReply
+
+# Search parameters joined, in this order, into the text of a structured query
+QUERY_PARAMS = ('street', 'city', 'county', 'state', 'country', 'postalcode')
+# Column names of address extracts mapped to nominatim place keys
+EXTRACT_COLUMNS = {
+    'lon': 'lon', 'longitude': 'lon', 'x': 'lon',
+    'lat': 'lat', 'latitude': 'lat', 'y': 'lat',
+    'number': 'house_number', 'housenumber': 'house_number', 'street': 'road',
+    'district': 'county', 'region': 'state', 'postalcode': 'postcode', 'zip': 'postcode'}
+EXTRACT_COLUMNS.update((name, name) for name in ADDRESS_FIELDS)
+EXTRACT_COLUMNS.update((name, name) for name in ('osm_type', 'osm_id', 'class', 'type', 'display_name'))
+# Address parts joined into the display name of an extract row without one
+DISPLAY_FIELDS = ('house_number', 'road', 'neighbourhood', 'locality', 'town', 'city',
+    'county', 'state', 'postcode', 'country')
+
+TOKEN_SPLIT = re.compile(r'[\W_]+')
+
+
+def normalize(text):
+    '''Lower case words of text separated by single spaces.'''
+    return ' '.join(TOKEN_SPLIT.split(text.casefold())).strip()
+
+
+def queryText(url):
+    '''Return the address text of a nominatim search url, the maximum
+    number of results and whether address details are asked for, or None
+    if url is not a search.'''
+    parts = urlsplit(url)
+    if not parts.path.rstrip('/').endswith(('/search', '/search.php')):
+        return None
+    params = dict(parse_qsl(parts.query))
+    if 'q' in params:
+        text = params['q']
+    else:
+        text = ' '.join(params[name] for name in QUERY_PARAMS if params.get(name))
+    try:
+        limit = max(1, int(params.get('limit', 1)))
+    except ValueError:
+        limit = 1
+    return normalize(text), limit, params.get('addressdetails', '0') == '1'
+
+
+class Gazetteer(object):
+    '''SQLite index of geocoded places used to answer search queries
+    before they are sent to the server. Places are imported from address
+    extracts or from the search replies of the reply cache. A query is
+    answered from the exact normalized query text a place was imported
+    with or, failing that, by a full text search requiring every word of
+    the query if it finds a single best place. Ambiguous queries, such as
+    a bare street name found in several towns, are left to the server. A
+    place with a house number is only returned for a query with that
+    number, so a query for a street is not answered by one of its houses.
+    get() returns a reply in the format of the server so the rest of the
+    plugin is unchanged.
+
+    If offlineOnly is set, queries that are not found or are ambiguous are
+    answered as having no result instead of being sent to the server.'''
+
+    # Places imported between commits
+    WRITEBATCH = 5000
+    # Most full text matches considered for a query
+    CANDIDATES = 64
+
+    def __init__(self, path, enabled=True, offlineOnly=False):
+        self.path = path
+        self.local = threading.local()
+        self.configure(enabled, offlineOnly)
+
+    def configure(self, enabled, offlineOnly=False):
+        self.enabled = enabled
+        self.offlineOnly = offlineOnly
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def connection(self):
+        '''SQLite connections cannot be shared across threads so each thread
+        gets its own.'''
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            dirname = os.path.dirname(self.path)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS places (id INTEGER PRIMARY KEY, key TEXT UNIQUE, '
+                'house TEXT, details INTEGER, data TEXT)')
+            conn.execute('CREATE TABLE IF NOT EXISTS queries (query TEXT PRIMARY KEY, ids TEXT)')
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS places_fts USING fts5(text, place UNINDEXED, "
+                "tokenize='unicode61 remove_diacritics 2')")
+            conn.commit()
+            self.local.conn = conn
+        return conn
+
+    def get(self, url):
+        '''Return the search reply for url as bytes or None if it is not a
+        search or no place matches it.'''
+        if not self.enabled:
+            return None
+        query = queryText(url)
+        if query is None:
+            return None
+        text, limit, details = query
+        if not text:
+            return None
+        conn = self.connection()
+        row = conn.execute('SELECT ids FROM queries WHERE query=?', (text,)).fetchone()
+        if row is not None:
+            places = self.places(conn, [int(i) for i in row[0].split(',')][:limit], details)
+        else:
+            places = self.search(conn, text, limit, details)
+        if not places:
+            return b'[]' if self.offlineOnly else None
+        return ('[' + ','.join(places) + ']').encode('utf-8')
+
+    def places(self, conn, ids, details):
+        rows = dict((row[0], row[1:]) for row in conn.execute('SELECT id, details, data FROM places WHERE id IN ({})'.format(
+            ','.join('?' * len(ids))), ids))
+        places = []
+        for i in ids:
+            if i not in rows or (details and not rows[i][0]):
+                # Without address details the place cannot answer this query
+                return []
+            places.append(rows[i][1])
+        return places
+
+    def search(self, conn, text, limit, details):
+        '''Return the place matching every word of text if the match is
+        unambiguous, otherwise an empty list so the server is asked. A
+        match is unambiguous if it is the only place found, or the only one
+        without words beyond those of the query. Places that match but
+        cannot answer the query, such as houses of a street searched for
+        without a number, still count as competing matches.'''
+        words = text.split()
+        queryWords = set(words)
+        numbers = set(w for w in words if w[0].isdigit())
+        match = ' '.join('"{}"'.format(w.replace('"', '')) for w in words)
+        # Ranking every match with bm25 costs milliseconds for common words
+        # so the matches are compared here by the number of words they have
+        # beyond the query instead.
+        candidates = {}
+        numRows = 0
+        cursor = conn.execute('SELECT f.text, p.id, p.house, p.details, p.data FROM places_fts f '
+            'JOIN places p ON p.id=f.place WHERE places_fts MATCH ? LIMIT ?', (match, self.CANDIDATES))
+        for indexed, placeId, house, hasDetails, data in cursor:
+            numRows += 1
+            if (house and normalize(house) not in numbers) or (details and not hasDetails):
+                data = None
+            extra = len(set(normalize(indexed).split()) - queryWords)
+            if placeId not in candidates or extra < candidates[placeId][0]:
+                candidates[placeId] = (extra, data)
+        if numRows >= self.CANDIDATES or not candidates:
+            # Too common to tell the matches apart from a subset of them
+            return []
+        ranked = sorted(candidates.values(), key=lambda c: c[0])
+        if ranked[0][1] is None:
+            return []
+        if len(ranked) == 1 or (ranked[0][0] == 0 and ranked[1][0] > 0):
+            return [ranked[0][1]]
+        return []
+
+    def addPlace(self, conn, place, query=''):
+        '''Add a decoded nominatim place and the query text it answers.
+        Returns the place id.'''
+        address = place.get('address') or {}
+        if place.get('osm_type') and place.get('osm_id'):
+            key = '{}{}'.format(str(place['osm_type'])[:1].upper(), place['osm_id'])
+        else:
+            key = '{} {} {}'.format(place['lat'], place['lon'], normalize(place.get('display_name', '')))
+        details = int(bool(address))
+        data = json.dumps(place, ensure_ascii=False, separators=(',', ':'))
+        row = conn.execute('SELECT id, details FROM places WHERE key=?', (key,)).fetchone()
+        if row is None:
+            placeId = conn.execute('INSERT INTO places (key, house, details, data) VALUES (?,?,?,?)',
+                (key, str(address.get('house_number', '')), details, data)).lastrowid
+            text = ' '.join([str(place.get('display_name', ''))] + [str(v) for v in address.values()])
+            conn.execute('INSERT INTO places_fts (text, place) VALUES (?,?)', (text, placeId))
+        else:
+            placeId = row[0]
+            if details and not row[1]:
+                conn.execute('UPDATE places SET details=1, data=? WHERE id=?', (data, placeId))
+        if query:
+            # Index the query as another name of the place
+            conn.execute('INSERT INTO places_fts (text, place) VALUES (?,?)', (query, placeId))
+        return placeId
+
+    def importReplies(self, items, progress=None):
+        '''Import (url, reply) pairs of nominatim search replies, such as
+        GeocodeCache.entries(). Other requests are skipped. Returns the
+        number of queries imported.'''
+        conn = self.connection()
+        count = 0
+        for url, data in items:
+            query = queryText(url)
+            if query is None or not query[0] or not data:
+                continue
+            try:
+                places = loadReply(data)
+                ids = [self.addPlace(conn, place, query[0]) for place in places
+                    if 'lat' in place and 'lon' in place]
+            except (ValueError, TypeError, AttributeError):
+                continue
+            if not ids:
+                continue
+            conn.execute('INSERT OR REPLACE INTO queries (query, ids) VALUES (?,?)',
+                (query[0], ','.join(str(i) for i in ids)))
+            count += 1
+            if count % self.WRITEBATCH == 0:
+                conn.commit()
+                if progress is not None:
+                    progress(count)
+        conn.commit()
+        return count
+
+    def importPlaces(self, places, progress=None):
+        '''Import an iterable of decoded nominatim places with lat and lon.
+        Returns the number of places imported.'''
+        conn = self.connection()
+        count = 0
+        for place in places:
+            self.addPlace(conn, place)
+            count += 1
+            if count % self.WRITEBATCH == 0:
+                conn.commit()
+                if progress is not None:
+                    progress(count)
+        conn.commit()
+        return count
+
+    def importFile(self, path, progress=None):
+        '''Import an address extract. A .csv or .tsv file has lon and lat
+        columns and any of the nominatim address fields, or the OpenAddresses
+        names of them. Any other file holds nominatim places as JSON, one
+        per line or as a list. Returns the number of places imported.'''
+        ext = os.path.splitext(path)[1].lower()
+        if ext in ('.csv', '.tsv', '.txt'):
+            return self.importPlaces(readExtract(path, '\t' if ext == '.tsv' else ','), progress)
+        return self.importPlaces(readPlaces(path), progress)
+
+    def count(self):
+        '''Number of places and of queries in the gazetteer.'''
+        if not self.exists():
+            return 0, 0
+        conn = self.connection()
+        return (conn.execute('SELECT COUNT(*) FROM places').fetchone()[0],
+            conn.execute('SELECT COUNT(*) FROM queries').fetchone()[0])
+
+    def clear(self):
+        conn = self.connection()
+        conn.execute('DELETE FROM places')
+        conn.execute('DELETE FROM queries')
+        conn.execute('DELETE FROM places_fts')
+        conn.commit()
+        conn.execute('VACUUM')
+
+    def close(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.commit()
+            conn.close()
+            self.local.conn = None
+
+
+def readExtract(path, delimiter=','):
+    '''Generate the nominatim places of the rows of a CSV address extract.'''
+    with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+        reader = csv.reader(f, delimiter=delimiter)
+        header = [EXTRACT_COLUMNS.get(name.strip().lower()) for name in next(reader, [])]
+        if 'lon' not in header or 'lat' not in header:
+            raise ValueError('{} has no lon and lat columns'.format(path))
+        for values in reader:
+            row = dict((key, value.strip()) for key, value in zip(header, values) if key and value.strip())
+            try:
+                place = {'lat': str(float(row.pop('lat'))), 'lon': str(float(row.pop('lon')))}
+            except (KeyError, ValueError):
+                continue
+            address = dict((name, row[name]) for name in ADDRESS_FIELDS if name in row)
+            for name in ('osm_type', 'osm_id', 'class', 'type'):
+                if name in row:
+                    place[name] = row[name]
+            place['display_name'] = row.get('display_name') or ', '.join(
+                address[name] for name in DISPLAY_FIELDS if name in address)
+            if address:
+                place['address'] = address
+            yield place
+
+
+def readPlaces(path):
+    '''Generate the places of a file of nominatim places as JSON lines or a
+    JSON list.'''
+    with open(path, 'rb') as f:
+        first = f.read(1)
+        while first.isspace():
+            first = f.read(1)
+        f.seek(0)
+        if first == b'[':
+            places = loadReply(f.read())
+        else:
+            places = (loadReply(line) for line in f if line.strip())
+        for place in places:
+            if isinstance(place, list):
+                for p in place:
+                    yield p
+            elif 'lat' in place and 'lon' in place:
+                yield place
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='gazetteer', description='Build a local gazetteer for offline geocoding.')
+    parser.add_argument('gazetteer', help='SQLite gazetteer file, created if needed')
+    parser.add_argument('--extract', action='append', default=[],
+        help='CSV address extract or JSON lines of nominatim places to import')
+    parser.add_argument('--cache', action='append', default=[], help='Reply cache file to import the searches of')
+    parser.add_argument('--clear', action='store_true', help='Empty the gazetteer first')
+    args = parser.parse_args(argv)
+
+    from .geocodeCache import GeocodeCache
+    gazetteer = Gazetteer(args.gazetteer)
+    try:
+        if args.clear:
+            gazetteer.clear()
+        for path in args.extract:
+            sys.stderr.write('{}: {} places imported\n'.format(path, gazetteer.importFile(path)))
+        for path in args.cache:
+            cache = GeocodeCache(path)
+            try:
+                sys.stderr.write('{}: {} queries imported\n'.format(path, gazetteer.importReplies(cache.entries())))
+            finally:
+                cache.close()
+        sys.stderr.write('Gazetteer: {} places, {} queries\n'.format(*gazetteer.count()))
+    finally:
+        gazetteer.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,143 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import os
+import time
+import sqlite3
+import threading
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+
+class GeocodeCache(object):
+    '''Persistent SQLite cache of raw Nominatim replies. Entries are keyed
+    on the normalized request url so the server and every query parameter
+    take part in the key. Entries expire after ttl seconds and the least
+    recently used ones are evicted once maxEntries is exceeded.'''
+
+    # Number of writes between commits and eviction checks
+    WRITEBATCH = 200
+
+    def __init__(self, path, enabled=True, ttl=30*86400, maxEntries=500000, precision=5):
+        self.path = path
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.configure(enabled, ttl, maxEntries, precision)
+
+    def configure(self, enabled, ttl, maxEntries, precision):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.maxEntries = maxEntries
+        # Number of decimal places lat/lon are rounded to in the key
+        self.precision = precision
+
+    def connection(self):
+        '''SQLite connections cannot be shared across threads so each thread
+        gets its own.'''
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            dirname = os.path.dirname(self.path)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, data TEXT, created REAL, accessed REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)')
+            conn.commit()
+            self.local.conn = conn
+            self.local.writes = 0
+            # Approximate entry count so eviction only runs when needed
+            self.local.count = conn.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+        return conn
+
+    def key(self, url):
+        '''Normalize a request url. Query parameters are sorted and reverse
+        geocoding coordinates are rounded so nearby points share an entry.'''
+        parts = urlsplit(url)
+        params = []
+        for name, value in parse_qsl(parts.query, keep_blank_values=True):
+            if name in ('lat', 'lon'):
+                try:
+                    value = '{:.{}f}'.format(float(value), self.precision)
+                except ValueError:
+                    pass
+            params.append((name, value))
+        params.sort()
+        return '{}://{}{}?{}'.format(parts.scheme, parts.netloc.lower(), parts.path, urlencode(params))
+
+    def get(self, url):
+        '''Return the cached reply text for url or None.'''
+        if not self.enabled:
+            return None
+        conn = self.connection()
+        key = self.key(url)
+        now = time.time()
+        row = conn.execute('SELECT data, created FROM cache WHERE key=?', (key,)).fetchone()
+        if row is None:
+            return None
+        if now - row[1] > self.ttl:
+            conn.execute('DELETE FROM cache WHERE key=?', (key,))
+            self.written()
+            return None
+        conn.execute('UPDATE cache SET accessed=? WHERE key=?', (now, key))
+        self.written()
+        return row[0]
+
+    def put(self, url, data):
+        if not self.enabled or not data:
+            return
+        conn = self.connection()
+        now = time.time()
+        conn.execute('INSERT OR REPLACE INTO cache (key, data, created, accessed) VALUES (?,?,?,?)',
+            (self.key(url), data, now, now))
+        self.local.count += 1
+        self.written()
+
+    def entries(self):
+        '''Generate the (url, reply) of every entry that has not expired.'''
+        conn = self.connection()
+        cursor = conn.execute('SELECT key, data FROM cache WHERE created>=?', (time.time() - self.ttl,))
+        for row in cursor:
+            yield row
+
+    def written(self):
+        self.local.writes += 1
+        if self.local.writes >= self.WRITEBATCH:
+            self.flush()
+
+    def flush(self):
+        '''Commit pending writes and evict the least recently used entries
+        beyond maxEntries.'''
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            return
+        with self.lock:
+            if self.local.count > self.maxEntries:
+                conn.execute('DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+                    (self.maxEntries,))
+                self.local.count = conn.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+            conn.commit()
+        self.local.writes = 0
+
+    def clear(self):
+        conn = self.connection()
+        with self.lock:
+            conn.execute('DELETE FROM cache')
+            conn.commit()
+        conn.execute('VACUUM')
+        self.local.writes = 0
+        self.local.count = 0
+
+    def close(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            self.flush()
+            conn.close()
+            self.local.conn = None
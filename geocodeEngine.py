@@ -0,0 +1,572 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import re
+import json
+import time
+import hashlib
+from collections import deque, namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPException
+from urllib.parse import quote_plus
+
+from .endpointPool import EndpointPool, ROUND_ROBIN
+from .httpSession import HttpSession
+from .rateLimiter import limiter, RETRY_STATUS, backoffDelay, parseRetryAfter
+
+# Use a faster JSON decoder when one is installed
+try:
+    import orjson
+    loadJson = orjson.loads
+    JSON_BACKEND = 'orjson'
+except ImportError:
+    try:
+        import ujson
+        loadJson = ujson.loads
+        JSON_BACKEND = 'ujson'
+    except ImportError:
+        loadJson = json.loads
+        JSON_BACKEND = 'json'
+
+# Query building, request and parsing logic of the geocoding tools. Nothing
+# here depends on QGIS or Qt so it can be scripted and run on headless nodes.
+
+NOMURL = 'https://nominatim.openstreetmap.org'
+
+# Output fields of the geocoding results
+SIMPLE_FIELDS = ['display_name']
+FORWARD_FIELDS = ['osm_type', 'osm_id', 'class', 'type', 'source_addr', 'display_name',
+    'house_number', 'road', 'neighbourhood', 'locality', 'town', 'city', 'county', 'state',
+    'postcode', 'country', 'country_code']
+REVERSE_FIELDS = ['osm_type', 'osm_id', 'display_name',
+    'house_number', 'road', 'neighbourhood', 'locality', 'town', 'city', 'county', 'state',
+    'postcode', 'country', 'country_code']
+# Fields of the nominatim address details in output order
+ADDRESS_FIELDS = ['house_number', 'road', 'neighbourhood', 'locality', 'town', 'city',
+    'county', 'state', 'postcode', 'country', 'country_code']
+
+# OGR driver used for each output file extension
+DRIVERS = {
+    '.gpkg': 'GPKG',
+    '.sqlite': 'SQLite',
+    '.shp': 'ESRI Shapefile',
+    '.geojson': 'GeoJSON',
+    '.json': 'GeoJSON'}
+
+# Keys of the address table column mapping
+COLUMNS = ('full', 'number', 'street', 'city', 'county', 'state', 'country', 'postal')
+# Structured search parameter of each address column after the street
+STRUCTURED_PARAMS = (('city', 'city'), ('county', 'county'), ('state', 'state'),
+    ('country', 'country'), ('postal', 'postalcode'))
+
+WHITESPACE = re.compile(r'\s+')
+
+# Most OSM ids nominatim accepts in one lookup request
+LOOKUP_BATCH = 50
+# Single letter OSM type used by the lookup request
+OSM_TYPES = {'n': 'N', 'node': 'N', 'w': 'W', 'way': 'W', 'r': 'R', 'relation': 'R'}
+
+# Output of one source row. points is a list of (lon, lat, attributes) and
+# error is a message or None.
+GeocodeResult = namedtuple('GeocodeResult', ['rowId', 'source', 'points', 'error'])
+
+
+def fieldMap(fields):
+    '''Compile a list of output field names into the (in address details,
+    key) pairs read by mapFields. The source_addr field has a key of None.'''
+    return tuple((name in ADDRESS_FIELDS, None if name == 'source_addr' else name) for name in fields)
+
+
+def mapFields(place, fields, source=''):
+    '''Return the attribute list of a decoded nominatim place in a single
+    pass over a compiled field map. Missing values are empty strings.'''
+    details = place.get('address') or {}
+    attributes = []
+    append = attributes.append
+    for inAddress, key in fields:
+        if key is None:
+            append(source)
+            continue
+        value = details.get(key) if inAddress else place.get(key)
+        if value is None:
+            append('')
+        elif value.__class__ is str:
+            append(value)
+        else:
+            append(str(value))
+    return attributes
+
+
+def loadReply(data):
+    '''Decode a JSON reply given as raw bytes or text.'''
+    if loadJson is json.loads and isinstance(data, bytes):
+        # The standard decoder is faster on text than on bytes
+        data = data.decode('utf-8', errors='replace')
+    try:
+        return loadJson(data)
+    except ValueError:
+        if isinstance(data, bytes):
+            # The faster decoders reject invalid UTF-8
+            return json.loads(data.decode('utf-8', errors='replace'))
+        raise
+
+
+def cleanValue(value):
+    '''Convert a column value to a single line string.'''
+    if not value:
+        return ''
+    return WHITESPACE.sub(' ', '{}'.format(value).strip())
+
+
+def forwardOptions(maxResults, showDetails):
+    return '&format=json&limit={}&polygon=0&addressdetails={}'.format(maxResults, int(showDetails))
+
+
+def freeFormQuery(searchURL, address):
+    '''Return the search url of a free-form address string without options.'''
+    return '{}?q={}'.format(searchURL, quote_plus(WHITESPACE.sub(' ', address)))
+
+
+class QueryTemplate(object):
+    '''Search query of the rows of an address table. columns maps each key
+    of COLUMNS to a column index or -1 if unused. The mapping is compiled
+    once so calling the template with the list of column values of a row
+    only builds that row's query. Returns the search url, ending in
+    options, and the source address of the row.'''
+
+    def __init__(self, searchURL, columns, useFreeFormQuery=False, options=''):
+        self.searchURL = searchURL
+        self.options = options
+        self.full = columns['full']
+        self.number = columns['number']
+        self.street = columns['street']
+        self.indexes = tuple(columns[key] for key, tag in STRUCTURED_PARAMS if columns[key] >= 0)
+        self.params = tuple((columns[key], tag + '=') for key, tag in STRUCTURED_PARAMS if columns[key] >= 0)
+        if self.full >= 0:
+            self.build = self.fullQuery
+        elif useFreeFormQuery:
+            self.build = self.freeFormQuery
+        else:
+            self.build = self.structuredQuery
+
+    def __call__(self, attributes):
+        return self.build(attributes)
+
+    def fieldIndexes(self):
+        '''Column indexes the queries are built from, or None if they use
+        every column.'''
+        if self.build == self.structuredQuery:
+            # The source address is the whole row
+            return None
+        if self.full >= 0:
+            return [self.full]
+        return [i for i in (self.number, self.street) + self.indexes if i >= 0]
+
+    def streetOf(self, attributes):
+        if self.street < 0:
+            return ''
+        num = ''
+        if self.number >= 0 and attributes[self.number]:
+            num = '{}'.format(attributes[self.number]).strip()
+        name = '{}'.format(attributes[self.street]).strip() if attributes[self.street] else ''
+        return (num + ' ' + name).strip()
+
+    def fullQuery(self, attributes):
+        address = '{}'.format(attributes[self.full] or '').strip()
+        return freeFormQuery(self.searchURL, address) + self.options, address
+
+    def freeFormQuery(self, attributes):
+        street = self.streetOf(attributes)
+        strs = [street] if street else []
+        for index in self.indexes:
+            value = attributes[index]
+            s = '{}'.format(value).strip() if value else ''
+            if s:
+                strs.append(s)
+        address = ', '.join(strs)
+        return self.searchURL + '?q=' + quote_plus(address) + self.options, address
+
+    def structuredQuery(self, attributes):
+        address = ','.join([str(x) if x else '' for x in attributes])
+        street = self.streetOf(attributes)
+        params = ['street=' + quote_plus(cleanValue(street))] if street else []
+        for index, tag in self.params:
+            params.append(tag + quote_plus(cleanValue(attributes[index])))
+        return self.searchURL + '?' + '&'.join(params) + self.options, address
+
+
+def queryHash(url):
+    '''Hash of a query url identifying the address and options it was built
+    from, so rows whose query has not changed can be recognized.'''
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+
+def reverseQuery(reverseURL, lat, lon, showDetails, zoom=18):
+    return '{}?format=json&lat={}&lon={}&zoom={}&addressdetails={}'.format(
+        reverseURL, lat, lon, zoom, int(showDetails))
+
+
+def osmKey(osmType, osmId):
+    '''Return the lookup key of an OSM object such as N123 or None if it is
+    not valid. If osmType is empty osmId may already be a key.'''
+    ident = '{}'.format(osmId).strip() if osmId is not None else ''
+    if re.match(r'^\d+\.0*$', ident):
+        # Ids read from a numeric field
+        ident = ident.split('.')[0]
+    osmType = '{}'.format(osmType).strip().lower() if osmType is not None else ''
+    if not osmType and ident[:1].lower() in OSM_TYPES:
+        osmType, ident = ident[:1].lower(), ident[1:]
+    if osmType not in OSM_TYPES or not ident.isdigit():
+        return None
+    return OSM_TYPES[osmType] + ident
+
+
+def lookupQuery(lookupURL, keys, showDetails):
+    return '{}?format=json&osm_ids={}&addressdetails={}'.format(lookupURL, ','.join(keys), int(showDetails))
+
+
+def lookupBatches(lookupURL, rows, showDetails):
+    '''Group an iterator of (row id, key) into lookup requests of up to
+    LOOKUP_BATCH distinct keys. Yields (url, list of (row id, key)).'''
+    batch = []
+    keys = {}
+    for rowId, key in rows:
+        batch.append((rowId, key))
+        if key is not None:
+            keys[key] = True
+            if len(keys) >= LOOKUP_BATCH:
+                yield lookupQuery(lookupURL, keys, showDetails), batch
+                batch = []
+                keys = {}
+    if keys:
+        yield lookupQuery(lookupURL, keys, showDetails), batch
+    elif batch:
+        # Only invalid keys are left so there is nothing to request
+        yield None, batch
+
+
+def lookupResults(batch, data, showDetails):
+    '''Match the places of a lookup reply to the rows of its batch. Yields
+    (row id, key, points, error) where points is None on error.'''
+    if not data:
+        for rowId, key in batch:
+            yield rowId, key, None, 'Lookup request failed' if key is not None else 'Invalid OSM type or id'
+        return
+    places = {}
+    try:
+        for place in loadReply(data):
+            key = osmKey(place.get('osm_type'), place.get('osm_id'))
+            if key is not None:
+                places[key] = place
+    except Exception as e:
+        for rowId, key in batch:
+            yield rowId, key, None, str(e)
+        return
+    for rowId, key in batch:
+        if key is None:
+            yield rowId, key, None, 'Invalid OSM type or id'
+        elif key not in places:
+            yield rowId, key, None, 'OSM object not found: {}'.format(key)
+        else:
+            try:
+                yield rowId, key, parseForward([places[key]], key, showDetails), None
+            except ValueError:
+                yield rowId, key, None, 'No location for {}'.format(key)
+
+
+def parseForward(jd, address, showDetails):
+    '''Return the list of (lon, lat, attributes) of a decoded search reply.
+    Raises ValueError(address) if there is no usable result.'''
+    points = []
+    if len(jd) == 0:
+        raise ValueError(address)
+    # Display only the resulting output address unless details are shown
+    fields = FORWARD_MAP if showDetails else SIMPLE_MAP
+    for addr in jd:
+        try:
+            lat = float(addr['lat'])
+            lon = float(addr['lon'])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError(address)
+        points.append((lon, lat, mapFields(addr, fields, address)))
+    return points
+
+
+def parseReverse(jd, showDetails):
+    '''Return the attributes of a decoded reverse reply.'''
+    if len(jd) == 0:
+        raise ValueError('')
+    return mapFields(jd, REVERSE_MAP if showDetails else SIMPLE_MAP)
+
+
+# Compiled field maps of the output fields
+SIMPLE_MAP = fieldMap(SIMPLE_FIELDS)
+FORWARD_MAP = fieldMap(FORWARD_FIELDS)
+REVERSE_MAP = fieldMap(REVERSE_FIELDS)
+
+
+class GeocodeConfig(object):
+    '''Plain settings of a geocoding run. It mirrors the plugin settings so
+    the same options can be given on the command line. endpoints is a list
+    of (url, weight) of replicas of the nominatim server to spread the
+    requests across using the balance strategy. Searches found in
+    gazetteer, a Gazetteer, are not sent to the server. Rows repeating one
+    of the last dedupSize distinct queries share its reply, like the rows
+    of a chunk in the plugin, or 0 to send every row.'''
+
+    def __init__(self, nominatimURL, maxResults=1, showDetails=False, levelOfDetail=18,
+            maxConcurrent=4, maxRetries=5, timeout=60, cache=None,
+            userAgent='QGIS Bulk Nominatim', endpoints=(), balance=ROUND_ROBIN, gazetteer=None, dedupSize=1000):
+        self.nominatimURL = nominatimURL.rstrip('/')
+        self.maxResults = maxResults
+        self.showDetails = showDetails
+        self.levelOfDetail = levelOfDetail
+        self.maxConcurrent = maxConcurrent
+        self.maxRetries = maxRetries
+        self.timeout = timeout
+        self.cache = cache
+        self.userAgent = userAgent
+        self.endpoints = endpoints
+        self.balance = balance
+        self.gazetteer = gazetteer
+        self.dedupSize = dedupSize
+
+    def searchURL(self):
+        return self.nominatimURL + '/search.php'
+
+    def reverseURL(self):
+        return self.nominatimURL + '/reverse.php'
+
+    def lookupURL(self):
+        return self.nominatimURL + '/lookup.php'
+
+
+class GeocodeEngine(object):
+    '''Geocode an iterator of rows with up to maxConcurrent requests in
+    flight on a thread pool. Each method returns an iterator of
+    GeocodeResult in input order so arbitrarily large inputs can be
+    streamed through it. Requests are paced by the shared rate limiter and
+    transient failures are retried with backoff like the plugin's
+    RequestDispatcher. Connections to the server are kept alive and shared
+    by the requests. If stats, a RunStats, is given the requests are timed
+    by phase in it. Call close() when done with the engine.'''
+
+    def __init__(self, config, limiter=limiter, stats=None):
+        self.config = config
+        self.stats = stats
+        self.cache = config.cache if config.cache is not None and config.cache.enabled else None
+        self.gazetteer = config.gazetteer if config.gazetteer is not None and config.gazetteer.enabled else None
+        self.limiter = limiter
+        self.pool = EndpointPool(config.nominatimURL, config.endpoints, config.balance)
+        self.session = HttpSession({'User-Agent': config.userAgent})
+        self.cacheHits = 0
+        self.cacheMisses = 0
+        self.gazetteerHits = 0
+        self.numRetries = 0
+        self.numFailed = 0
+        self.numErrors = 0
+        # Rows looked up and distinct queries made for them
+        self.numRows = 0
+        self.numQueries = 0
+
+    def forward(self, rows):
+        '''rows is an iterator of (row id, address string).'''
+        searchURL = self.config.searchURL()
+        options = forwardOptions(self.config.maxResults, self.config.showDetails)
+        jobs = ((freeFormQuery(searchURL, address) + options, (rowId, address)) for rowId, address in rows)
+        return self.forwardResults(jobs)
+
+    def table(self, rows, columns, useFreeFormQuery=False):
+        '''rows is an iterator of (row id, list of column values) and columns
+        maps each key of COLUMNS to a column index or -1.'''
+        template = QueryTemplate(self.config.searchURL(), columns, useFreeFormQuery,
+            forwardOptions(self.config.maxResults, self.config.showDetails))
+
+        def jobs():
+            for rowId, attributes in rows:
+                url, address = template(attributes)
+                yield (url, (rowId, address))
+        return self.forwardResults(jobs())
+
+    def reverse(self, rows):
+        '''rows is an iterator of (row id, lon, lat) in EPSG:4326. A row with
+        a lon or lat of None is not requested and fails as invalid.'''
+        reverseURL = self.config.reverseURL()
+        jobs = ((reverseQuery(reverseURL, lat, lon, self.config.showDetails, self.config.levelOfDetail)
+            if lon is not None and lat is not None else None, (rowId, lon, lat)) for rowId, lon, lat in rows)
+        for (rowId, lon, lat), data in self.fetchAll(jobs):
+            if lon is None or lat is None:
+                self.numErrors += 1
+                yield GeocodeResult(rowId, (lon, lat), [], 'Invalid coordinates')
+                continue
+            start = time.monotonic()
+            try:
+                attributes = parseReverse(loadReply(data), self.config.showDetails)
+                result = GeocodeResult(rowId, (lon, lat), [(lon, lat, attributes)], None)
+            except Exception as e:
+                self.numErrors += 1
+                result = GeocodeResult(rowId, (lon, lat), [], str(e))
+            self.timed('parse', start)
+            yield result
+
+    def lookup(self, rows):
+        '''rows is an iterator of (row id, OSM type, OSM id). Up to
+        LOOKUP_BATCH objects are requested at a time.'''
+        keys = ((rowId, osmKey(osmType, osmId)) for rowId, osmType, osmId in rows)
+        for batch, data in self.fetchAll(lookupBatches(self.config.lookupURL(), keys, self.config.showDetails)):
+            start = time.monotonic()
+            results = []
+            for rowId, key, points, error in lookupResults(batch, data, self.config.showDetails):
+                if error is not None:
+                    self.numErrors += 1
+                results.append(GeocodeResult(rowId, key, points or [], error))
+            self.timed('parse', start)
+            for result in results:
+                yield result
+
+    def forwardResults(self, jobs):
+        for (rowId, address), data in self.fetchAll(jobs):
+            start = time.monotonic()
+            try:
+                points = parseForward(loadReply(data), address, self.config.showDetails)
+                result = GeocodeResult(rowId, address, points, None)
+            except Exception as e:
+                self.numErrors += 1
+                result = GeocodeResult(rowId, address, [], str(e))
+            self.timed('parse', start)
+            yield result
+
+    def close(self):
+        self.session.close()
+
+    def timed(self, phase, start):
+        '''Add the time since start to phase of the stats.'''
+        if self.stats is not None:
+            self.stats.add(phase, time.monotonic() - start)
+
+    def timedRequest(self, start, timings):
+        '''Add the connect and server times of a request made since start to
+        the stats and the rest of its time to network.'''
+        if self.stats is None:
+            return
+        elapsed = time.monotonic() - start
+        for phase in ('connect', 'server'):
+            if phase in timings:
+                self.stats.add(phase, timings[phase])
+                elapsed -= timings[phase]
+        self.stats.add('network', max(0.0, elapsed))
+
+    def fetchAll(self, jobs):
+        '''jobs is an iterable of (url, context). Yields (context, data) in
+        input order where data is the raw reply, or empty if the request
+        failed. A url repeating one of the last dedupSize distinct urls
+        shares its reply. Otherwise replies are taken from the cache, then
+        the gazetteer, before the server is asked. At most maxConcurrent*4
+        jobs are read ahead.'''
+        window = max(1, self.config.maxConcurrent) * 4
+        pending = deque()
+        # Reply, or its future, of the most recent distinct urls
+        recent = OrderedDict()
+        with ThreadPoolExecutor(max(1, self.config.maxConcurrent)) as executor:
+            for url, context in jobs:
+                data = None
+                first = True
+                if url is None:
+                    data = b''
+                else:
+                    self.numRows += 1
+                    data = recent.get(url)
+                    if data is not None:
+                        first = False
+                        recent.move_to_end(url)
+                    else:
+                        self.numQueries += 1
+                if data is None and self.cache is not None:
+                    data = self.cache.get(url)
+                    if data is None:
+                        self.cacheMisses += 1
+                    else:
+                        self.cacheHits += 1
+                if data is None and self.gazetteer is not None:
+                    data = self.gazetteer.get(url)
+                    if data is not None:
+                        self.gazetteerHits += 1
+                if data is None:
+                    data = executor.submit(self.request, url)
+                if url is not None and first and self.config.dedupSize > 0:
+                    recent[url] = data
+                    if len(recent) > self.config.dedupSize:
+                        recent.popitem(last=False)
+                pending.append((url, context, data, first))
+                while len(pending) >= window:
+                    yield self.complete(*pending.popleft())
+            while pending:
+                yield self.complete(*pending.popleft())
+        if self.cache is not None:
+            self.cache.flush()
+
+    def complete(self, url, context, result, first=True):
+        if isinstance(result, (bytes, str)):
+            return context, result
+        data, retries = result.result()
+        if not first:
+            # Counted with the row that made the request
+            return context, data
+        self.numRetries += retries
+        if data:
+            if self.cache is not None:
+                self.cache.put(url, data)
+        else:
+            self.numFailed += 1
+        return context, data
+
+    def dedupSummary(self):
+        '''Lines describing the requests saved by sharing the replies of
+        repeated queries.'''
+        if not self.numQueries:
+            return []
+        return ['Unique queries: {}'.format(self.numQueries),
+            'Deduplication ratio: {:.2f} ({} requests saved)'.format(
+                self.numRows / self.numQueries, self.numRows - self.numQueries)]
+
+    def request(self, url):
+        '''Fetch url on a worker thread. Returns the raw reply bytes, empty
+        on failure, and the number of retries made.'''
+        attempt = 0
+        while True:
+            start = time.monotonic()
+            self.limiter.wait()
+            self.timed('queue', start)
+            delay = None
+            start = time.monotonic()
+            target, endpoint = self.pool.route(url)
+            timings = {}
+            try:
+                status, headers, data = self.session.get(target, self.config.timeout, timings)
+            except (HTTPException, OSError):
+                self.timedRequest(start, timings)
+                self.pool.release(endpoint, False)
+            else:
+                self.timedRequest(start, timings)
+                self.pool.release(endpoint, status not in RETRY_STATUS)
+                if status < 400:
+                    self.limiter.succeeded()
+                    return data, attempt
+                if status not in RETRY_STATUS:
+                    return b'', attempt
+                if status in (429, 503):
+                    self.limiter.throttled()
+                delay = parseRetryAfter(headers.get('Retry-After'))
+            if attempt >= self.config.maxRetries:
+                return b'', attempt
+            if delay is None:
+                delay = backoffDelay(attempt)
+            attempt += 1
+            time.sleep(delay)
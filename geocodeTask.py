@@ -0,0 +1,547 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import time
+from itertools import islice
+
+from qgis.core import (QgsTask, QgsFeature, QgsGeometry, QgsPointXY, QgsFeatureRequest,
+    QgsProject, QgsMessageLog, Qgis)
+from qgis.PyQt.QtCore import pyqtSignal
+
+from .dispatcher import RequestDispatcher
+from .endpointPool import pool
+from .geocodeEngine import (JSON_BACKEND, forwardOptions, freeFormQuery, QueryTemplate, queryHash, reverseQuery,
+    loadReply, parseForward, parseReverse, osmKey, lookupBatches, lookupResults)
+from .pointReader import readPoints
+from .runStats import RunStats
+from .spatialCache import SpatialCache
+
+
+class GeocodeTask(QgsTask):
+    '''Base class for the bulk geocoding jobs. The requests are made in
+    run() on a background thread and the results are written through
+    writer, a result writer from resultWriter.py. The output layer is added
+    to the project from finished() once the job is done. If a journal is given,
+    completed rows are checkpointed to it and rows already recorded by an
+    interrupted run are restored rather than requested again.
+
+    In streaming mode the input is read and geocoded chunkSize rows at a
+    time so the size of the input is not limited by memory.
+
+    Every request is timed by phase in stats. statusChanged is emitted about
+    once a second with the throughput and estimated time remaining, and the
+    statistics are exported to statsPath, if set, when the job ends.'''
+
+    statusChanged = pyqtSignal(str)
+
+    # Seconds between status updates
+    STATUS_INTERVAL = 1.0
+
+    def __init__(self, description, settings, writer, showDetails, resultsTextEdit, journal=None):
+        super(GeocodeTask, self).__init__(description, QgsTask.CanCancel)
+        self.maxConcurrent = settings.maxConcurrent
+        self.maxRetries = settings.maxRetries
+        self.chunkSize = settings.chunkSize if settings.streamingMode else 0
+        self.numChunks = 0
+        self.cache = settings.cache
+        # Local gazetteer searches are looked up in, set by the forward tasks
+        self.gazetteer = None
+        self.searchURL = settings.searchURL()
+        self.reverseURL = settings.reverseURL()
+        self.writer = writer
+        self.showDetails = showDetails
+        self.resultsTextEdit = resultsTextEdit
+        self.journal = journal
+        self.completed = {}
+        self.numResumed = 0
+        self.numAddress = 0
+        self.numErrors = 0
+        self.numProcessed = 0
+        self.errors = []
+        self.exception = None
+        self.dispatcher = None
+        self.stats = RunStats(description)
+        self.stats.info = {'concurrent_requests': self.maxConcurrent, 'max_retries': self.maxRetries,
+            'chunk_size': self.chunkSize, 'cache_enabled': bool(self.cache is not None and self.cache.enabled),
+            'show_details': showDetails, 'json_decoder': JSON_BACKEND}
+        self.statsPath = ''
+        self.lastStatus = 0
+        self.poolCounts = pool.counts()
+
+    def run(self):
+        try:
+            self.dispatcher = RequestDispatcher(self.maxConcurrent, self.cache, self.isCanceled, self.maxRetries,
+                stats=self.stats, gazetteer=self.gazetteer)
+            if self.journal is not None:
+                self.completed = self.journal.load()
+                self.restore()
+            self.process()
+        except Exception as e:
+            self.exception = e
+            return False
+        finally:
+            self.writer.flush()
+            if self.journal is not None:
+                self.journal.checkpoint()
+            if self.cache is not None:
+                # Release this thread's cache connection
+                self.cache.close()
+            if self.gazetteer is not None:
+                self.gazetteer.close()
+        return not self.isCanceled()
+
+    def process(self):
+        raise NotImplementedError
+
+    def chunks(self, jobs):
+        '''Split jobs into lists of chunkSize jobs, or a single list if not
+        streaming.'''
+        jobs = iter(jobs)
+        while not self.isCanceled():
+            chunk = list(islice(jobs, self.chunkSize)) if self.chunkSize else list(jobs)
+            if not chunk:
+                break
+            yield chunk
+
+    def chunkDone(self):
+        self.numChunks += 1
+        if self.chunkSize:
+            QgsMessageLog.logMessage('{}: chunk {} complete, {} of {} rows processed'.format(
+                self.description(), self.numChunks, self.numProcessed, self.numAddress), 'Bulk Nominatim', level=Qgis.Info)
+
+    def restore(self):
+        '''Add the rows completed by an earlier run of this job to the output.'''
+        for rowId, rows in self.completed.items():
+            features = []
+            for lon, lat, attributes in rows:
+                feature = QgsFeature()
+                feature.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(lon, lat)))
+                feature.setAttributes(attributes)
+                features.append(feature)
+            self.writer.addRow(rowId, features)
+        self.numResumed = len(self.completed)
+        self.numProcessed += self.numResumed
+
+    def writeFeatures(self, rowId, features):
+        '''Write the output features of a source row.'''
+        start = time.monotonic()
+        self.writer.addRow(rowId, features)
+        if self.journal is not None:
+            self.journal.record(rowId, features)
+        self.stats.add('write', time.monotonic() - start)
+
+    def advance(self, count=1):
+        self.numProcessed += count
+        self.stats.rowsDone(count)
+        if self.numAddress:
+            self.setProgress(100.0 * self.numProcessed / self.numAddress)
+        now = time.monotonic()
+        if now - self.lastStatus >= self.STATUS_INTERVAL:
+            self.lastStatus = now
+            self.statusChanged.emit(self.stats.status(self.numAddress - self.numResumed))
+
+    def finished(self, result):
+        '''Called in the main thread when run() is complete.'''
+        self.stats.stop()
+        self.statusChanged.emit(self.stats.status(self.numAddress - self.numResumed))
+        for line in self.errors:
+            self.resultsTextEdit.appendPlainText(line)
+        layer = self.writer.finish()
+        if result:
+            if self.journal is not None:
+                self.journal.remove()
+            if layer is not None:
+                QgsProject.instance().addMapLayer(layer)
+            self.resultsTextEdit.appendPlainText('Results written to '+self.writer.description())
+            for line in self.summary():
+                self.resultsTextEdit.appendPlainText(line)
+            if self.chunkSize:
+                self.resultsTextEdit.appendPlainText('Number of Chunks Processed: {}'.format(self.numChunks))
+            if self.numResumed:
+                self.resultsTextEdit.appendPlainText('Number of Rows Resumed from Checkpoint: {}'.format(self.numResumed))
+            self.resultsTextEdit.appendPlainText('Number of Retried Requests: {}'.format(self.dispatcher.numRetries))
+            self.resultsTextEdit.appendPlainText('Number of Failed Requests: {}'.format(self.dispatcher.numFailed))
+            for line in pool.summary(self.poolCounts) + self.dispatcher.connectionSummary():
+                self.resultsTextEdit.appendPlainText(line)
+            if self.dispatcher.cache is not None:
+                self.resultsTextEdit.appendPlainText('Cache Hits: {}'.format(self.dispatcher.cacheHits))
+                self.resultsTextEdit.appendPlainText('Cache Misses: {}'.format(self.dispatcher.cacheMisses))
+            if self.dispatcher.gazetteer is not None:
+                self.resultsTextEdit.appendPlainText('Gazetteer Hits: {}'.format(self.dispatcher.gazetteerHits))
+            self.resultsTextEdit.appendPlainText('JSON Decoder: {}'.format(JSON_BACKEND))
+            for line in self.stats.summary():
+                self.resultsTextEdit.appendPlainText(line)
+            self.resultsTextEdit.appendPlainText('Processing Complete!')
+        elif self.exception is not None:
+            QgsMessageLog.logMessage('Geocoding failed: {}'.format(self.exception), 'Bulk Nominatim', level=Qgis.Critical)
+            self.resultsTextEdit.appendPlainText('Geocoding failed: {}'.format(self.exception))
+        else:
+            self.resultsTextEdit.appendPlainText('Geocoding canceled after {} of {}'.format(self.numProcessed, self.numAddress))
+        if not result and self.writer.persistent:
+            self.resultsTextEdit.appendPlainText('Partial results were written to '+self.writer.description())
+        if not result and self.journal is not None and self.journal.exists():
+            self.resultsTextEdit.appendPlainText('Completed rows were checkpointed and will be resumed when this job is run again.')
+        if self.statsPath:
+            self.exportStats(result)
+
+    def exportStats(self, result):
+        '''Write the run statistics to statsPath.'''
+        self.stats.counters = {'completed': int(bool(result)), 'rows_total': self.numAddress,
+            'rows_resumed': self.numResumed, 'errors': self.numErrors}
+        if self.dispatcher is not None:
+            self.stats.counters.update({'retries': self.dispatcher.numRetries, 'failed_requests': self.dispatcher.numFailed,
+                'cache_hits': self.dispatcher.cacheHits, 'cache_misses': self.dispatcher.cacheMisses,
+                'gazetteer_hits': self.dispatcher.gazetteerHits,
+                'requests': self.dispatcher.numRequests, 'tls_handshakes': self.dispatcher.numHandshakes,
+                'http2_replies': self.dispatcher.numHttp2})
+        try:
+            self.stats.export(self.statsPath)
+            self.resultsTextEdit.appendPlainText('Run statistics written to '+self.statsPath)
+        except Exception as e:
+            self.resultsTextEdit.appendPlainText('Unable to write the run statistics: {}'.format(e))
+
+    def summary(self):
+        return []
+
+    def addressError(self, message, rowId=None):
+        if rowId is not None:
+            self.writer.rowFailed(rowId)
+        if self.numErrors == 0:
+            self.errors.append('Address Errors')
+        self.numErrors += 1
+        self.errors.append(message)
+
+
+class ForwardGeocodeTask(GeocodeTask):
+    '''Geocode addresses into points. Subclasses provide jobs(), a generator
+    of (url, (row id, source address)) tuples for the rows not yet completed.
+    Queries found in the local gazetteer, if enabled, are not sent to the
+    server.'''
+
+    def __init__(self, description, settings, writer, showDetails, resultsTextEdit, maxResults, journal=None):
+        super(ForwardGeocodeTask, self).__init__(description, settings, writer, showDetails, resultsTextEdit, journal)
+        self.maxResults = maxResults
+        self.numQueries = 0
+        # Rows grouped into queries by this run, leaving out resumed and
+        # unchanged rows
+        self.numGrouped = 0
+        self.gazetteer = settings.gazetteer if settings.gazetteer.enabled else None
+
+    def process(self):
+        for chunk in self.chunks(self.jobs()):
+            queries = self.groupQueries(chunk)
+            self.numQueries += len(queries)
+            self.dispatcher.fetchAll(queries.items(), self.addForwardResults)
+            self.chunkDone()
+
+    def jobs(self):
+        raise NotImplementedError
+
+    def summary(self):
+        lines = ['Number of Addresses Processed: '+str(self.numAddress),
+            'Number of Successes: '+ str(self.numAddress-self.numErrors),
+            'Number of Errors: '+str(self.numErrors),
+            'Number of Unique Queries: '+str(self.numQueries)]
+        if self.numQueries:
+            lines.append('Deduplication Ratio: {:.2f} ({} requests saved)'.format(
+                self.numGrouped / self.numQueries, self.numGrouped - self.numQueries))
+        return lines
+
+    def queryOptions(self):
+        return forwardOptions(self.maxResults, self.showDetails)
+
+    def groupQueries(self, jobs):
+        '''Group the source addresses by the query url they produce so each
+        distinct query is only sent once. Returns an ordered mapping of url
+        to the list of (row id, source address) in first seen order.'''
+        queries = {}
+        for url, row in jobs:
+            if self.isCanceled():
+                break
+            self.numGrouped += 1
+            if url in queries:
+                queries[url].append(row)
+            else:
+                queries[url] = [row]
+        return queries
+
+    def addForwardResults(self, rows, jsondata):
+        '''Add the geocoded results for a query to the output layer once for
+        each source row that produced it.'''
+        self.advance(len(rows))
+        start = time.monotonic()
+        try:
+            jd = loadReply(jsondata)
+        except Exception as e:
+            for rowId, address in rows:
+                self.addressError(str(e), rowId)
+            return
+        finally:
+            self.stats.add('parse', time.monotonic() - start)
+        for rowId, address in rows:
+            self.addForwardResult(rowId, address, jd)
+
+    def addForwardResult(self, rowId, address, jd):
+        try:
+            features = []
+            for lon, lat, attributes in parseForward(jd, address, self.showDetails):
+                feature = QgsFeature()
+                feature.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(lon, lat)))
+                feature.setAttributes(attributes)
+                features.append(feature)
+            self.writeFeatures(rowId, features)
+        except Exception as e:
+            self.addressError(str(e), rowId)
+
+
+class AddressTableTask(ForwardGeocodeTask):
+    '''Geocode the features of a table or vector layer. columns maps each of
+    full, number, street, city, county, state, country and postal to a
+    field index or -1 if it is not used.
+
+    If incremental is set the writer is an incremental OgrResultWriter. Rows
+    whose query hash matches existing output are skipped. Once every row
+    has been seen, the old output of changed rows and of rows no longer in
+    the source is removed.'''
+
+    def __init__(self, settings, writer, showDetails, resultsTextEdit, maxResults,
+            source, numAddress, columns, useFreeFormQuery, journal=None, incremental=False):
+        super(AddressTableTask, self).__init__('Bulk Nominatim table geocoding', settings,
+            writer, showDetails, resultsTextEdit, maxResults, journal)
+        self.source = source
+        self.numAddress = numAddress
+        self.columns = columns
+        self.useFreeFormQuery = useFreeFormQuery
+        self.incremental = incremental
+        # Query hash of the rows being geocoded in incremental mode
+        self.hashes = {}
+        self.numUnchanged = 0
+        self.numRemoved = 0
+
+    def process(self):
+        super(AddressTableTask, self).process()
+        if self.incremental and not self.isCanceled():
+            self.numRemoved = self.writer.removeUnseen()
+
+    def summary(self):
+        lines = super(AddressTableTask, self).summary()
+        if self.incremental:
+            if self.writer.rebuilt:
+                lines.append('Incremental Output Rebuilt: {}'.format(self.writer.rebuilt))
+            lines.append('Number of Unchanged Rows Kept: {}'.format(self.numUnchanged))
+            lines.append('Number of Outdated Rows Removed from the Output: {}'.format(self.numRemoved))
+        return lines
+
+    def writeFeatures(self, rowId, features):
+        if self.incremental:
+            extra = [rowId, self.hashes.pop(rowId)]
+            for feature in features:
+                feature.setAttributes(feature.attributes() + extra)
+        super(AddressTableTask, self).writeFeatures(rowId, features)
+
+    def addressError(self, message, rowId=None):
+        if self.incremental and rowId is not None:
+            # The stale output is removed at the end so the row is tried
+            # again next time
+            self.hashes.pop(rowId, None)
+        super(AddressTableTask, self).addressError(message, rowId)
+
+    def jobs(self):
+        template = QueryTemplate(self.searchURL, self.columns, self.useFreeFormQuery, self.queryOptions())
+        request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry)
+        indexes = template.fieldIndexes()
+        if indexes is not None:
+            request.setSubsetOfAttributes(indexes)
+        for feature in self.source.getFeatures(request):
+            if feature.id() in self.completed:
+                continue
+            url, address = template(feature.attributes())
+            if self.incremental:
+                h = queryHash(url)
+                if self.writer.unchanged(feature.id(), h):
+                    self.numUnchanged += 1
+                    self.advance()
+                    continue
+                self.hashes[feature.id()] = h
+            yield (url, (feature.id(), address))
+
+
+class FreeFormTask(ForwardGeocodeTask):
+    '''Geocode a list of free-form address strings.'''
+
+    def __init__(self, settings, writer, showDetails, resultsTextEdit, maxResults, addresses, journal=None):
+        super(FreeFormTask, self).__init__('Bulk Nominatim address geocoding', settings,
+            writer, showDetails, resultsTextEdit, maxResults, journal)
+        self.addresses = addresses
+        self.numAddress = len(addresses)
+
+    def jobs(self):
+        options = self.queryOptions()
+        for rowId, address in enumerate(self.addresses):
+            if rowId in self.completed:
+                continue
+            yield (freeFormQuery(self.searchURL, address) + options, (rowId, address))
+
+
+class ReverseGeocodeTask(GeocodeTask):
+    '''Reverse geocode the points of a point layer. transform converts the
+    layer coordinates to EPSG:4326.
+
+    With a snap tolerance, points within that many meters of a point that
+    was already requested share its result. Such points are grouped with
+    the first one so only one request is sent for each distinct location.'''
+
+    def __init__(self, settings, writer, showDetails, resultsTextEdit, source, numAddress, transform, journal=None):
+        super(ReverseGeocodeTask, self).__init__('Bulk Nominatim reverse geocoding', settings,
+            writer, showDetails, resultsTextEdit, journal)
+        self.source = source
+        self.numAddress = numAddress
+        self.transform = transform
+        self.spatialCache = SpatialCache(settings.snapTolerance) if settings.snapTolerance > 0 else None
+
+    def process(self):
+        for chunk in self.chunks(self.jobs()):
+            if self.spatialCache is None:
+                self.dispatcher.fetchAll(chunk, self.addReverseResult)
+            else:
+                self.dispatcher.fetchAll(self.snapPoints(chunk), self.addSnappedResults)
+            self.chunkDone()
+
+    def snapPoints(self, chunk):
+        '''Group the points of a chunk with an earlier point within the snap
+        tolerance. Returns the jobs for the dispatcher, whose context is a
+        group holding the rows and, once known, the shared attributes.
+        Groups resolved in an earlier chunk are not requested again.'''
+        jobs = []
+        for url, (rowId, pt) in chunk:
+            if self.isCanceled():
+                break
+            group = self.spatialCache.find(pt.x(), pt.y())
+            if group is None:
+                group = {'pt': pt, 'rows': [], 'attributes': None}
+                self.spatialCache.add(pt.x(), pt.y(), group)
+                jobs.append((url, group))
+            elif group['attributes'] is not None:
+                jobs.append((None, {'pt': pt, 'rows': [(rowId, pt)], 'attributes': group['attributes']}))
+                continue
+            group['rows'].append((rowId, pt))
+        return jobs
+
+    def jobs(self):
+        # make sure the coordinates are in EPSG:4326
+        for fid, pt in readPoints(self.source, self.transform, self.completed, self.pointFailed):
+            url = reverseQuery(self.reverseURL, pt.y(), pt.x(), self.showDetails)
+            yield (url, (fid, pt))
+
+    def pointFailed(self, fid):
+        '''A feature has no point or it could not be transformed.'''
+        self.numErrors += 1
+        self.advance()
+
+    def summary(self):
+        lines = ['Total Points Processed: '+str(self.numAddress)]
+        if self.spatialCache is not None:
+            lines.append('Spatial Cache Hits: {} of {} points ({:.1f}%)'.format(self.spatialCache.hits,
+                self.spatialCache.hits + self.spatialCache.misses, self.spatialCache.hitRate()))
+        return lines
+
+    def addSnappedResults(self, group, jsondata):
+        '''Add the reverse geocoded address shared by a group of points.'''
+        rows = group['rows']
+        group['rows'] = []
+        self.advance(len(rows))
+        if group['attributes'] is None:
+            start = time.monotonic()
+            try:
+                group['attributes'] = parseReverse(loadReply(jsondata), self.showDetails)
+            except Exception:
+                # Let later points near this one be requested again
+                self.spatialCache.discard(group['pt'].x(), group['pt'].y(), group)
+                self.numErrors += len(rows)
+                return
+            finally:
+                self.stats.add('parse', time.monotonic() - start)
+        for rowId, pt in rows:
+            feature = QgsFeature()
+            feature.setGeometry(QgsGeometry.fromPointXY(pt))
+            feature.setAttributes(group['attributes'])
+            self.writeFeatures(rowId, [feature])
+
+    def addReverseResult(self, row, jsondata):
+        '''Add the reverse geocoded address of a point to the output layer.'''
+        rowId, pt = row
+        self.advance()
+        try:
+            start = time.monotonic()
+            try:
+                attributes = parseReverse(loadReply(jsondata), self.showDetails)
+            finally:
+                self.stats.add('parse', time.monotonic() - start)
+            feature = QgsFeature()
+            feature.setGeometry(QgsGeometry.fromPointXY(pt))
+            feature.setAttributes(attributes)
+            self.writeFeatures(rowId, [feature])
+        except Exception:
+            self.numErrors += 1
+
+
+class LookupTask(GeocodeTask):
+    '''Refresh places by their OSM type and id with the nominatim lookup
+    request, which takes up to LOOKUP_BATCH ids at a time. typeIdx is the
+    field of the OSM type or -1 if the id field holds keys such as N123.'''
+
+    def __init__(self, settings, writer, showDetails, resultsTextEdit, source, numAddress, typeIdx, idIdx, journal=None):
+        super(LookupTask, self).__init__('Bulk Nominatim OSM id lookup', settings,
+            writer, showDetails, resultsTextEdit, journal)
+        self.lookupURL = settings.lookupURL()
+        self.source = source
+        self.numAddress = numAddress
+        self.typeIdx = typeIdx
+        self.idIdx = idIdx
+        self.numQueries = 0
+
+    def process(self):
+        for chunk in self.chunks(self.jobs()):
+            batches = list(lookupBatches(self.lookupURL, chunk, self.showDetails))
+            self.numQueries += len([url for url, batch in batches if url is not None])
+            self.dispatcher.fetchAll(batches, self.addLookupResults)
+            self.chunkDone()
+
+    def jobs(self):
+        request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry)
+        for feature in self.source.getFeatures(request):
+            if feature.id() in self.completed:
+                continue
+            osmType = feature[self.typeIdx] if self.typeIdx >= 0 else None
+            yield (feature.id(), osmKey(osmType, feature[self.idIdx]))
+
+    def summary(self):
+        return ['Number of Objects Processed: '+str(self.numAddress),
+            'Number of Successes: '+ str(self.numAddress-self.numErrors),
+            'Number of Errors: '+str(self.numErrors),
+            'Number of Lookup Requests: '+str(self.numQueries)]
+
+    def addLookupResults(self, batch, jsondata):
+        '''Add the places of a lookup reply to the output layer.'''
+        self.advance(len(batch))
+        start = time.monotonic()
+        results = list(lookupResults(batch, jsondata, self.showDetails))
+        self.stats.add('parse', time.monotonic() - start)
+        for rowId, key, points, error in results:
+            if error is not None:
+                self.addressError('{}: {}'.format(rowId, error))
+                continue
+            features = []
+            for lon, lat, attributes in points:
+                feature = QgsFeature()
+                feature.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(lon, lat)))
+                feature.setAttributes(attributes)
+                features.append(feature)
+            self.writeFeatures(rowId, features)
@@ -0,0 +1,180 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import ssl
+import time
+import zlib
+import threading
+import http.client
+from urllib.parse import urlsplit, urljoin
+from urllib.request import getproxies, proxy_bypass
+
+# Redirects followed for one request
+MAX_REDIRECTS = 5
+REDIRECT_STATUS = (301, 302, 303, 307, 308)
+# Errors of a kept alive connection the server has since closed
+STALE_ERRORS = (http.client.RemoteDisconnected, http.client.BadStatusLine, BrokenPipeError,
+    ConnectionResetError, ConnectionAbortedError)
+
+
+class HttpSession(object):
+    '''Persistent HTTP/1.1 connections shared by the worker threads of the
+    geocoding engine. Each request borrows an idle connection to its host,
+    or opens a new one, and returns it once the reply has been read, so
+    TLS handshakes are only paid once per connection instead of once per
+    request. Replies are requested gzip compressed. A request failing on a
+    reused connection the server has closed in the meantime is sent again
+    on a new connection. Proxies are taken from the environment like
+    urllib does.
+
+    If a timings dict is passed to get(), the seconds spent opening new
+    connections, including DNS and TLS, are added to its 'connect' entry
+    and the seconds from sending each request to receiving the reply
+    headers to its 'server' entry.'''
+
+    def __init__(self, headers=None):
+        self.headers = {'Accept': 'application/json', 'Accept-Encoding': 'gzip, deflate',
+            'Connection': 'keep-alive'}
+        self.headers.update(headers or {})
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.context = ssl.create_default_context()
+        self.proxies = getproxies()
+        self.numRequests = 0
+        self.numConnections = 0
+        self.numReused = 0
+        self.bytesReceived = 0
+        self.bytesDecoded = 0
+
+    def get(self, url, timeout=60, timings=None):
+        '''Send a GET request. Returns the HTTP status, the reply headers
+        and the decoded body. Raises OSError or http.client.HTTPException
+        if there is no reply.'''
+        if timings is None:
+            timings = {}
+        for i in range(MAX_REDIRECTS + 1):
+            status, headers, body = self.send(url, timeout, timings)
+            location = headers.get('Location')
+            if status not in REDIRECT_STATUS or not location:
+                break
+            url = urljoin(url, location)
+        return status, headers, body
+
+    def send(self, url, timeout, timings):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        while True:
+            conn, reused = self.acquire(key, parts, timeout)
+            try:
+                if not reused:
+                    start = time.monotonic()
+                    conn.connect()
+                    timings['connect'] = timings.get('connect', 0.0) + time.monotonic() - start
+                target = url if getattr(conn, 'proxied', False) else path
+                start = time.monotonic()
+                conn.request('GET', target, headers=self.headers)
+                reply = conn.getresponse()
+                timings['server'] = timings.get('server', 0.0) + time.monotonic() - start
+                data = reply.read()
+            except STALE_ERRORS:
+                conn.close()
+                if reused:
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+            with self.lock:
+                self.numRequests += 1
+                if reused:
+                    self.numReused += 1
+                self.bytesReceived += len(data)
+            if reply.will_close:
+                conn.close()
+            else:
+                self.release(key, conn)
+            data = self.decode(data, reply.getheader('Content-Encoding', ''))
+            with self.lock:
+                self.bytesDecoded += len(data)
+            return reply.status, reply.msg, data
+
+    def acquire(self, key, parts, timeout):
+        '''Return an idle connection to the host of parts, or a new one,
+        and whether it is reused.'''
+        with self.lock:
+            idle = self.idle.get(key)
+            if idle:
+                conn = idle.pop()
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+            self.numConnections += 1
+        return self.connect(parts, timeout), False
+
+    def connect(self, parts, timeout):
+        https = parts.scheme == 'https'
+        port = parts.port or (443 if https else 80)
+        proxy = self.proxies.get(parts.scheme)
+        if proxy and proxy_bypass(parts.hostname):
+            proxy = None
+        if proxy:
+            proxy = urlsplit(proxy if '://' in proxy else 'http://' + proxy)
+            if https:
+                conn = http.client.HTTPSConnection(proxy.hostname, proxy.port or 80, timeout=timeout,
+                    context=self.context)
+                conn.set_tunnel(parts.hostname, port)
+            else:
+                conn = http.client.HTTPConnection(proxy.hostname, proxy.port or 80, timeout=timeout)
+                conn.proxied = True
+        elif https:
+            conn = http.client.HTTPSConnection(parts.hostname, port, timeout=timeout, context=self.context)
+        else:
+            conn = http.client.HTTPConnection(parts.hostname, port, timeout=timeout)
+        return conn
+
+    def release(self, key, conn):
+        with self.lock:
+            self.idle.setdefault(key, []).append(conn)
+
+    def decode(self, data, encoding):
+        encoding = encoding.strip().lower()
+        if encoding in ('gzip', 'x-gzip'):
+            return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        if encoding == 'deflate':
+            try:
+                return zlib.decompress(data)
+            except zlib.error:
+                # Raw deflate without the zlib header
+                return zlib.decompress(data, -zlib.MAX_WBITS)
+        return data
+
+    def close(self):
+        '''Close the idle connections.'''
+        with self.lock:
+            idle = self.idle
+            self.idle = {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def summary(self):
+        '''Lines describing the connection reuse and compression.'''
+        if not self.numRequests:
+            return []
+        lines = ['Connections: {} opened for {} requests ({} reused)'.format(
+            self.numConnections, self.numRequests, self.numReused)]
+        if self.bytesDecoded > self.bytesReceived:
+            lines.append('Compression: {:.1f} MB received for {:.1f} MB of replies'.format(
+                self.bytesReceived / 1048576.0, self.bytesDecoded / 1048576.0))
+        return lines
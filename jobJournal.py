@@ -0,0 +1,79 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import os
+import json
+import time
+import hashlib
+
+
+class JobJournal(object):
+    '''Append only journal of the rows a bulk geocoding job has completed
+    and the output points they produced. It is written at checkpoints so
+    an interrupted job can be resumed without requesting those rows again.
+    Each line holds one row as {"id": row id, "f": [[lon, lat, attributes], ...]}.'''
+
+    # Checkpoint after this many rows or this many seconds
+    CHECKPOINT_ROWS = 500
+    CHECKPOINT_SECONDS = 10
+
+    def __init__(self, directory, *keys):
+        '''The journal file name is derived from keys, which should identify
+        the input and every option that changes the output.'''
+        digest = hashlib.sha1('\n'.join([str(k) for k in keys]).encode('utf-8')).hexdigest()
+        self.path = os.path.join(directory, digest + '.jsonl')
+        self.pending = []
+        self.lastCheckpoint = time.monotonic()
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def load(self):
+        '''Return a dictionary of row id to the list of (lon, lat, attributes)
+        recorded for that row.'''
+        completed = {}
+        if not self.exists():
+            return completed
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                    completed[row['id']] = row['f']
+                except (ValueError, KeyError):
+                    # A partially written last line from a crash
+                    continue
+        return completed
+
+    def record(self, rowId, features):
+        '''Record the output features of a completed row.'''
+        self.pending.append(json.dumps({'id': rowId,
+            'f': [[f.geometry().asPoint().x(), f.geometry().asPoint().y(), f.attributes()] for f in features]}))
+        if (len(self.pending) >= self.CHECKPOINT_ROWS or
+                time.monotonic() - self.lastCheckpoint >= self.CHECKPOINT_SECONDS):
+            self.checkpoint()
+
+    def checkpoint(self):
+        '''Write the recorded rows to disk.'''
+        if self.pending:
+            directory = os.path.dirname(self.path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write('\n'.join(self.pending))
+                f.write('\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.pending = []
+        self.lastCheckpoint = time.monotonic()
+
+    def remove(self):
+        self.pending = []
+        if self.exists():
+            os.remove(self.path)
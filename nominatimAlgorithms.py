@@ -0,0 +1,329 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import os
+from itertools import islice
+
+from qgis.core import (QgsApplication, QgsProcessingAlgorithm, QgsProcessing, QgsProcessingException,
+    QgsProcessingParameterFeatureSource, QgsProcessingParameterField, QgsProcessingParameterString,
+    QgsProcessingParameterNumber, QgsProcessingParameterBoolean, QgsProcessingParameterFeatureSink,
+    QgsFeature, QgsFeatureSink, QgsFeatureRequest, QgsFields, QgsField, QgsGeometry, QgsPointXY,
+    QgsWkbTypes, QgsCoordinateReferenceSystem, QgsCoordinateTransform)
+from qgis.PyQt.QtCore import QSettings, QVariant
+from qgis.PyQt.QtGui import QIcon
+
+from .dispatcher import RequestDispatcher
+from .gazetteer import Gazetteer
+from .geocodeCache import GeocodeCache
+from .geocodeEngine import (NOMURL, SIMPLE_FIELDS, FORWARD_FIELDS, REVERSE_FIELDS, forwardOptions,
+    freeFormQuery, QueryTemplate, reverseQuery, loadReply, parseForward, parseReverse)
+from .pointReader import readPoints
+
+
+def pluginCache():
+    '''Open the plugin's reply cache configured from the saved settings, or
+    return None if caching is disabled.'''
+    settings = QSettings()
+    if not int(settings.value('/BulkNominatim/cacheEnabled', 1)):
+        return None
+    return GeocodeCache(os.path.join(QgsApplication.qgisSettingsDirPath(), 'bulknominatim', 'cache.sqlite'),
+        True, int(settings.value('/BulkNominatim/cacheDays', 30))*86400,
+        int(settings.value('/BulkNominatim/cacheSize', 500000)),
+        int(settings.value('/BulkNominatim/cachePrecision', 5)))
+
+
+def pluginGazetteer():
+    '''Open the plugin's local gazetteer configured from the saved settings,
+    or return None if it is disabled.'''
+    settings = QSettings()
+    if not int(settings.value('/BulkNominatim/gazetteerEnabled', 0)):
+        return None
+    return Gazetteer(os.path.join(QgsApplication.qgisSettingsDirPath(), 'bulknominatim', 'gazetteer.sqlite'),
+        True, bool(int(settings.value('/BulkNominatim/gazetteerOffline', 0))))
+
+
+class GeocodeAlgorithm(QgsProcessingAlgorithm):
+    '''Base class of the Processing algorithms. The parameters common to all
+    of them default to the plugin settings. Each run has its own request
+    dispatcher so several can run in parallel within a model.'''
+
+    URL = 'URL'
+    DETAILS = 'DETAILS'
+    CONCURRENT = 'CONCURRENT'
+    OUTPUT = 'OUTPUT'
+
+    # Number of input rows grouped and dispatched at a time
+    CHUNKSIZE = 1000
+    # Look searches up in the local gazetteer before sending them
+    useGazetteer = False
+
+    def createInstance(self):
+        return type(self)()
+
+    def group(self):
+        return 'Geocoding'
+
+    def groupId(self):
+        return 'geocoding'
+
+    def icon(self):
+        return QIcon(os.path.dirname(__file__) + '/images/icon.png')
+
+    def addCommonParameters(self):
+        settings = QSettings()
+        self.addParameter(QgsProcessingParameterString(self.URL, 'Nominatim service URL',
+            settings.value('/BulkNominatim/URL', NOMURL)))
+        self.addParameter(QgsProcessingParameterBoolean(self.DETAILS, 'Include detailed address results', False))
+        param = QgsProcessingParameterNumber(self.CONCURRENT, 'Concurrent requests',
+            QgsProcessingParameterNumber.Integer, int(settings.value('/BulkNominatim/maxConcurrent', 4)), False, 1, 64)
+        param.setFlags(param.flags() | param.FlagAdvanced)
+        self.addParameter(param)
+
+    def prepareRun(self, parameters, context, feedback, detailedFields):
+        '''Read the common parameters and create the output sink.'''
+        self.nominatimURL = self.parameterAsString(parameters, self.URL, context).strip().rstrip('/')
+        if not self.nominatimURL:
+            raise QgsProcessingException('A Nominatim service URL is required')
+        self.showDetails = int(self.parameterAsBool(parameters, self.DETAILS, context))
+        self.feedback = feedback
+        self.numErrors = 0
+        self.numProcessed = 0
+        self.total = 0
+        fields = QgsFields()
+        for name in (detailedFields if self.showDetails else SIMPLE_FIELDS):
+            fields.append(QgsField(name, QVariant.String))
+        self.sink, destId = self.parameterAsSink(parameters, self.OUTPUT, context, fields,
+            QgsWkbTypes.Point, QgsCoordinateReferenceSystem('EPSG:4326'))
+        if self.sink is None:
+            raise QgsProcessingException(self.invalidSinkError(parameters, self.OUTPUT))
+        self.cache = pluginCache()
+        self.gazetteer = pluginGazetteer() if self.useGazetteer else None
+        settings = QSettings()
+        self.dispatcher = RequestDispatcher(self.parameterAsInt(parameters, self.CONCURRENT, context),
+            self.cache, feedback.isCanceled, int(settings.value('/BulkNominatim/maxRetries', 5)),
+            gazetteer=self.gazetteer)
+        return destId
+
+    def finishRun(self):
+        if self.cache is not None:
+            self.cache.close()
+        if self.gazetteer is not None:
+            self.gazetteer.close()
+        self.feedback.pushInfo('Rows processed: {}'.format(self.numProcessed))
+        self.feedback.pushInfo('Errors: {}'.format(self.numErrors))
+        self.feedback.pushInfo('Retried requests: {}'.format(self.dispatcher.numRetries))
+        self.feedback.pushInfo('Failed requests: {}'.format(self.dispatcher.numFailed))
+        if self.dispatcher.cache is not None:
+            self.feedback.pushInfo('Cache hits: {} misses: {}'.format(
+                self.dispatcher.cacheHits, self.dispatcher.cacheMisses))
+        if self.dispatcher.gazetteer is not None:
+            self.feedback.pushInfo('Gazetteer hits: {}'.format(self.dispatcher.gazetteerHits))
+
+    def advance(self, count=1):
+        self.numProcessed += count
+        if self.total > 0:
+            self.feedback.setProgress(100.0 * self.numProcessed / self.total)
+
+    def addPoints(self, points):
+        features = []
+        for lon, lat, attributes in points:
+            feature = QgsFeature()
+            feature.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(lon, lat)))
+            feature.setAttributes(attributes)
+            features.append(feature)
+        self.sink.addFeatures(features, QgsFeatureSink.FastInsert)
+
+    def reportError(self, message):
+        self.numErrors += 1
+        self.feedback.reportError(message)
+
+
+class ForwardGeocodeAlgorithm(GeocodeAlgorithm):
+    '''Base class of the algorithms geocoding addresses into points.'''
+
+    MAX_RESULTS = 'MAX_RESULTS'
+    useGazetteer = True
+
+    def addForwardParameters(self):
+        self.addParameter(QgsProcessingParameterNumber(self.MAX_RESULTS, 'Maximum results per entry',
+            QgsProcessingParameterNumber.Integer, 1, False, 1, 50))
+        self.addCommonParameters()
+        self.addParameter(QgsProcessingParameterFeatureSink(self.OUTPUT, 'Geocoded points',
+            QgsProcessing.TypeVectorPoint))
+
+    def geocode(self, parameters, context, feedback, rows, total):
+        '''rows is an iterator of (url without options, source address).
+        Identical queries in a chunk are only requested once.'''
+        destId = self.prepareRun(parameters, context, feedback, FORWARD_FIELDS)
+        self.total = total
+        options = forwardOptions(self.parameterAsInt(parameters, self.MAX_RESULTS, context), self.showDetails)
+        rows = iter(rows)
+        while not feedback.isCanceled():
+            chunk = list(islice(rows, self.CHUNKSIZE))
+            if not chunk:
+                break
+            queries = {}
+            for url, address in chunk:
+                queries.setdefault(url + options, []).append(address)
+            self.dispatcher.fetchAll(queries.items(), self.addForwardResults)
+        self.finishRun()
+        return {self.OUTPUT: destId}
+
+    def addForwardResults(self, addresses, data):
+        self.advance(len(addresses))
+        try:
+            jd = loadReply(data)
+        except Exception as e:
+            for address in addresses:
+                self.reportError('{}: {}'.format(address, e))
+            return
+        for address in addresses:
+            try:
+                self.addPoints(parseForward(jd, address, self.showDetails))
+            except Exception as e:
+                self.reportError('Unable to geocode: {}'.format(e))
+
+
+class TableGeocodeAlgorithm(ForwardGeocodeAlgorithm):
+    INPUT = 'INPUT'
+    FULL = 'FULL'
+    NUMBER = 'NUMBER'
+    STREET = 'STREET'
+    CITY = 'CITY'
+    COUNTY = 'COUNTY'
+    STATE = 'STATE'
+    COUNTRY = 'COUNTRY'
+    POSTAL = 'POSTAL'
+    FREE_FORM = 'FREE_FORM'
+
+    # Parameter name, label and key of the column mapping
+    COLUMN_PARAMETERS = [(FULL, 'Full address field', 'full'), (NUMBER, 'Street number field', 'number'),
+        (STREET, 'Street name field', 'street'), (CITY, 'City field', 'city'),
+        (COUNTY, 'County field', 'county'), (STATE, 'State field', 'state'),
+        (COUNTRY, 'Country field', 'country'), (POSTAL, 'Postal code field', 'postal')]
+
+    def name(self):
+        return 'geocodetable'
+
+    def displayName(self):
+        return 'Geocode table'
+
+    def shortHelpString(self):
+        return ('Geocode the addresses of a table or vector layer. Either select the field holding the full '
+            'address or the individual address fields.')
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(QgsProcessingParameterFeatureSource(self.INPUT, 'Input address table',
+            [QgsProcessing.TypeVector]))
+        for param, label, key in self.COLUMN_PARAMETERS:
+            self.addParameter(QgsProcessingParameterField(param, label, None, self.INPUT, optional=True))
+        self.addParameter(QgsProcessingParameterBoolean(self.FREE_FORM,
+            'Combine the address fields into a free-form query', False))
+        self.addForwardParameters()
+
+    def processAlgorithm(self, parameters, context, feedback):
+        source = self.parameterAsSource(parameters, self.INPUT, context)
+        if source is None:
+            raise QgsProcessingException(self.invalidSourceError(parameters, self.INPUT))
+        fields = source.fields()
+        columns = {}
+        for param, label, key in self.COLUMN_PARAMETERS:
+            name = self.parameterAsString(parameters, param, context)
+            columns[key] = fields.lookupField(name) if name else -1
+        if columns['full'] < 0 and columns['street'] < 0 and columns['city'] < 0:
+            raise QgsProcessingException('Select the full address field or the address fields to geocode')
+        useFreeFormQuery = self.parameterAsBool(parameters, self.FREE_FORM, context)
+        searchURL = self.parameterAsString(parameters, self.URL, context).strip().rstrip('/') + '/search.php'
+
+        template = QueryTemplate(searchURL, columns, useFreeFormQuery)
+
+        def rows():
+            request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry)
+            indexes = template.fieldIndexes()
+            if indexes is not None:
+                request.setSubsetOfAttributes(indexes)
+            for feature in source.getFeatures(request):
+                yield template(feature.attributes())
+        return self.geocode(parameters, context, feedback, rows(), source.featureCount())
+
+
+class FreeFormGeocodeAlgorithm(ForwardGeocodeAlgorithm):
+    ADDRESSES = 'ADDRESSES'
+
+    def name(self):
+        return 'geocodeaddresses'
+
+    def displayName(self):
+        return 'Geocode addresses'
+
+    def shortHelpString(self):
+        return 'Geocode a list of free-form addresses, one per line.'
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(QgsProcessingParameterString(self.ADDRESSES, 'Addresses', multiLine=True))
+        self.addForwardParameters()
+
+    def processAlgorithm(self, parameters, context, feedback):
+        addresses = [line.strip() for line in self.parameterAsString(parameters, self.ADDRESSES, context).splitlines()]
+        addresses = [address for address in addresses if address]
+        searchURL = self.parameterAsString(parameters, self.URL, context).strip().rstrip('/') + '/search.php'
+        rows = ((freeFormQuery(searchURL, address), address) for address in addresses)
+        return self.geocode(parameters, context, feedback, rows, len(addresses))
+
+
+class ReverseGeocodeAlgorithm(GeocodeAlgorithm):
+    INPUT = 'INPUT'
+
+    def name(self):
+        return 'reversegeocode'
+
+    def displayName(self):
+        return 'Reverse geocode points'
+
+    def shortHelpString(self):
+        return 'Find the closest address or feature to each point of a point layer.'
+
+    def icon(self):
+        return QIcon(os.path.dirname(__file__) + '/images/reverse.png')
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(QgsProcessingParameterFeatureSource(self.INPUT, 'Input point layer',
+            [QgsProcessing.TypeVectorPoint]))
+        self.addCommonParameters()
+        self.addParameter(QgsProcessingParameterFeatureSink(self.OUTPUT, 'Reverse geocoded points',
+            QgsProcessing.TypeVectorPoint))
+
+    def processAlgorithm(self, parameters, context, feedback):
+        source = self.parameterAsSource(parameters, self.INPUT, context)
+        if source is None:
+            raise QgsProcessingException(self.invalidSourceError(parameters, self.INPUT))
+        destId = self.prepareRun(parameters, context, feedback, REVERSE_FIELDS)
+        self.total = source.featureCount()
+        reverseURL = self.nominatimURL + '/reverse.php'
+        transform = QgsCoordinateTransform(source.sourceCrs(), QgsCoordinateReferenceSystem('EPSG:4326'),
+            context.transformContext())
+
+        def failed(fid):
+            self.reportError('Feature {} has no point to reverse geocode'.format(fid))
+            self.advance()
+
+        jobs = ((reverseQuery(reverseURL, pt.y(), pt.x(), self.showDetails), (pt.x(), pt.y()))
+            for fid, pt in readPoints(source, transform, failed=failed))
+        self.dispatcher.fetchAll(jobs, self.addReverseResult)
+        self.finishRun()
+        return {self.OUTPUT: destId}
+
+    def addReverseResult(self, pt, data):
+        self.advance()
+        try:
+            attributes = parseReverse(loadReply(data), self.showDetails)
+            self.addPoints([(pt[0], pt[1], attributes)])
+        except Exception as e:
+            self.reportError('Unable to reverse geocode {}, {}: {}'.format(pt[0], pt[1], e))
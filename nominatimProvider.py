@@ -0,0 +1,51 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import os
+
+from qgis.core import QgsProcessingProvider
+from qgis.PyQt.QtCore import QSettings
+from qgis.PyQt.QtGui import QIcon
+
+from .endpointPool import pool, parseEndpoints
+from .geocodeEngine import NOMURL
+from .nominatimAlgorithms import TableGeocodeAlgorithm, FreeFormGeocodeAlgorithm, ReverseGeocodeAlgorithm
+from .rateLimiter import limiter
+
+
+class NominatimProvider(QgsProcessingProvider):
+    '''Processing provider exposing the bulk geocoding tools to the
+    Processing toolbox, the model builder and qgis_process.'''
+
+    def load(self):
+        # The settings dialog is not created when run by qgis_process
+        settings = QSettings()
+        limiter.setRate(float(settings.value('/BulkNominatim/requestsPerSecond', 0)))
+        pool.configure(settings.value('/BulkNominatim/URL', NOMURL),
+            parseEndpoints(settings.value('/BulkNominatim/endpoints', '')),
+            settings.value('/BulkNominatim/balance', ''))
+        return super(NominatimProvider, self).load()
+
+    def loadAlgorithms(self):
+        self.addAlgorithm(TableGeocodeAlgorithm())
+        self.addAlgorithm(FreeFormGeocodeAlgorithm())
+        self.addAlgorithm(ReverseGeocodeAlgorithm())
+
+    def id(self):
+        return 'bulknominatim'
+
+    def name(self):
+        return 'Bulk Nominatim'
+
+    def icon(self):
+        return QIcon(os.path.dirname(__file__) + '/images/icon.png')
+
+    def longName(self):
+        return self.name()
@@ -0,0 +1,84 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from qgis.core import QgsFeatureRequest, QgsLineString, QgsPointXY, QgsCsException
+
+# Number of points transformed at a time
+BATCHSIZE = 4096
+
+
+def transformPoints(transform, xs, ys):
+    '''Transform lists of x and y coordinates in a single call. The
+    coordinates are packed into one QgsLineString so the whole batch is
+    transformed in C++ rather than one Python call per point. Returns the
+    transformed lists with None for any point that could not be transformed.'''
+    if transform is None or transform.isShortCircuited():
+        return xs, ys
+    try:
+        line = QgsLineString(xs, ys)
+        line.transform(transform)
+        return line.xVector(), line.yVector()
+    except QgsCsException:
+        # Fall back to one point at a time to find the bad ones
+        outX = []
+        outY = []
+        for x, y in zip(xs, ys):
+            try:
+                pt = transform.transform(x, y)
+                outX.append(pt.x())
+                outY.append(pt.y())
+            except QgsCsException:
+                outX.append(None)
+                outY.append(None)
+        return outX, outY
+
+
+def readPoints(source, transform, skip=(), failed=None, batchSize=BATCHSIZE):
+    '''Generate (feature id, QgsPointXY) for the points of a point feature
+    source transformed by transform. No attributes are read and the points
+    are transformed batchSize at a time as the source is read, so the
+    output can be streamed into the request stage. Features whose id is in
+    skip are left out. failed(feature id) is called for features without a
+    point or that could not be transformed.'''
+    request = QgsFeatureRequest().setNoAttributes()
+    fids = []
+    xs = []
+    ys = []
+    for feature in source.getFeatures(request):
+        fid = feature.id()
+        if fid in skip:
+            continue
+        geom = feature.geometry()
+        if geom.isNull() or geom.isEmpty():
+            if failed is not None:
+                failed(fid)
+            continue
+        # already know that this is a point vector layer
+        pt = geom.asPoint()
+        fids.append(fid)
+        xs.append(pt.x())
+        ys.append(pt.y())
+        if len(fids) >= batchSize:
+            yield from pointBatch(transform, fids, xs, ys, failed)
+            fids = []
+            xs = []
+            ys = []
+    if fids:
+        yield from pointBatch(transform, fids, xs, ys, failed)
+
+
+def pointBatch(transform, fids, xs, ys, failed):
+    xs, ys = transformPoints(transform, xs, ys)
+    for fid, x, y in zip(fids, xs, ys):
+        if x is None:
+            if failed is not None:
+                failed(fid)
+            continue
+        yield fid, QgsPointXY(x, y)
@@ -0,0 +1,97 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
+
+
+class RateLimiter(object):
+    '''Token bucket limiting the number of requests per second sent to the
+    Nominatim server. A rate of 0 means unlimited. When the server signals
+    it is overloaded the rate is halved and then slowly raised back to the
+    configured rate as requests succeed.'''
+
+    def __init__(self, rate=0):
+        self.lock = threading.Lock()
+        self.setRate(rate)
+
+    def setRate(self, rate):
+        with self.lock:
+            self.rate = max(0.0, float(rate))
+            self.currentRate = self.rate
+            # Allow a burst of up to one second worth of requests
+            self.burst = max(1.0, self.rate)
+            self.tokens = self.burst
+            self.updated = time.monotonic()
+
+    def reserve(self):
+        '''Take a token if one is available and return 0. Otherwise return the
+        number of seconds until the next token is available.'''
+        with self.lock:
+            if self.currentRate <= 0:
+                return 0
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.currentRate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.currentRate
+
+    def wait(self):
+        '''Block the calling thread until a token is available.'''
+        while True:
+            delay = self.reserve()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    def throttled(self):
+        '''The server returned 429 or 503. Back off multiplicatively.'''
+        with self.lock:
+            if self.rate > 0:
+                self.currentRate = max(self.rate / 16.0, self.currentRate / 2.0)
+
+    def succeeded(self):
+        '''Additively recover toward the configured rate.'''
+        with self.lock:
+            if self.currentRate < self.rate:
+                self.currentRate = min(self.rate, self.currentRate + self.rate / 20.0)
+
+
+# Rate limiter shared by every request made by the plugin
+limiter = RateLimiter()
+
+# HTTP status codes that are worth retrying
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+def backoffDelay(attempt, base=1.0, cap=60.0):
+    '''Exponential backoff with full jitter for the given retry attempt
+    starting at 0.'''
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def parseRetryAfter(value):
+    '''Return the number of seconds requested by a Retry-After header value,
+    which is either a number of seconds or an HTTP date, or None.'''
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError):
+        return None
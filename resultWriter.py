@@ -0,0 +1,452 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import os
+
+from osgeo import ogr, osr
+
+from qgis.core import (QgsVectorLayer, QgsField, QgsPalLayerSettings, QgsVectorLayerSimpleLabeling,
+    QgsRectangle, QgsGeometry, QgsCoordinateTransform, QgsCoordinateReferenceSystem,
+    QgsProject, QgsVectorDataProvider, QgsMessageLog, Qgis)
+from qgis.PyQt.QtCore import Qt, QVariant, QObject, QThread, pyqtSignal
+
+from .geocodeEngine import SIMPLE_FIELDS, FORWARD_FIELDS, REVERSE_FIELDS, DRIVERS
+
+# Drivers that can hold more than one layer in a file
+MULTILAYER = ('GPKG', 'SQLite')
+
+FILE_FILTER = 'GeoPackage (*.gpkg);;SQLite (*.sqlite);;ESRI Shapefile (*.shp);;GeoJSON (*.geojson)'
+
+# Fields added to incremental output holding the source feature id and the
+# hash of the query it was geocoded with
+SOURCE_FIELDS = ['src_fid', 'src_hash']
+
+# Prefix of the fields added to the input layer when writing back to it
+WRITEBACK_PREFIX = 'nom_'
+
+
+def labelLayer(layer):
+    '''Display the display_name of each point as its label.'''
+    label = QgsPalLayerSettings()
+    label.fieldName = 'display_name'
+    label.placement= QgsPalLayerSettings.AroundPoint
+    labeling = QgsVectorLayerSimpleLabeling(label)
+    layer.setLabeling(labeling)
+    layer.setLabelsEnabled(True)
+
+
+class ResultWriter(object):
+    '''Base class of the result writers. Output features are buffered and
+    handed to write() batchSize at a time. The bounds of the written points
+    are tracked as batches are written so the extent of the output never
+    needs to be recomputed by scanning it.'''
+
+    persistent = False
+
+    def __init__(self, batchSize):
+        self.batchSize = max(1, batchSize)
+        self.buffer = []
+        self.xmin = self.ymin = float('inf')
+        self.xmax = self.ymax = float('-inf')
+
+    def addFeatures(self, features):
+        self.buffer.extend(features)
+        if len(self.buffer) >= self.batchSize:
+            self.flush()
+
+    def addRow(self, rowId, features):
+        '''Add the output features of the source row rowId.'''
+        self.addFeatures(features)
+
+    def rowFailed(self, rowId):
+        '''The source row rowId could not be geocoded.'''
+        pass
+
+    def flush(self):
+        if self.buffer:
+            self.write(self.buffer)
+            self.buffer = []
+
+    def write(self, features):
+        raise NotImplementedError
+
+    def includePoints(self, xs, ys):
+        '''Grow the tracked bounds to include the written coordinates.'''
+        if xs:
+            self.xmin = min(self.xmin, min(xs))
+            self.xmax = max(self.xmax, max(xs))
+            self.ymin = min(self.ymin, min(ys))
+            self.ymax = max(self.ymax, max(ys))
+
+    def extent(self):
+        if self.xmin > self.xmax:
+            return None
+        return QgsRectangle(self.xmin, self.ymin, self.xmax, self.ymax)
+
+
+class MemoryResultWriter(ResultWriter):
+    '''Write the geocoded points to a new memory layer.'''
+
+    def __init__(self, layerName, fieldNames, showLabels, batchSize=1000):
+        super(MemoryResultWriter, self).__init__(batchSize)
+        self.layer = QgsVectorLayer("point?crs=epsg:4326", layerName, "memory")
+        self.provider = self.layer.dataProvider()
+        self.provider.addAttributes([QgsField(name, QVariant.String) for name in fieldNames])
+        self.layer.updateFields()
+        if showLabels:
+            labelLayer(self.layer)
+
+    def description(self):
+        return 'memory layer'
+
+    def write(self, features):
+        points = [f.geometry().asPoint() for f in features]
+        self.includePoints([pt.x() for pt in points], [pt.y() for pt in points])
+        self.provider.addFeatures(features)
+
+    def finish(self):
+        '''Complete the output and return the layer to add to the project.'''
+        self.flush()
+        extent = self.extent()
+        if extent is None:
+            self.layer.updateExtents()
+        else:
+            self.layer.setExtent(extent)
+        return self.layer
+
+
+class OgrResultWriter(ResultWriter):
+    '''Write the geocoded points directly to a GeoPackage or other OGR file.
+    Features are buffered and written batchSize at a time, each batch in its
+    own transaction, so the results are on disk as the job progresses.
+
+    If incremental is set the SOURCE_FIELDS are added after fieldNames, and
+    if the file already holds an incremental output layer it is updated in
+    place rather than replaced. unchanged() tells whether a source row was
+    already geocoded with the same query so its output can be kept. The
+    output of a row is found by its source feature id and query hash or,
+    failing that, by the query hash alone, since the feature ids of
+    delimited text and memory layers are row positions that shift when a
+    row is inserted or removed. Output found by its hash is renumbered to
+    the new feature id. removeUnseen() deletes the output no row kept, of
+    rows that changed or are no longer in the source. If the existing
+    layer can not be updated, because it is missing or its fields do not
+    match, only that layer is replaced, every row is geocoded again and
+    the reason is kept in rebuilt.'''
+
+    persistent = True
+
+    def __init__(self, path, layerName, fieldNames, showLabels, batchSize=1000, incremental=False):
+        super(OgrResultWriter, self).__init__(batchSize)
+        self.path = path
+        self.displayName = layerName
+        self.showLabels = showLabels
+        self.incremental = incremental
+        # (source feature id, query hash) to the output feature ids of the
+        # rows in an existing output not yet kept
+        self.previous = {}
+        # Query hash to the source feature ids it was geocoded for
+        self.byHash = {}
+        # (output feature id, new source feature id) of kept output
+        # found by its query hash
+        self.renumbered = []
+        self.deleted = []
+        self.rebuilt = ''
+        if incremental:
+            fieldNames = list(fieldNames) + SOURCE_FIELDS
+        driverName = DRIVERS.get(os.path.splitext(path)[1].lower(), 'GPKG')
+        self.multiLayer = driverName in MULTILAYER
+        driver = ogr.GetDriverByName(driverName)
+        if driver is None:
+            raise IOError('The {} driver is not available'.format(driverName))
+        self.datasource = None
+        if incremental and os.path.exists(path):
+            self.rebuilt = self.openExisting(layerName, fieldNames)
+            if self.rebuilt:
+                QgsMessageLog.logMessage('{}: {}, so the layer is replaced and every row geocoded again'.format(
+                    path, self.rebuilt), 'Bulk Nominatim', level=Qgis.Warning)
+        if self.datasource is None:
+            self.datasource = self.createOutput(driver, layerName)
+            srs = osr.SpatialReference()
+            srs.ImportFromEPSG(4326)
+            self.layer = self.datasource.CreateLayer(layerName, srs, ogr.wkbPoint)
+            for name in fieldNames:
+                if name == 'src_fid':
+                    self.layer.CreateField(ogr.FieldDefn(name, ogr.OFTInteger64))
+                else:
+                    self.layer.CreateField(ogr.FieldDefn(name, ogr.OFTString))
+        self.layerName = self.layer.GetName()
+        self.defn = self.layer.GetLayerDefn()
+
+    def createOutput(self, driver, layerName):
+        '''Open the file for a new output layer. In a file that can hold
+        several layers only a layer of the same name is replaced and the
+        other layers are kept.'''
+        if os.path.exists(self.path):
+            datasource = ogr.Open(self.path, 1) if self.multiLayer else None
+            if datasource is not None:
+                for i in range(datasource.GetLayerCount()):
+                    if datasource.GetLayerByIndex(i).GetName().lower() == layerName.lower():
+                        if datasource.DeleteLayer(i) != 0:
+                            raise IOError('Unable to replace the layer {} in {}'.format(layerName, self.path))
+                        break
+                return datasource
+            driver.DeleteDataSource(self.path)
+        datasource = driver.CreateDataSource(self.path)
+        if datasource is None:
+            raise IOError('Unable to create {}'.format(self.path))
+        return datasource
+
+    def openExisting(self, layerName, fieldNames):
+        '''Open the output of an earlier incremental run for update if it has
+        all of the fields and load the source rows it holds. Returns why it
+        can not be updated, or an empty string.'''
+        datasource = ogr.Open(self.path, 1)
+        if datasource is None:
+            return 'the file can not be opened for update'
+        layer = datasource.GetLayerByName(layerName) if self.multiLayer else datasource.GetLayer(0)
+        if layer is None:
+            return 'there is no layer {} from an earlier run'.format(layerName)
+        if layer.GetGeomType() != ogr.wkbPoint:
+            return 'the layer {} is not a point layer'.format(layerName)
+        defn = layer.GetLayerDefn()
+        # Shapefiles truncate the field names
+        names = [defn.GetFieldDefn(i).GetName() for i in range(defn.GetFieldCount())]
+        if len(names) != len(fieldNames) or not all(f.startswith(n.lower()) for f, n in zip(fieldNames, names)):
+            return 'the fields of the layer {} do not match the requested output'.format(layerName)
+        self.fidIdx = len(fieldNames) - 2
+        hashIdx = len(fieldNames) - 1
+        layer.SetIgnoredFields(names[:self.fidIdx] + ['OGR_GEOMETRY'])
+        for feature in layer:
+            key = (feature.GetFieldAsInteger64(self.fidIdx), feature.GetFieldAsString(hashIdx))
+            fids = self.previous.get(key)
+            if fids is None:
+                self.previous[key] = [feature.GetFID()]
+                self.byHash.setdefault(key[1], []).append(key[0])
+            else:
+                fids.append(feature.GetFID())
+        layer.SetIgnoredFields([])
+        layer.ResetReading()
+        self.datasource = datasource
+        self.layer = layer
+        return ''
+
+    def unchanged(self, srcFid, queryHash):
+        '''Return True and keep the existing output of a source row if it
+        was geocoded with the same query, under this or another feature id.'''
+        fids = self.previous.pop((srcFid, queryHash), None)
+        if fids is not None:
+            return True
+        for oldFid in self.byHash.get(queryHash, ()):
+            fids = self.previous.pop((oldFid, queryHash), None)
+            if fids is not None:
+                self.renumbered.extend((fid, srcFid) for fid in fids)
+                return True
+        return False
+
+    def removeUnseen(self):
+        '''Delete the output no source row was found to be unchanged for, as
+        its row changed or is no longer in the source. Returns the number of
+        source rows of the deleted output.'''
+        removed = len(self.previous)
+        for fids in self.previous.values():
+            self.deleted.extend(fids)
+        self.previous = {}
+        self.byHash = {}
+        return removed
+
+    def flush(self):
+        if self.buffer or self.deleted or self.renumbered:
+            self.write(self.buffer)
+            self.buffer = []
+
+    def description(self):
+        return self.path
+
+    def write(self, features):
+        xs = []
+        ys = []
+        self.layer.StartTransaction()
+        for fid in self.deleted:
+            self.layer.DeleteFeature(fid)
+        self.deleted = []
+        for fid, srcFid in self.renumbered:
+            out = self.layer.GetFeature(fid)
+            if out is not None:
+                out.SetField(self.fidIdx, srcFid)
+                self.layer.SetFeature(out)
+        self.renumbered = []
+        for feature in features:
+            pt = feature.geometry().asPoint()
+            xs.append(pt.x())
+            ys.append(pt.y())
+            geom = ogr.Geometry(ogr.wkbPoint)
+            geom.AddPoint_2D(pt.x(), pt.y())
+            out = ogr.Feature(self.defn)
+            out.SetGeometry(geom)
+            for i, value in enumerate(feature.attributes()):
+                if value or isinstance(value, (int, float)):
+                    out.SetField(i, value)
+            self.layer.CreateFeature(out)
+        self.layer.CommitTransaction()
+        self.includePoints(xs, ys)
+
+    def finish(self):
+        '''Write any buffered features, close the file and return a layer
+        reading it.'''
+        if self.datasource is not None:
+            self.flush()
+            self.layer = None
+            self.defn = None
+            self.datasource = None
+        uri = self.path
+        if self.multiLayer:
+            uri = '{}|layername={}'.format(self.path, self.layerName)
+        layer = QgsVectorLayer(uri, self.displayName, 'ogr')
+        if self.showLabels:
+            labelLayer(layer)
+        return layer
+
+
+class MemoryLayerUpdater(QObject):
+    '''Apply batches of attribute and geometry changes to a memory layer in
+    the main thread. Batches emitted from a task thread are queued to the
+    thread the updater was created in.'''
+
+    batchReady = pyqtSignal(object, object)
+
+    def __init__(self, layer):
+        super(MemoryLayerUpdater, self).__init__()
+        self.layer = layer
+        self.batchReady.connect(self.apply, Qt.QueuedConnection)
+
+    def apply(self, values, geometries):
+        provider = self.layer.dataProvider()
+        provider.changeAttributeValues(values)
+        if geometries:
+            provider.changeGeometryValues(geometries)
+        self.layer.triggerRepaint()
+
+
+class SourceLayerWriter(ResultWriter):
+    '''Write the results back into the input layer instead of a new layer.
+    Fields prefixed with WRITEBACK_PREFIX holding the latitude, longitude,
+    match status and result fields of the first result of each row are
+    added to the layer, and if setGeometry is set the point geometry of
+    each feature is moved to its result. The changes are made batchSize
+    rows at a time with changeAttributeValues and changeGeometryValues
+    keyed by feature id, so no second layer or join is needed.
+
+    The fields are added in the main thread when the writer is created.
+    The writes from the task use a separate connection to the layer's data
+    source. Memory layers have no other connection and may be drawn or
+    read on the main thread at any time, so each of their batches is
+    handed to a MemoryLayerUpdater and applied on the main thread.'''
+
+    persistent = True
+
+    def __init__(self, layer, fieldNames, setGeometry, batchSize=1000):
+        super(SourceLayerWriter, self).__init__(batchSize)
+        self.layer = layer
+        self.setGeometry = setGeometry
+        provider = layer.dataProvider()
+        capabilities = provider.capabilities()
+        if not capabilities & QgsVectorDataProvider.ChangeAttributeValues:
+            raise IOError('The layer {} can not be edited'.format(layer.name()))
+        if setGeometry and not capabilities & QgsVectorDataProvider.ChangeGeometries:
+            raise IOError('The geometry of {} can not be changed'.format(layer.name()))
+        fields = [QgsField(WRITEBACK_PREFIX + 'lat', QVariant.Double), QgsField(WRITEBACK_PREFIX + 'lon', QVariant.Double),
+            QgsField(WRITEBACK_PREFIX + 'match', QVariant.String)]
+        fields.extend([QgsField(WRITEBACK_PREFIX + name, QVariant.String) for name in fieldNames if name != 'source_addr'])
+        missing = [f for f in fields if provider.fields().lookupField(f.name()) < 0]
+        if missing:
+            if not capabilities & QgsVectorDataProvider.AddAttributes:
+                raise IOError('Fields can not be added to {}'.format(layer.name()))
+            if not provider.addAttributes(missing):
+                raise IOError('Unable to add the result fields to {}'.format(layer.name()))
+            layer.updateFields()
+        providerFields = provider.fields()
+        self.latIdx, self.lonIdx, self.matchIdx = [providerFields.lookupField(f.name()) for f in fields[:3]]
+        # Index of each result attribute in the layer or -1 to skip it
+        self.attrIndexes = [providerFields.lookupField(WRITEBACK_PREFIX + name) if name != 'source_addr' else -1
+            for name in fieldNames]
+        self.resultIndexes = [i for i in self.attrIndexes if i >= 0]
+        self.transform = None
+        if setGeometry:
+            self.transform = QgsCoordinateTransform(QgsCoordinateReferenceSystem('EPSG:4326'), layer.crs(),
+                QgsProject.instance())
+        self.source = layer.source()
+        self.providerKey = layer.providerType()
+        self.target = None
+        self.writeLayer = None
+        self.updater = MemoryLayerUpdater(layer) if self.providerKey == 'memory' else None
+
+    def description(self):
+        return 'the input layer ' + self.layer.name()
+
+    def addRow(self, rowId, features):
+        if not features:
+            self.rowFailed(rowId)
+            return
+        # Only the best match is written back
+        pt = features[0].geometry().asPoint()
+        values = {self.latIdx: pt.y(), self.lonIdx: pt.x(), self.matchIdx: 'matched'}
+        for i, value in zip(self.attrIndexes, features[0].attributes()):
+            if i >= 0:
+                values[i] = value
+        self.buffer.append((rowId, values, pt))
+        if len(self.buffer) >= self.batchSize:
+            self.flush()
+
+    def rowFailed(self, rowId):
+        values = {i: None for i in self.resultIndexes}
+        values.update({self.latIdx: None, self.lonIdx: None, self.matchIdx: 'not found'})
+        self.buffer.append((rowId, values, None))
+        if len(self.buffer) >= self.batchSize:
+            self.flush()
+
+    def write(self, rows):
+        if self.updater is not None:
+            changes = {rowId: values for rowId, values, pt in rows}
+            geometries = self.geometries(rows) if self.setGeometry else {}
+            if QThread.currentThread() == self.updater.thread():
+                self.updater.apply(changes, geometries)
+            else:
+                self.updater.batchReady.emit(changes, geometries)
+            return
+        if self.target is None:
+            # Opened on first use so it belongs to the task thread
+            self.writeLayer = QgsVectorLayer(self.source, 'bulk nominatim output', self.providerKey)
+            self.target = self.writeLayer.dataProvider()
+        self.target.changeAttributeValues({rowId: values for rowId, values, pt in rows})
+        if self.setGeometry:
+            self.target.changeGeometryValues(self.geometries(rows))
+
+    def geometries(self, rows):
+        '''Map the feature id of each matched row to its result point in the
+        layer CRS.'''
+        geometries = {}
+        for rowId, values, pt in rows:
+            if pt is not None:
+                geometries[rowId] = QgsGeometry.fromPointXY(self.transform.transform(pt))
+        return geometries
+
+    def finish(self):
+        '''Write the remaining rows and refresh the input layer. There is no
+        new layer to add to the project so None is returned.'''
+        self.flush()
+        self.target = None
+        self.writeLayer = None
+        if self.updater is None:
+            self.layer.dataProvider().reloadData()
+        if self.setGeometry:
+            self.layer.updateExtents()
+        self.layer.triggerRepaint()
+        return None
@@ -9,22 +9,144 @@
  ***************************************************************************/
 """
 import os
-import re
 import json
+from collections import OrderedDict, deque
 
 from qgis.PyQt import uic
 from qgis.PyQt.QtWidgets import QDockWidget
 from qgis.PyQt.QtGui import QColor
-from qgis.PyQt.QtCore import Qt, QUrl, pyqtSignal, QByteArray, QEventLoop, QTextCodec
-from qgis.core import QgsCoordinateReferenceSystem, QgsCoordinateTransform, QgsGeometry, QgsNetworkAccessManager, QgsProject, QgsNetworkContentFetcher, QgsWkbTypes
+from qgis.PyQt.QtCore import Qt, pyqtSignal, QObject, QTimer, QSettings
+from qgis.core import (QgsCoordinateReferenceSystem, QgsCoordinateTransform, QgsGeometry, QgsNetworkAccessManager,
+    QgsProject, QgsWkbTypes, QgsCsException)
 from qgis.gui import QgsMapTool, QgsRubberBand, QgsVertexMarker
 from qgis.PyQt.QtNetwork import QNetworkRequest, QNetworkReply
 
+from .dispatcher import RETRY_ERRORS, nominatimRequest
+from .endpointPool import pool
+from .rateLimiter import limiter, RETRY_STATUS
+from .tileGrid import tileZoom, tileOf, tileCenter, tileRange, tilesNear
+
 FORM_CLASS, _ = uic.loadUiType(os.path.join(
     os.path.dirname(__file__), 'reverseGeocode.ui'))
 
+
+
+class RecentReplies(object):
+    '''In memory least recently used map of request keys to reply text.'''
+
+    def __init__(self, maxEntries=256):
+        self.maxEntries = maxEntries
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        data = self.entries.get(key)
+        if data is not None:
+            self.entries.move_to_end(key)
+        return data
+
+    def put(self, key, data):
+        self.entries[key] = data
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxEntries:
+            self.entries.popitem(last=False)
+
+
+class TilePrefetcher(QObject):
+    '''Fetch the reverse geocoding replies of map tiles in the background
+    with up to MAX_IN_FLIGHT requests outstanding, paced by the shared rate
+    limiter. fetch() puts a tile the user is waiting on at the front of the
+    queue and prefetch() replaces the rest of the queue. done(tile, url,
+    data) is called with the raw reply of each tile, empty if the request
+    failed.'''
+
+    MAX_IN_FLIGHT = 2
+
+    def __init__(self, done):
+        super(TilePrefetcher, self).__init__()
+        self.done = done
+        # (tile, url) waiting to be sent
+        self.queue = deque()
+        # Tile of each request in flight to its reply and server
+        self.replies = {}
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.issue)
+
+    def idle(self):
+        return not self.queue and not self.replies
+
+    def fetch(self, tile, url):
+        if tile in self.replies:
+            return
+        self.drop(tile)
+        self.queue.appendleft((tile, url))
+        self.issue()
+
+    def drop(self, tile):
+        '''Remove a tile from the queue if it has not been sent yet.'''
+        self.queue = deque(job for job in self.queue if job[0] != tile)
+
+    def prefetch(self, jobs):
+        '''Replace the queued tiles with jobs, a list of (tile, url).'''
+        self.queue = deque(job for job in jobs if job[0] not in self.replies)
+        self.issue()
+
+    def cancel(self):
+        '''Drop the queued tiles and abort the requests in flight.'''
+        self.queue.clear()
+        self.timer.stop()
+        for reply, endpoint in self.replies.values():
+            reply.finished.disconnect()
+            reply.abort()
+            reply.deleteLater()
+            pool.release(endpoint, True)
+        self.replies.clear()
+
+    def issue(self):
+        while self.queue and len(self.replies) < self.MAX_IN_FLIGHT:
+            delay = limiter.reserve()
+            if delay > 0:
+                self.timer.start(max(1, int(delay * 1000)))
+                return
+            tile, url = self.queue.popleft()
+            target, endpoint = pool.route(url)
+            reply = QgsNetworkAccessManager.instance().get(nominatimRequest(target))
+            self.replies[tile] = (reply, endpoint)
+            reply.finished.connect(lambda tile=tile, url=url: self.replyFinished(tile, url))
+
+    def replyFinished(self, tile, url):
+        reply, endpoint = self.replies.pop(tile)
+        status = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+        pool.release(endpoint, status not in RETRY_STATUS and reply.error() not in RETRY_ERRORS)
+        data = bytes(reply.readAll()) if reply.error() == QNetworkReply.NoError else b''
+        reply.deleteLater()
+        self.done(tile, url, data)
+        self.issue()
+
     
 class ReverseGeocodeTool(QgsMapTool):
+    '''Reverse geocode the point clicked on the map canvas. Requests are
+    sent asynchronously so the canvas stays responsive, and a click made
+    while a request is in flight aborts it so an older reply can never
+    replace the address of a newer click. Replies of recent clicks are kept
+    in memory, in front of the plugin's reply cache.
+
+    In hover mode the location under the cursor is reverse geocoded once
+    the mouse has rested for HOVER_DELAY milliseconds. Hover lookups are
+    made at the center of the map tile under the cursor, so every point of
+    a tile shares one reply, and the tiles of the visible extent nearest to
+    its center are prefetched in the background, up to the prefetch budget
+    of requests each time the view changes.'''
+
+    # Replies of recent clicks and tiles kept in memory
+    RECENT = 4096
+    # Milliseconds the mouse must rest before the hover lookup
+    HOVER_DELAY = 250
+    # Milliseconds the view must stay still before prefetching
+    PREFETCH_DELAY = 500
+    # Nothing is prefetched if the view covers more than this many times
+    # the budget in tiles, as the budget would only cover a small part of it.
+    PREFETCH_COVERAGE = 16
 
     def __init__(self, iface, settings):
         self.canvas = iface.mapCanvas()
@@ -36,6 +158,26 @@ class ReverseGeocodeTool(QgsMapTool):
         self.reverseGeoCodeDialog.hide()
         self.epsg4326 = QgsCoordinateReferenceSystem('EPSG:4326')
         self.marker = None
+        self.recent = RecentReplies(self.RECENT)
+        # The request in flight, its url and the server it was sent to
+        self.reply = None
+        self.replyUrl = None
+        self.endpoint = None
+        self.hoverMode = False
+        self.hoverPos = None
+        self.hoverTile = None
+        self.hoverTimer = QTimer(self)
+        self.hoverTimer.setSingleShot(True)
+        self.hoverTimer.setInterval(self.HOVER_DELAY)
+        self.hoverTimer.timeout.connect(self.hoverLookup)
+        self.prefetchTimer = QTimer(self)
+        self.prefetchTimer.setSingleShot(True)
+        self.prefetchTimer.setInterval(self.PREFETCH_DELAY)
+        self.prefetchTimer.timeout.connect(self.prefetch)
+        self.prefetcher = TilePrefetcher(self.tileReady)
+        self.canvas.extentsChanged.connect(self.viewChanged)
+        self.reverseGeoCodeDialog.hoverCheckBox.setChecked(
+            bool(int(QSettings().value('/BulkNominatim/hoverMode', 0))))
         
         # Set up a polygon/line rubber band
         self.rubber = QgsRubberBand(self.canvas)
@@ -47,8 +189,16 @@ class ReverseGeocodeTool(QgsMapTool):
         '''When activated set the cursor to a crosshair.'''
         self.canvas.setCursor(Qt.CrossCursor)
         self.show()
+        self.viewChanged()
+
+    def deactivate(self):
+        self.stopHover()
+        QgsMapTool.deactivate(self)
         
     def unload(self):
+        self.abortRequest()
+        self.stopHover()
+        self.canvas.extentsChanged.disconnect(self.viewChanged)
         self.iface.removeDockWidget(self.reverseGeoCodeDialog)
         self.reverseGeoCodeDialog = None
         if self.rubber:
@@ -89,25 +239,190 @@ class ReverseGeocodeTool(QgsMapTool):
         self.reverseGeoCodeDialog.show()
         
     def request(self, url):
-        fetcher = QgsNetworkContentFetcher()
-        fetcher.fetchContent(QUrl(url))
-        evloop = QEventLoop()
-        fetcher.finished.connect(evloop.quit)
-        evloop.exec_(QEventLoop.ExcludeUserInputEvents)
-        fetcher.finished.disconnect(evloop.quit)
-        return fetcher.contentAsString()
+        '''Send url without waiting for the reply, aborting any request
+        still in flight.'''
+        self.abortRequest()
+        # Share the kept alive connections of the bulk requests
+        target, self.endpoint = pool.route(url)
+        self.replyUrl = url
+        self.reply = QgsNetworkAccessManager.instance().get(nominatimRequest(target))
+        self.reply.finished.connect(lambda reply=self.reply: self.replyFinished(reply))
+
+    def abortRequest(self):
+        if self.reply is None:
+            return
+        reply = self.reply
+        self.reply = None
+        reply.finished.disconnect()
+        reply.abort()
+        reply.deleteLater()
+        # Abandoning a request says nothing about the server's health
+        pool.release(self.endpoint, True)
+        self.endpoint = None
+
+    def replyFinished(self, reply):
+        if reply is not self.reply:
+            # A stale reply of a request already replaced by a newer click
+            reply.deleteLater()
+            return
+        self.reply = None
+        status = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+        pool.release(self.endpoint, status not in RETRY_STATUS and reply.error() not in RETRY_ERRORS)
+        self.endpoint = None
+        data = bytes(reply.readAll()).decode('utf-8', errors='replace')
+        reply.deleteLater()
+        if reply.error() == QNetworkReply.NoError:
+            self.remember(self.replyUrl, data)
+        self.showReply(data)
+
+    def remember(self, url, data, flush=True):
+        '''Keep a reply that decodes in memory and in the reply cache.'''
+        try:
+            json.loads(data)
+        except ValueError:
+            return
+        self.recent.put(self.settings.cache.key(url), data)
+        cache = self.settings.cache if self.settings.cache.enabled else None
+        if cache:
+            cache.put(url, data)
+            if flush:
+                cache.flush()
+
+    def cachedReply(self, url):
+        '''Return the reply for url from memory or the reply cache, or None.'''
+        # Nearby points share an entry as in the reply cache
+        key = self.settings.cache.key(url)
+        jsondata = self.recent.get(key)
+        if jsondata is None:
+            cache = self.settings.cache if self.settings.cache.enabled else None
+            jsondata = cache.get(url) if cache else None
+            if jsondata is not None:
+                self.recent.put(key, jsondata)
+        return jsondata
+
+    def reverseUrl(self, lon, lat):
+        return '{}?format=json&lat={:f}&lon={:f}&zoom={:d}&addressdetails=0&polygon_text=1'.format(self.settings.reverseURL(), lat, lon, self.settings.levelOfDetail)
+
+    def toLonLat(self, pos):
+        '''Transform a canvas position to EPSG:4326.'''
+        pt = self.toMapCoordinates(pos)
+        canvasCRS = self.canvas.mapSettings().destinationCrs()
+        transform = QgsCoordinateTransform(canvasCRS, self.epsg4326, QgsProject.instance())
+        pt = transform.transform(pt.x(), pt.y())
+        return pt.x(), pt.y()
         
     def canvasReleaseEvent(self, event):
         # Make sure the point is transfored to 4326
         self.clearSelection()
-        pt = self.toMapCoordinates(event.pos())
+        lon, lat = self.toLonLat(event.pos())
+        url = self.reverseUrl(lon, lat)
+        # print( url )
+        if not self.reverseGeoCodeDialog.isVisible():
+            self.show()
+        # A click takes over from the hover lookup until the mouse moves on
+        self.hoverTimer.stop()
+        if self.hoverTile is not None:
+            self.prefetcher.drop(self.hoverTile)
+        self.hoverTile = None
+        jsondata = self.cachedReply(url)
+        if jsondata is None:
+            self.setText('Looking up address...')
+            self.request(url)
+            return
+        # The reply of an earlier click must not replace this one
+        self.abortRequest()
+        self.showReply(jsondata)
+
+    def setHoverMode(self, enabled):
+        self.hoverMode = enabled
+        QSettings().setValue('/BulkNominatim/hoverMode', int(enabled))
+        if enabled:
+            self.viewChanged()
+        else:
+            self.stopHover()
+
+    def stopHover(self):
+        self.hoverTimer.stop()
+        self.prefetchTimer.stop()
+        self.prefetcher.cancel()
+        self.hoverTile = None
+
+    def canvasMoveEvent(self, event):
+        if self.hoverMode:
+            # Restarting the timer on each move debounces the lookups
+            self.hoverPos = event.pos()
+            self.hoverTimer.start()
+
+    def hoverTarget(self, lon, lat):
+        '''Return the tile containing lon, lat and the url of its center.'''
+        zoom = tileZoom(self.settings.levelOfDetail)
+        x, y = tileOf(lon, lat, zoom)
+        return (zoom, x, y), self.reverseUrl(*tileCenter(x, y, zoom))
+
+    def hoverLookup(self):
+        if not self.hoverMode or self.hoverPos is None:
+            return
+        try:
+            tile, url = self.hoverTarget(*self.toLonLat(self.hoverPos))
+        except QgsCsException:
+            return
+        if tile == self.hoverTile:
+            return
+        self.hoverTile = tile
+        if not self.reverseGeoCodeDialog.isVisible():
+            self.show()
+        self.clearSelection()
+        jsondata = self.cachedReply(url)
+        if jsondata is None:
+            self.setText('Looking up address...')
+            self.prefetcher.fetch(tile, url)
+        else:
+            self.showReply(jsondata)
+
+    def tileReady(self, tile, url, data):
+        '''Called with the reply of a hover or prefetch request.'''
+        if data:
+            self.remember(url, data, self.prefetcher.idle())
+        if tile == self.hoverTile:
+            self.clearSelection()
+            self.showReply(data)
+
+    def viewChanged(self):
+        if self.hoverMode and self.canvas.mapTool() is self:
+            self.prefetchTimer.start()
+
+    def prefetch(self):
+        '''Queue the uncached tiles of the visible extent nearest to its
+        center, up to the prefetch budget.'''
+        budget = self.settings.prefetchBudget
+        if not self.hoverMode or self.canvas.mapTool() is not self or budget <= 0:
+            return
         canvasCRS = self.canvas.mapSettings().destinationCrs()
         transform = QgsCoordinateTransform(canvasCRS, self.epsg4326, QgsProject.instance())
-        pt = transform.transform(pt.x(), pt.y())
-        url = '{}?format=json&lat={:f}&lon={:f}&zoom={:d}&addressdetails=0&polygon_text=1'.format(self.settings.reverseURL(), pt.y(), pt.x(), self.settings.levelOfDetail)
-        # print( url )
-        jsondata = self.request(url)
+        try:
+            extent = transform.transformBoundingBox(self.canvas.extent())
+            center = transform.transform(self.canvas.center())
+        except QgsCsException:
+            return
+        zoom = tileZoom(self.settings.levelOfDetail)
+        x0, y0, x1, y1 = tileRange(extent.xMinimum(), extent.yMinimum(), extent.xMaximum(), extent.yMaximum(), zoom)
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > budget * self.PREFETCH_COVERAGE:
+            self.prefetcher.prefetch([])
+            return
+        x, y = tileOf(center.x(), center.y(), zoom)
+        jobs = []
+        for tx, ty in tilesNear(x, y, x0, y0, x1, y1, budget * self.PREFETCH_COVERAGE):
+            url = self.reverseUrl(*tileCenter(tx, ty, zoom))
+            if self.cachedReply(url) is None:
+                jobs.append(((zoom, tx, ty), url))
+                if len(jobs) >= budget:
+                    break
+        self.prefetcher.prefetch(jobs)
 
+    def showReply(self, jsondata):
+        '''Show the address and outline of a reverse geocoding reply.'''
+        if isinstance(jsondata, bytes):
+            jsondata = jsondata.decode('utf-8', errors='replace')
         try:
             jd = json.loads(jsondata)
             try:
@@ -137,10 +452,6 @@ class ReverseGeocodeTool(QgsMapTool):
         except Exception:
             self.setText("Error: "+jsondata)
 
-
-        if not self.reverseGeoCodeDialog.isVisible():
-            self.show()
-
     def setText(self, text):
         self.reverseGeoCodeDialog.addressLineEdit.setText(text)
 
@@ -152,8 +463,10 @@ class ReverseGeocodeDialog(QDockWidget, FORM_CLASS):
         super(ReverseGeocodeDialog, self).__init__(parent)
         self.setupUi(self)
         self.tool = tool
+        self.hoverCheckBox.toggled.connect(tool.setHoverMode)
 
     def closeEvent(self, event):
+        self.tool.abortRequest()
         self.tool.clearSelection()
         self.closingPlugin.emit()
         event.accept()
@@ -0,0 +1,172 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import csv
+import json
+import time
+import bisect
+import threading
+
+# Phases each request is timed in. queue is the time waiting for the rate
+# limiter or a retry, connect is opening a connection including the DNS
+# lookup and TLS handshake, server is from sending the request to receiving
+# the reply headers, network is the rest of the time until the whole reply
+# is received, parse is decoding the reply and write is adding the output
+# features. QNetworkReply does not report the connect and server time so
+# the requests of the plugin tools include them in network. Only the
+# headless engine, which opens its own connections, times them separately.
+PHASES = ('queue', 'connect', 'server', 'network', 'parse', 'write')
+
+# Upper bounds of the histogram buckets in milliseconds
+BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000)
+
+
+class Histogram(object):
+    '''Fixed bucket histogram of durations in milliseconds.'''
+
+    def __init__(self):
+        self.counts = [0] * (len(BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, msec):
+        self.counts[bisect.bisect_left(BOUNDS, msec)] += 1
+        self.count += 1
+        self.total += msec
+        if msec > self.max:
+            self.max = msec
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, p):
+        '''Estimate a percentile as the upper bound of the bucket it falls in.'''
+        if not self.count:
+            return 0.0
+        rank = p / 100.0 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return round(min(BOUNDS[i], self.max) if i < len(BOUNDS) else self.max, 3)
+        return round(self.max, 3)
+
+    def toDict(self):
+        buckets = {}
+        for i, n in enumerate(self.counts):
+            label = 'le_{}ms'.format(BOUNDS[i]) if i < len(BOUNDS) else 'gt_{}ms'.format(BOUNDS[-1])
+            buckets[label] = n
+        return {'count': self.count, 'total_ms': round(self.total, 3), 'mean_ms': round(self.mean(), 3),
+            'p50_ms': self.percentile(50), 'p95_ms': self.percentile(95), 'p99_ms': self.percentile(99),
+            'max_ms': round(self.max, 3), 'histogram': buckets}
+
+
+class RunStats(object):
+    '''Timing statistics of a geocoding job. The phases of each request are
+    added to per phase histograms and the number of completed rows gives the
+    throughput and an estimated time to completion. add() may be called from
+    several threads.'''
+
+    def __init__(self, job=''):
+        self.job = job
+        self.lock = threading.Lock()
+        self.phases = {phase: Histogram() for phase in PHASES}
+        self.counters = {}
+        self.info = {}
+        self.started = time.time()
+        self.start = time.monotonic()
+        self.stopped = None
+        self.rows = 0
+
+    def add(self, phase, seconds):
+        with self.lock:
+            self.phases[phase].add(seconds * 1000.0)
+
+    def rowsDone(self, count=1):
+        self.rows += count
+
+    def stop(self):
+        self.stopped = time.monotonic()
+
+    def elapsed(self):
+        return (self.stopped or time.monotonic()) - self.start
+
+    def throughput(self):
+        elapsed = self.elapsed()
+        return self.rows / elapsed if elapsed > 0 else 0.0
+
+    def eta(self, total):
+        '''Estimated seconds until total rows are done, or None.'''
+        rate = self.throughput()
+        if rate <= 0 or total <= 0:
+            return None
+        return max(0.0, (total - self.rows) / rate)
+
+    def status(self, total):
+        '''One line description of the progress for display during a run.'''
+        text = '{} of {} rows, {:.1f} rows/s'.format(self.rows, total, self.throughput())
+        eta = self.eta(total)
+        if eta is not None:
+            text += ', {} remaining'.format(formatDuration(eta))
+        return text
+
+    def summary(self):
+        '''Lines summarizing the run for the results window.'''
+        lines = ['Elapsed Time: {}'.format(formatDuration(self.elapsed())),
+            'Throughput: {:.1f} rows/s'.format(self.throughput())]
+        for phase in PHASES:
+            h = self.phases[phase]
+            if h.count:
+                lines.append('{} time: mean {:.1f} ms, p50 {:.1f} ms, p95 {:.1f} ms, p99 {:.1f} ms'.format(
+                    phase.capitalize(), h.mean(), h.percentile(50), h.percentile(95), h.percentile(99)))
+        return lines
+
+    def toDict(self):
+        return {
+            'job': self.job,
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+            'elapsed_s': round(self.elapsed(), 3),
+            'rows': self.rows,
+            'rows_per_sec': round(self.throughput(), 3),
+            'info': self.info,
+            'counters': self.counters,
+            'phases': {phase: self.phases[phase].toDict() for phase in PHASES}}
+
+    def export(self, path):
+        '''Write the statistics to path as CSV if it ends in .csv or else JSON.'''
+        if path.lower().endswith('.csv'):
+            self.exportCsv(path)
+        else:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(self.toDict(), f, indent=2)
+
+    def exportCsv(self, path):
+        '''One row per phase with the run totals repeated on each row.'''
+        d = self.toDict()
+        buckets = list(self.phases[PHASES[0]].toDict()['histogram'].keys())
+        counters = sorted(self.counters.keys())
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['job', 'started', 'elapsed_s', 'rows', 'rows_per_sec'] + counters +
+                ['phase', 'count', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms'] + buckets)
+            for phase in PHASES:
+                p = d['phases'][phase]
+                writer.writerow([d['job'], d['started'], d['elapsed_s'], d['rows'], d['rows_per_sec']] +
+                    [self.counters[c] for c in counters] +
+                    [phase, p['count'], p['mean_ms'], p['p50_ms'], p['p95_ms'], p['p99_ms'], p['max_ms']] +
+                    [p['histogram'][b] for b in buckets])
+
+
+def formatDuration(seconds):
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return '{}:{:02d}:{:02d}'.format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+    return '{}:{:02d}'.format(seconds // 60, seconds % 60)
@@ -10,11 +10,16 @@
 """
 import os
 
+from qgis.core import QgsApplication
 from qgis.PyQt import uic
-from qgis.PyQt.QtCore import QSettings
-from qgis.PyQt.QtWidgets import QDialog, QDialogButtonBox
+from qgis.PyQt.QtCore import QSettings, Qt
+from qgis.PyQt.QtWidgets import QApplication, QDialog, QDialogButtonBox, QFileDialog, QMessageBox
 
-NOMURL = 'https://nominatim.openstreetmap.org'
+from .endpointPool import pool, parseEndpoints, STRATEGIES
+from .gazetteer import Gazetteer
+from .geocodeCache import GeocodeCache
+from .geocodeEngine import NOMURL
+from .rateLimiter import limiter
 
 FORM_CLASS, _ = uic.loadUiType(os.path.join(
     os.path.dirname(__file__), 'settings.ui'))
@@ -25,18 +30,66 @@ class SettingsWidget(QDialog, FORM_CLASS):
         super(SettingsWidget, self).__init__(parent)
         self.setupUi(self)
         self.buttonBox.button(QDialogButtonBox.RestoreDefaults).clicked.connect(self.restore)
+        self.clearCacheButton.clicked.connect(self.clearCache)
+        self.importExtractButton.clicked.connect(self.importExtract)
+        self.importCacheButton.clicked.connect(self.importCache)
+        self.clearGazetteerButton.clicked.connect(self.clearGazetteer)
         settings = QSettings()
         self.nominatimURL = settings.value('/BulkNominatim/URL', NOMURL)
+        self.endpoints = settings.value('/BulkNominatim/endpoints', '')
+        self.balance = settings.value('/BulkNominatim/balance', STRATEGIES[0])
         self.maxAddress = int(settings.value('/BulkNominatim/maxAddress', 100))
         self.levelOfDetail = int(settings.value('/BulkNominatim/levelOfDetail', 18))
+        self.snapTolerance = float(settings.value('/BulkNominatim/snapTolerance', 0))
+        self.prefetchBudget = int(settings.value('/BulkNominatim/prefetchBudget', 50))
+        self.maxConcurrent = int(settings.value('/BulkNominatim/maxConcurrent', 4))
+        self.requestsPerSecond = float(settings.value('/BulkNominatim/requestsPerSecond', 0))
+        self.maxRetries = int(settings.value('/BulkNominatim/maxRetries', 5))
+        self.writeBatchSize = int(settings.value('/BulkNominatim/writeBatchSize', 1000))
+        self.streamingMode = int(settings.value('/BulkNominatim/streamingMode', 0))
+        self.chunkSize = int(settings.value('/BulkNominatim/chunkSize', 1000))
+        self.cacheEnabled = int(settings.value('/BulkNominatim/cacheEnabled', 1))
+        self.cacheDays = int(settings.value('/BulkNominatim/cacheDays', 30))
+        self.cacheSize = int(settings.value('/BulkNominatim/cacheSize', 500000))
+        self.cachePrecision = int(settings.value('/BulkNominatim/cachePrecision', 5))
+        self.gazetteerEnabled = int(settings.value('/BulkNominatim/gazetteerEnabled', 0))
+        self.gazetteerOffline = int(settings.value('/BulkNominatim/gazetteerOffline', 0))
         self.nomServiceLineEdit.setText(self.nominatimURL)
+        self.endpointsTextEdit.setPlainText(self.endpoints)
+        self.balanceComboBox.setCurrentIndex(STRATEGIES.index(self.balance) if self.balance in STRATEGIES else 0)
+        self.configurePool()
         self.maxRequestSpinBox.setValue(self.maxAddress)
+        self.snapSpinBox.setValue(self.snapTolerance)
+        self.prefetchSpinBox.setValue(self.prefetchBudget)
+        self.concurrentSpinBox.setValue(self.maxConcurrent)
+        self.rateSpinBox.setValue(self.requestsPerSecond)
+        self.retriesSpinBox.setValue(self.maxRetries)
+        self.batchSpinBox.setValue(self.writeBatchSize)
+        self.streamingGroupBox.setChecked(bool(self.streamingMode))
+        self.chunkSpinBox.setValue(self.chunkSize)
+        limiter.setRate(self.requestsPerSecond)
+        self.cacheGroupBox.setChecked(bool(self.cacheEnabled))
+        self.cacheDaysSpinBox.setValue(self.cacheDays)
+        self.cacheSizeSpinBox.setValue(self.cacheSize)
+        self.cachePrecisionSpinBox.setValue(self.cachePrecision)
+        self.cache = GeocodeCache(os.path.join(QgsApplication.qgisSettingsDirPath(), 'bulknominatim', 'cache.sqlite'))
+        self.configureCache()
+        self.gazetteerGroupBox.setChecked(bool(self.gazetteerEnabled))
+        self.gazetteerOfflineCheckBox.setChecked(bool(self.gazetteerOffline))
+        self.gazetteer = Gazetteer(os.path.join(QgsApplication.qgisSettingsDirPath(), 'bulknominatim', 'gazetteer.sqlite'))
+        self.configureGazetteer()
+        self.showGazetteerCount()
         
     def accept(self):
         '''Accept the settings and save them for next time.'''
         settings = QSettings()
         self.nominatimURL = self.nomServiceLineEdit.text().strip()
         settings.setValue('/BulkNominatim/URL', self.nominatimURL)
+        self.endpoints = self.endpointsTextEdit.toPlainText().strip()
+        settings.setValue('/BulkNominatim/endpoints', self.endpoints)
+        self.balance = STRATEGIES[self.balanceComboBox.currentIndex()]
+        settings.setValue('/BulkNominatim/balance', self.balance)
+        self.configurePool()
         try:
             self.maxAddress = self.maxRequestSpinBox.value()
         except:
@@ -45,15 +98,111 @@ class SettingsWidget(QDialog, FORM_CLASS):
         settings.setValue('/BulkNominatim/maxAddress', self.maxAddress)
         self.levelOfDetail = self.detailSpinBox.value()
         settings.setValue('/BulkNominatim/levelOfDetail', self.levelOfDetail)
+        self.snapTolerance = self.snapSpinBox.value()
+        settings.setValue('/BulkNominatim/snapTolerance', self.snapTolerance)
+        self.prefetchBudget = self.prefetchSpinBox.value()
+        settings.setValue('/BulkNominatim/prefetchBudget', self.prefetchBudget)
+        self.maxConcurrent = self.concurrentSpinBox.value()
+        settings.setValue('/BulkNominatim/maxConcurrent', self.maxConcurrent)
+        self.requestsPerSecond = self.rateSpinBox.value()
+        settings.setValue('/BulkNominatim/requestsPerSecond', self.requestsPerSecond)
+        limiter.setRate(self.requestsPerSecond)
+        self.maxRetries = self.retriesSpinBox.value()
+        settings.setValue('/BulkNominatim/maxRetries', self.maxRetries)
+        self.writeBatchSize = self.batchSpinBox.value()
+        settings.setValue('/BulkNominatim/writeBatchSize', self.writeBatchSize)
+        self.streamingMode = int(self.streamingGroupBox.isChecked())
+        settings.setValue('/BulkNominatim/streamingMode', self.streamingMode)
+        self.chunkSize = self.chunkSpinBox.value()
+        settings.setValue('/BulkNominatim/chunkSize', self.chunkSize)
+        self.cacheEnabled = int(self.cacheGroupBox.isChecked())
+        settings.setValue('/BulkNominatim/cacheEnabled', self.cacheEnabled)
+        self.cacheDays = self.cacheDaysSpinBox.value()
+        settings.setValue('/BulkNominatim/cacheDays', self.cacheDays)
+        self.cacheSize = self.cacheSizeSpinBox.value()
+        settings.setValue('/BulkNominatim/cacheSize', self.cacheSize)
+        self.cachePrecision = self.cachePrecisionSpinBox.value()
+        settings.setValue('/BulkNominatim/cachePrecision', self.cachePrecision)
+        self.configureCache()
+        self.gazetteerEnabled = int(self.gazetteerGroupBox.isChecked())
+        settings.setValue('/BulkNominatim/gazetteerEnabled', self.gazetteerEnabled)
+        self.gazetteerOffline = int(self.gazetteerOfflineCheckBox.isChecked())
+        settings.setValue('/BulkNominatim/gazetteerOffline', self.gazetteerOffline)
+        self.configureGazetteer()
         self.close()
         
     def restore(self):
         self.nomServiceLineEdit.setText(NOMURL)
+        self.endpointsTextEdit.setPlainText('')
+        self.balanceComboBox.setCurrentIndex(0)
         self.maxRequestSpinBox.setValue(100)
         self.detailSpinBox.setValue(18)
+        self.snapSpinBox.setValue(0)
+        self.prefetchSpinBox.setValue(50)
+        self.concurrentSpinBox.setValue(4)
+        self.rateSpinBox.setValue(0)
+        self.retriesSpinBox.setValue(5)
+        self.batchSpinBox.setValue(1000)
+        self.streamingGroupBox.setChecked(False)
+        self.chunkSpinBox.setValue(1000)
+        self.cacheGroupBox.setChecked(True)
+        self.cacheDaysSpinBox.setValue(30)
+        self.cacheSizeSpinBox.setValue(500000)
+        self.cachePrecisionSpinBox.setValue(5)
+        self.gazetteerGroupBox.setChecked(False)
+        self.gazetteerOfflineCheckBox.setChecked(False)
+
+    def configurePool(self):
+        pool.configure(self.nominatimURL, parseEndpoints(self.endpoints), self.balance)
+
+    def configureCache(self):
+        self.cache.configure(bool(self.cacheEnabled), self.cacheDays*86400, self.cacheSize, self.cachePrecision)
+
+    def clearCache(self):
+        self.cache.clear()
+
+    def configureGazetteer(self):
+        self.gazetteer.configure(bool(self.gazetteerEnabled), bool(self.gazetteerOffline))
+
+    def showGazetteerCount(self):
+        places, queries = self.gazetteer.count()
+        self.gazetteerCountLabel.setText('Places: {}, Searches: {}'.format(places, queries))
+
+    def runImport(self, description, importer):
+        '''Run a gazetteer import showing a busy cursor and report the result.'''
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        try:
+            count = importer()
+        except Exception as e:
+            QApplication.restoreOverrideCursor()
+            QMessageBox.warning(self, 'Offline Gazetteer', 'Import failed: {}'.format(e))
+            return
+        finally:
+            # The import ran on this thread's connection
+            self.gazetteer.close()
+        QApplication.restoreOverrideCursor()
+        self.showGazetteerCount()
+        QMessageBox.information(self, 'Offline Gazetteer', '{} {} imported'.format(count, description))
+
+    def importExtract(self):
+        path, _ = QFileDialog.getOpenFileName(self, 'Import Address Extract', '',
+            'Address extracts (*.csv *.tsv *.txt *.json *.jsonl);;All files (*)')
+        if path:
+            self.runImport('places', lambda: self.gazetteer.importFile(path))
+
+    def importCache(self):
+        self.runImport('searches', lambda: self.gazetteer.importReplies(self.cache.entries()))
+
+    def clearGazetteer(self):
+        self.gazetteer.clear()
+        self.gazetteer.close()
+        self.showGazetteerCount()
 
     def searchURL(self):
         return self.nominatimURL + '/search.php'
         
     def reverseURL(self):
         return self.nominatimURL + '/reverse.php'
+
+    def lookupURL(self):
+        return self.nominatimURL + '/lookup.php'
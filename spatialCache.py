@@ -0,0 +1,78 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import math
+
+# Approximate length of a degree of latitude in meters
+METERS_PER_DEGREE = 111320.0
+
+
+class SpatialCache(object):
+    '''Grid hash of values stored at EPSG:4326 points. find() returns the
+    value stored nearest to a point if it is within tolerance meters, so
+    nearby points can share the result of an earlier reverse geocode. The
+    grid cells are tolerance meters on a side so only the 3x3 cells around
+    a point need to be searched.'''
+
+    def __init__(self, tolerance):
+        self.tolerance = float(tolerance)
+        self.cellLat = self.tolerance / METERS_PER_DEGREE
+        self.cells = {}
+        self.hits = 0
+        self.misses = 0
+
+    def cellLon(self, row):
+        '''Width of the cells in row in degrees of longitude.'''
+        lat = min(89.9, abs((row + 0.5) * self.cellLat))
+        return self.cellLat / max(0.01, math.cos(math.radians(lat)))
+
+    def key(self, lon, lat):
+        row = int(math.floor(lat / self.cellLat))
+        return row, int(math.floor(lon / self.cellLon(row)))
+
+    def distance(self, lon1, lat1, lon2, lat2):
+        '''Equirectangular distance in meters, accurate at these distances.'''
+        x = (lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2.0))
+        return math.hypot(x, lat2 - lat1) * METERS_PER_DEGREE
+
+    def find(self, lon, lat):
+        '''Return the value nearest to lon, lat within tolerance or None.'''
+        best = None
+        bestDistance = self.tolerance
+        row = int(math.floor(lat / self.cellLat))
+        for r in (row - 1, row, row + 1):
+            col = int(math.floor(lon / self.cellLon(r)))
+            for c in (col - 1, col, col + 1):
+                for x, y, value in self.cells.get((r, c), ()):
+                    d = self.distance(lon, lat, x, y)
+                    if d <= bestDistance:
+                        best = value
+                        bestDistance = d
+        if best is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return best
+
+    def add(self, lon, lat, value):
+        self.cells.setdefault(self.key(lon, lat), []).append((lon, lat, value))
+
+    def discard(self, lon, lat, value):
+        '''Remove a value added at lon, lat.'''
+        key = self.key(lon, lat)
+        entries = [e for e in self.cells.get(key, []) if e[2] is not value]
+        if entries:
+            self.cells[key] = entries
+        else:
+            self.cells.pop(key, None)
+
+    def hitRate(self):
+        total = self.hits + self.misses
+        return 100.0 * self.hits / total if total else 0.0
@@ -0,0 +1,15 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+Tests of the modules that do not depend on QGIS. Run them from the plugin
+directory with make test or
+
+    python3 -m unittest discover -s tests -t ..
+"""
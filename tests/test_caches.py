@@ -0,0 +1,102 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from ..geocodeCache import GeocodeCache
+from ..spatialCache import SpatialCache
+from ..tileGrid import tileOf, tileCenter, tileRange, tilesNear, tileZoom, MAX_ZOOM
+
+
+class GeocodeCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = GeocodeCache(os.path.join(self.directory, 'cache', 'cache.sqlite'))
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.directory)
+
+    def testKey(self):
+        self.assertEqual(self.cache.key('https://H.org/reverse.php?lon=2.1234567&lat=1.0&format=json'),
+            self.cache.key('https://h.org/reverse.php?format=json&lat=1.000001&lon=2.123459'))
+        self.assertNotEqual(self.cache.key('https://h.org/search.php?q=a'),
+            self.cache.key('https://h2.org/search.php?q=a'))
+
+    def testExpiry(self):
+        self.cache.put('http://h/search.php?q=a', '[1]')
+        self.assertEqual(self.cache.get('http://h/search.php?q=a'), '[1]')
+        self.cache.ttl = 0
+        time.sleep(0.01)
+        self.assertIsNone(self.cache.get('http://h/search.php?q=a'))
+
+    def testLeastRecentlyUsedEvicted(self):
+        self.cache.maxEntries = 2
+        for q in 'abc':
+            self.cache.put('http://h/search.php?q=' + q, q)
+            time.sleep(0.01)
+        self.cache.get('http://h/search.php?q=a')
+        self.cache.flush()
+        self.assertEqual(sorted(data for url, data in self.cache.entries()), ['a', 'c'])
+
+    def testDisabled(self):
+        self.cache.configure(False, 3600, 10, 5)
+        self.cache.put('http://h/search.php?q=a', 'a')
+        self.assertIsNone(self.cache.get('http://h/search.php?q=a'))
+
+
+class SpatialCacheTest(unittest.TestCase):
+
+    def testFindWithinTolerance(self):
+        cache = SpatialCache(50)
+        cache.add(10.0, 60.0, 'a')
+        # About 33 meters east and 100 meters north at 60 degrees
+        self.assertEqual(cache.find(10.0006, 60.0), 'a')
+        self.assertIsNone(cache.find(10.0, 60.0009))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def testNearestAcrossCells(self):
+        cache = SpatialCache(20)
+        cache.add(0.0, 0.0, 'far')
+        cache.add(0.00025, 0.0, 'near')
+        self.assertEqual(cache.find(0.00017, 0.0), 'near')
+        cache.discard(0.00025, 0.0, 'near')
+        self.assertEqual(cache.find(0.00017, 0.0), 'far')
+
+
+class TileGridTest(unittest.TestCase):
+
+    def testTileOf(self):
+        self.assertEqual(tileOf(0.0, 0.0, 1), (1, 1))
+        self.assertEqual(tileOf(-180.0, 90.0, 3), (0, 0))
+        self.assertEqual(tileOf(180.0, -90.0, 3), (7, 7))
+
+    def testCenterIsInTile(self):
+        for zoom in (0, 5, 12, MAX_ZOOM):
+            x, y = tileOf(13.4, 52.5, zoom)
+            self.assertEqual(tileOf(*tileCenter(x, y, zoom), zoom=zoom), (x, y))
+
+    def testZoom(self):
+        self.assertEqual(tileZoom(18), MAX_ZOOM)
+        self.assertEqual(tileZoom(10), 13)
+        self.assertEqual(tileZoom(-5), 0)
+
+    def testTilesNear(self):
+        x0, y0, x1, y1 = tileRange(-1.0, -1.0, 1.0, 1.0, 8)
+        tiles = list(tilesNear(x0, y0, x0, y0, x1, y1, 1000))
+        self.assertEqual(tiles[0], (x0, y0))
+        self.assertEqual(len(tiles), (x1 - x0 + 1) * (y1 - y0 + 1))
+        self.assertEqual(len(set(tiles)), len(tiles))
+        self.assertEqual(len(list(tilesNear(x0, y0, x0, y0, x1, y1, 3))), 3)
@@ -0,0 +1,62 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import unittest
+
+from ..endpointPool import EndpointPool, parseEndpoints, LEAST_OUTSTANDING
+
+
+class EndpointPoolTest(unittest.TestCase):
+
+    def testParseEndpoints(self):
+        text = 'http://a:8080/ 2\n# http://skipped\n\nhttp://b\nhttp://c 0\nhttp://d x'
+        self.assertEqual(parseEndpoints(text), [('http://a:8080', 2.0), ('http://b', 1.0), ('http://d', 1.0)])
+
+    def assertRouted(self, pool, url, rest):
+        target, endpoint = pool.route(url)
+        self.assertIsNotNone(endpoint)
+        self.assertEqual(target, endpoint.url + rest)
+
+    def testOnlyPrimaryUrlsRouted(self):
+        pool = EndpointPool('https://nominatim.example.org/', [('http://replica', 1.0)])
+        self.assertRouted(pool, 'https://nominatim.example.org/search.php?q=a', '/search.php?q=a')
+        self.assertRouted(pool, 'https://NOMINATIM.example.org:443/reverse', '/reverse')
+        for url in ('https://nominatim.example.org.evil/search?q=a', 'http://nominatim.example.org/search',
+                'https://nominatim.example.org:8443/search', 'https://other.org/search'):
+            self.assertEqual(pool.route(url), (url, None))
+
+    def testPathBoundary(self):
+        pool = EndpointPool('https://h.org/nominatim', [('http://replica/n', 1.0)])
+        self.assertRouted(pool, 'https://h.org/nominatim/search?q=a', '/search?q=a')
+        self.assertRouted(pool, 'https://h.org/nominatim', '')
+        self.assertEqual(pool.route('https://h.org/nominatim2/search'), ('https://h.org/nominatim2/search', None))
+
+    def testWeightedRoundRobin(self):
+        pool = EndpointPool('http://a', [('http://a', 1.0), ('http://b', 3.0)])
+        urls = [pool.route('http://a/search')[0] for i in range(8)]
+        self.assertEqual(urls.count('http://b/search'), 6)
+        # Smooth round robin never sends the light server two in a row
+        self.assertNotIn(('http://a/search', 'http://a/search'), list(zip(urls, urls[1:])))
+
+    def testLeastOutstanding(self):
+        pool = EndpointPool('http://a', [('http://a', 1.0), ('http://b', 1.0)], LEAST_OUTSTANDING)
+        first = pool.route('http://a/x')[1]
+        second = pool.route('http://a/x')[1]
+        self.assertIsNot(first, second)
+        pool.release(first, True)
+        self.assertIs(pool.route('http://a/x')[1], first)
+
+    def testEjection(self):
+        pool = EndpointPool('http://a', [('http://a', 1.0), ('http://b', 1.0)])
+        bad = pool.endpoints[0]
+        for i in range(pool.EJECT_FAILURES):
+            pool.release(bad, False)
+        self.assertEqual(bad.numEjected, 1)
+        self.assertTrue(all(pool.route('http://a/x')[1] is not bad for i in range(6)))
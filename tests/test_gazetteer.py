@@ -0,0 +1,80 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from ..gazetteer import Gazetteer, queryText, normalize
+
+
+def place(osmId, road, town, house=''):
+    address = {'road': road, 'town': town}
+    if house:
+        address['house_number'] = house
+    return {'osm_type': 'node', 'osm_id': osmId, 'lat': '1.0', 'lon': '2.0',
+        'display_name': ', '.join(p for p in (house, road, town) if p), 'address': address}
+
+
+class GazetteerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.gazetteer = Gazetteer(os.path.join(self.directory, 'gazetteer.sqlite'))
+        self.gazetteer.importPlaces([place(1, 'Main Street', 'Springfield', '12'),
+            place(2, 'Main Street', 'Springfield', '14'), place(3, 'Main Street', 'Shelbyville'),
+            place(4, 'Elm Road', 'Springfield')])
+
+    def tearDown(self):
+        self.gazetteer.close()
+        shutil.rmtree(self.directory)
+
+    def search(self, text, details=False):
+        data = self.gazetteer.get('https://nominatim.example.org/search.php?q={}&format=json&limit=1'
+            '&addressdetails={}'.format(text.replace(' ', '+'), int(details)))
+        return None if data is None else [p['osm_id'] for p in json.loads(data.decode('utf-8'))]
+
+    def testUnambiguousMatches(self):
+        self.assertEqual(self.search('12 Main Street Springfield'), [1])
+        self.assertEqual(self.search('Main Street Shelbyville'), [3])
+        self.assertEqual(self.search('Elm Road'), [4])
+
+    def testHousesCompeteWithStreets(self):
+        # The houses cannot answer these but make them ambiguous
+        self.assertIsNone(self.search('Springfield'))
+        self.assertIsNone(self.search('Main Street'))
+
+    def testHouseNeedsItsNumber(self):
+        self.assertIsNone(self.search('16 Main Street Springfield'))
+
+    def testDetails(self):
+        p = place(5, 'Oak Lane', 'Ogden')
+        del p['address']
+        self.gazetteer.importPlaces([p])
+        self.assertEqual(self.search('Oak Lane Ogden'), [5])
+        self.assertIsNone(self.search('Oak Lane Ogden', True))
+
+    def testOfflineOnly(self):
+        self.gazetteer.configure(True, offlineOnly=True)
+        self.assertEqual(self.search('Main Street'), [])
+
+    def testImportedQuery(self):
+        url = 'https://nominatim.example.org/search.php?q=the+corner+shop&format=json&limit=1&addressdetails=0'
+        reply = json.dumps([place(6, 'High Street', 'Ogden')])
+        self.assertEqual(self.gazetteer.importReplies([(url, reply)]), 1)
+        self.assertEqual(self.search('The Corner Shop'), [6])
+
+    def testQueryText(self):
+        self.assertEqual(queryText('http://h/search.php?street=1+Main+St&city=Ogden&limit=3&addressdetails=1'),
+            ('1 main st ogden', 3, True))
+        self.assertIsNone(queryText('http://h/reverse.php?lat=1&lon=2'))
+        self.assertEqual(normalize(' Rue  de l\'Église_Nord '), 'rue de l église nord')
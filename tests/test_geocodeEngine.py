@@ -0,0 +1,169 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import json
+import unittest
+from urllib.parse import quote_plus
+
+from ..geocodeEngine import (COLUMNS, QueryTemplate, GeocodeConfig, GeocodeEngine, cleanValue, freeFormQuery,
+    forwardOptions, osmKey, lookupBatches, lookupResults, parseForward, LOOKUP_BATCH)
+from ..rateLimiter import RateLimiter
+from ..benchmark.mockServer import MockNominatim, place
+from ..benchmark.parseBenchmark import legacyForward
+
+
+def legacyTableQuery(searchURL, attributes, columns, useFreeFormQuery):
+    '''The table query builder QueryTemplate replaced.'''
+    full_address_idx = columns['full']
+    street_num_idx = columns['number']
+    street_name_idx = columns['street']
+    if full_address_idx >= 0:
+        address = '{}'.format(attributes[full_address_idx] or '').strip()
+        return freeFormQuery(searchURL, address), address
+    street = ''
+    if street_name_idx >= 0:
+        num = ''
+        if street_num_idx >= 0 and attributes[street_num_idx]:
+            num = '{}'.format(attributes[street_num_idx]).strip()
+        name = '{}'.format(attributes[street_name_idx]).strip() if attributes[street_name_idx] else ''
+        street = (num+' '+name).strip()
+    if useFreeFormQuery:
+        strs = [street] if street else []
+        for key in ('city', 'county', 'state', 'country', 'postal'):
+            if columns[key] >= 0:
+                s = '{}'.format(attributes[columns[key]]).strip()
+                if s:
+                    strs.append(s)
+        address = ', '.join(strs)
+        return searchURL + '?q=' + quote_plus(address), address
+    address = ','.join([str(x) if x else '' for x in attributes])
+    params = []
+    if street:
+        params.append('street='+quote_plus(cleanValue(street)))
+    for key, tag in (('city', 'city'), ('county', 'county'), ('state', 'state'),
+            ('country', 'country'), ('postal', 'postalcode')):
+        if columns[key] >= 0:
+            params.append(tag+'='+quote_plus(cleanValue(attributes[columns[key]])))
+    return searchURL + '?' + '&'.join(params), address
+
+
+class QueryTemplateTest(unittest.TestCase):
+
+    SEARCH = 'https://nominatim.example.org/search.php'
+    ROWS = [
+        ['12', 'Main  Street', 'Springfield', 'Greene', 'MO', 'USA', '65801', '12 Main Street, Springfield'],
+        [None, 'Rue de l\'Église', 'Paris', '', None, 'France', 75001, ''],
+        [7, ' Elm Rd ', '', None, 'Ohio\n', '', '', None],
+        ['', '', '', '', '', '', '', 'Only & full?']]
+    MAPPINGS = [
+        dict(zip(COLUMNS, (-1, 0, 1, 2, 3, 4, 5, 6))),
+        dict(zip(COLUMNS, (-1, -1, 1, 2, -1, 4, 5, -1))),
+        dict(zip(COLUMNS, (7, 0, 1, 2, 3, 4, 5, 6)))]
+
+    def testSameUrlsAsLegacyBuilder(self):
+        options = forwardOptions(3, True)
+        for columns in self.MAPPINGS:
+            for freeForm in (False, True):
+                template = QueryTemplate(self.SEARCH, columns, freeForm, options)
+                for row in self.ROWS:
+                    if freeForm and columns['full'] < 0 and None in [row[i] for i in template.indexes]:
+                        # None is now skipped instead of formatted as text
+                        continue
+                    url, address = legacyTableQuery(self.SEARCH, row, columns, freeForm)
+                    self.assertEqual(template(row), (url + options, address))
+
+    def testFieldIndexes(self):
+        self.assertIsNone(QueryTemplate(self.SEARCH, self.MAPPINGS[0]).fieldIndexes())
+        self.assertEqual(QueryTemplate(self.SEARCH, self.MAPPINGS[2]).fieldIndexes(), [7])
+        self.assertEqual(QueryTemplate(self.SEARCH, self.MAPPINGS[1], True).fieldIndexes(), [1, 2, 4, 5])
+
+
+class ParseTest(unittest.TestCase):
+
+    def testSameFieldsAsLegacyParser(self):
+        data = json.dumps([place(i, True) for i in range(5)]).encode('utf-8')
+        self.assertEqual(parseForward(json.loads(data), 'an address', True), legacyForward(data, 'an address'))
+
+    def testNoResult(self):
+        with self.assertRaises(ValueError):
+            parseForward([], 'nowhere', False)
+        with self.assertRaises(ValueError):
+            parseForward([{'display_name': 'no location'}], 'nowhere', False)
+
+
+class LookupTest(unittest.TestCase):
+
+    def testOsmKey(self):
+        self.assertEqual(osmKey('node', 123), 'N123')
+        self.assertEqual(osmKey('W', '45.0'), 'W45')
+        self.assertEqual(osmKey('', 'r9'), 'R9')
+        self.assertEqual(osmKey(None, 'N77'), 'N77')
+        self.assertIsNone(osmKey('area', 1))
+        self.assertIsNone(osmKey('node', 'abc'))
+        self.assertIsNone(osmKey('node', None))
+
+    def testBatches(self):
+        rows = [(i, 'N{}'.format(i % (LOOKUP_BATCH + 10))) for i in range(LOOKUP_BATCH + 20)] + [(-1, None)]
+        batches = list(lookupBatches('http://h/lookup.php', rows, False))
+        self.assertEqual(len(batches), 2)
+        self.assertEqual(batches[0][0].count(','), LOOKUP_BATCH - 1)
+        self.assertEqual(sum(len(batch) for url, batch in batches), len(rows))
+        self.assertEqual(list(lookupBatches('http://h/lookup.php', [(1, None)], False)), [(None, [(1, None)])])
+
+    def testResults(self):
+        data = json.dumps([{'osm_type': 'node', 'osm_id': 1, 'lat': '1', 'lon': '2', 'display_name': 'one'}])
+        results = list(lookupResults([(10, 'N1'), (11, 'N2'), (12, None)], data, False))
+        self.assertEqual(results[0], (10, 'N1', [(2.0, 1.0, ['one'])], None))
+        self.assertEqual(results[1][2:], (None, 'OSM object not found: N2'))
+        self.assertEqual(results[2][2:], (None, 'Invalid OSM type or id'))
+
+
+class EngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = MockNominatim()
+        self.url = self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def engine(self, **kwargs):
+        return GeocodeEngine(GeocodeConfig(self.url, maxConcurrent=2, **kwargs), limiter=RateLimiter())
+
+    def testResultsInInputOrder(self):
+        engine = self.engine()
+        rows = [(i, '{} Main Street'.format(i)) for i in range(20)]
+        results = list(engine.forward(rows))
+        engine.close()
+        self.assertEqual([r.rowId for r in results], list(range(20)))
+        self.assertTrue(all(r.error is None and len(r.points) == 1 for r in results))
+
+    def testRepeatedQueriesSentOnce(self):
+        engine = self.engine()
+        rows = [(i, 'Address {}'.format(i % 3)) for i in range(12)]
+        results = list(engine.forward(rows))
+        engine.close()
+        self.assertEqual(self.server.numRequests, 3)
+        self.assertEqual((engine.numRows, engine.numQueries), (12, 3))
+        self.assertEqual(results[0].points, results[3].points)
+
+    def testDeduplicationOff(self):
+        engine = self.engine(dedupSize=0)
+        list(engine.forward([(i, 'Same address') for i in range(4)]))
+        engine.close()
+        self.assertEqual(self.server.numRequests, 4)
+
+    def testInvalidCoordinates(self):
+        engine = self.engine()
+        results = list(engine.reverse([(1, 2.0, 1.0), (2, None, None)]))
+        engine.close()
+        self.assertIsNone(results[0].error)
+        self.assertEqual(results[1].error, 'Invalid coordinates')
+        self.assertEqual(self.server.numRequests, 1)
@@ -0,0 +1,59 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import time
+import unittest
+from email.utils import formatdate
+
+from ..rateLimiter import RateLimiter, backoffDelay, parseRetryAfter
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def testUnlimited(self):
+        limiter = RateLimiter(0)
+        self.assertTrue(all(limiter.reserve() == 0 for i in range(1000)))
+
+    def testBurstThenPaced(self):
+        limiter = RateLimiter(10)
+        self.assertEqual([limiter.reserve() for i in range(10)], [0] * 10)
+        delay = limiter.reserve()
+        self.assertGreater(delay, 0)
+        self.assertLessEqual(delay, 0.1)
+
+    def testThrottleBounds(self):
+        limiter = RateLimiter(16)
+        for i in range(20):
+            limiter.throttled()
+        self.assertEqual(limiter.currentRate, 1.0)
+        for i in range(40):
+            limiter.succeeded()
+        self.assertEqual(limiter.currentRate, 16.0)
+
+
+class BackoffTest(unittest.TestCase):
+
+    def testDelayBounds(self):
+        for attempt in range(12):
+            for i in range(50):
+                delay = backoffDelay(attempt, base=0.5, cap=10.0)
+                self.assertGreaterEqual(delay, 0.0)
+                self.assertLessEqual(delay, min(10.0, 0.5 * 2 ** attempt))
+
+    def testRetryAfter(self):
+        self.assertEqual(parseRetryAfter('120'), 120.0)
+        self.assertEqual(parseRetryAfter(' 1.5 '), 1.5)
+        self.assertEqual(parseRetryAfter('-3'), 0.0)
+        self.assertIsNone(parseRetryAfter(''))
+        self.assertIsNone(parseRetryAfter(None))
+        self.assertIsNone(parseRetryAfter('soon'))
+        delay = parseRetryAfter(formatdate(time.time() + 30, usegmt=True))
+        self.assertTrue(25 <= delay <= 30)
+        self.assertEqual(parseRetryAfter(formatdate(time.time() - 30, usegmt=True)), 0.0)
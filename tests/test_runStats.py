@@ -0,0 +1,119 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import os
+import csv
+import json
+import shutil
+import tempfile
+import unittest
+
+from ..runStats import RunStats, Histogram, PHASES, formatDuration
+from ..jobJournal import JobJournal
+
+
+class HistogramTest(unittest.TestCase):
+
+    def testPercentiles(self):
+        h = Histogram()
+        for msec in range(1, 101):
+            h.add(msec)
+        self.assertEqual(h.mean(), 50.5)
+        self.assertEqual(h.percentile(50), 50)
+        self.assertEqual(h.percentile(95), 100)
+        self.assertEqual(h.percentile(99), 100)
+        self.assertEqual(Histogram().percentile(50), 0.0)
+
+
+class RunStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testExport(self):
+        stats = RunStats('forward')
+        stats.add('network', 0.02)
+        stats.add('parse', 0.001)
+        stats.rowsDone(3)
+        stats.counters = {'retries': 1}
+        stats.stop()
+        path = os.path.join(self.directory, 'stats.json')
+        stats.export(path)
+        with open(path) as f:
+            d = json.load(f)
+        self.assertEqual(d['rows'], 3)
+        self.assertEqual(sorted(d['phases']), sorted(PHASES))
+        self.assertEqual(d['phases']['network']['count'], 1)
+        path = os.path.join(self.directory, 'stats.csv')
+        stats.export(path)
+        with open(path) as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual([row['phase'] for row in rows], list(PHASES))
+        self.assertEqual(rows[0]['retries'], '1')
+
+    def testStatus(self):
+        stats = RunStats()
+        stats.rowsDone(10)
+        self.assertIn('10 of 20 rows', stats.status(20))
+        self.assertIn('Throughput', stats.summary()[1])
+        self.assertEqual(formatDuration(3725), '1:02:05')
+
+
+class Feature(object):
+    '''The parts of a QgsFeature the journal records.'''
+
+    class Point(object):
+        def __init__(self, x, y):
+            self.x = lambda: x
+            self.y = lambda: y
+
+    def __init__(self, x, y, attributes):
+        self.point = Feature.Point(x, y)
+        self.values = attributes
+
+    def geometry(self):
+        return self
+
+    def asPoint(self):
+        return self.point
+
+    def attributes(self):
+        return self.values
+
+
+class JobJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testResume(self):
+        journal = JobJournal(os.path.join(self.directory, 'jobs'), 'input.csv', 'forward', 1)
+        journal.record(1, [Feature(2.0, 1.0, ['one'])])
+        journal.record(2, [])
+        self.assertFalse(journal.exists())
+        journal.checkpoint()
+        with open(journal.path, 'a') as f:
+            # A line cut short by a crash
+            f.write('{"id": 3, "f": [[')
+        resumed = JobJournal(os.path.join(self.directory, 'jobs'), 'input.csv', 'forward', 1)
+        self.assertEqual(resumed.load(), {1: [[2.0, 1.0, ['one']]], 2: []})
+        resumed.remove()
+        self.assertFalse(journal.exists())
+
+    def testKeysSelectJournal(self):
+        a = JobJournal(self.directory, 'input.csv', 'forward')
+        b = JobJournal(self.directory, 'input.csv', 'reverse')
+        self.assertNotEqual(a.path, b.path)
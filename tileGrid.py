@@ -0,0 +1,68 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import math
+
+# Latitude limit of the web mercator tiles
+MAX_LATITUDE = 85.0511287798
+MAX_ZOOM = 21
+
+
+def tileZoom(levelOfDetail):
+    '''Zoom of the tiles reverse geocoding results are shared within for a
+    nominatim level of detail. Nominatim zoom levels follow the map tile
+    zoom levels so tiles three levels finer are about 20 meters across at
+    the default building level of detail.'''
+    return max(0, min(MAX_ZOOM, levelOfDetail + 3))
+
+
+def tileOf(lon, lat, zoom):
+    '''Return the x, y of the web mercator tile containing lon, lat.'''
+    n = 2 ** zoom
+    lat = max(-MAX_LATITUDE, min(MAX_LATITUDE, lat))
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(n - 1, max(0, x)), min(n - 1, max(0, y))
+
+
+def tileCenter(x, y, zoom):
+    '''Return the lon, lat of the center of a tile.'''
+    n = 2 ** zoom
+    lon = (x + 0.5) / n * 360.0 - 180.0
+    lat = math.degrees(math.atan(math.sinh(math.pi * (1.0 - 2.0 * (y + 0.5) / n))))
+    return lon, lat
+
+
+def tileRange(west, south, east, north, zoom):
+    '''Return the x0, y0, x1, y1 of the tiles covering an extent.'''
+    x0, y0 = tileOf(west, north, zoom)
+    x1, y1 = tileOf(east, south, zoom)
+    return x0, y0, x1, y1
+
+
+def tilesNear(x, y, x0, y0, x1, y1, maxTiles):
+    '''Generate up to maxTiles (x, y) of the tiles in the range x0, y0 to
+    x1, y1 in rings of increasing distance from tile x, y.'''
+    x = min(x1, max(x0, x))
+    y = min(y1, max(y0, y))
+    count = 0
+    last = max(x - x0, x1 - x, y - y0, y1 - y)
+    for r in range(last + 1):
+        if r == 0:
+            ring = [(x, y)]
+        else:
+            ring = [(x + dx, y - r) for dx in range(-r, r + 1)] + [(x + dx, y + r) for dx in range(-r, r + 1)]
+            ring += [(x - r, y + dy) for dy in range(-r + 1, r)] + [(x + r, y + dy) for dy in range(-r + 1, r)]
+        for tx, ty in ring:
+            if x0 <= tx <= x1 and y0 <= ty <= y1:
+                yield tx, ty
+                count += 1
+                if count >= maxTiles:
+                    return